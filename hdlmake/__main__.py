@@ -95,6 +95,24 @@ def _get_parser():
         help="name for the Makefile file to be created",
         default=None,
         dest="filename")
+    makefile.add_argument(
+        "--reduce-deps",
+        help="remove the file dependencies already implied by other ones "
+             "from the simulation Makefile (transitive reduction)",
+        dest="reduce_deps",
+        default=False,
+        action="store_true")
+    makefile.add_argument(
+        "--defines",
+        help="comma separated Verilog macros defined by the user, that "
+             "select the `ifdef guarded code (an empty value for none) and "
+             "are added to the Verilog compiler options of the simulators "
+             "supporting it; repeat it to write a Makefile for each of "
+             "several configurations, all of them solved from a single "
+             "parse",
+        dest="defines",
+        default=None,
+        action="append")
     subparsers.add_parser(
         "fetch",
         help="fetch and/or update all of the remote modules")
@@ -132,9 +150,31 @@ def _get_parser():
         action="store_true")
     listfiles.add_argument(
         "--top",
-        help="print only those files required to build 'top'",
+        help="print only those files required to build 'top', several "
+             "comma separated tops can be given to print a list for each",
         dest="top",
         default=None)
+    listfiles.add_argument(
+        "--waves",
+        help="group the files in waves that can be compiled concurrently",
+        dest="waves",
+        default=False,
+        action="store_true")
+    listfiles.add_argument(
+        "--compile-times",
+        help="JSON file with the compile time history of the files, used "
+             "to sort them by compile priority and report the critical path",
+        dest="compile_times",
+        default=None)
+    listfiles.add_argument(
+        "--defines",
+        help="comma separated Verilog macros defined by the user, that "
+             "select the `ifdef guarded code (an empty value for none); "
+             "repeat it to get the result of several configurations, all "
+             "of them solved from a single parse",
+        dest="defines",
+        default=None,
+        action="append")
     tree = subparsers.add_parser(
         "tree",
         help="generate a module hierarchy tree graph")
@@ -179,6 +219,34 @@ def _get_parser():
         dest="log",
         default="info",
         help="logging level: debug, info, warning, error, critical")
+    parser.add_argument(
+        "--lazy-parse",
+        dest="lazy_parse",
+        default=False,
+        action="store_true",
+        help="parse only the files that can be required by the top entity")
+    parser.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        default=1,
+        type=int,
+        help="number of parallel processes used to parse the files")
+    parser.add_argument(
+        "--no-parse-cache",
+        dest="no_parse_cache",
+        default=False,
+        action="store_true",
+        help="parse every file instead of loading the unchanged ones "
+             "from the parse cache, which is kept by default in "
+             "hdlmake/parse in the user cache directory "
+             "($XDG_CACHE_HOME or ~/.cache)")
+    parser.add_argument(
+        "--parse-cache-dir",
+        dest="parse_cache_dir",
+        default=None,
+        help="directory of the parse cache, that can be shared by several "
+             "workspaces (default: hdlmake/parse in the user cache "
+             "directory)")
     parser.add_argument(
         "-p", "--prefix",
         dest="prefix_code",
@@ -32,7 +32,8 @@ from hdlmake.tools import load_syn_tool, load_sim_tool
 from hdlmake.util import shell
 from hdlmake.util.termcolor import colored
 from hdlmake import new_dep_solver as dep_solver
-from hdlmake.srcfile import SourceFileSet
+from hdlmake.parse_cache import ParseCache
+from hdlmake.srcfile import SourceFileSet, SourceFileRegistry
 
 
 def set_logging_level(options):
@@ -68,6 +69,13 @@ class Action(list):
         self.parseable_fileset = SourceFileSet()
         self.privative_fileset = SourceFileSet()
         self._deps_solved = False
+        self._dep_index = None
+        # the Verilog macros defined by the user selecting the relations
+        # found in `ifdef guarded code
+        self._defines = ()
+        # the File instances shared by all of the modules and dependencies
+        # of the pool
+        self.file_registry = SourceFileRegistry()
         self.options = options
         set_logging_level(options)
         self.new_module(parent=None,
@@ -140,20 +148,87 @@ class Action(list):
         logging.debug("End build complete file set")
         return all_manifested_files
 
-    def solve_file_set(self):
-        """Build file set with only those files required by the top entity"""
+    def _solve_dependencies(self, top_entities):
+        """Parse and solve the dependencies of the parseable fileset. If the
+        on demand parsing is enabled, only the files that can be required
+        by the top entities are parsed. The files are parsed for any set of
+        Verilog macros only if several configurations are requested"""
         if not self._deps_solved:
-            dep_solver.solve(self.parseable_fileset,
-                             self.tool.get_standard_libs())
+            parse_cache = self._get_parse_cache()
+            jobs = getattr(self.options, "jobs", 1)
+            any_defines = len(self.get_define_configurations()) > 1
+            fileset = self.parseable_fileset
+            if (getattr(self.options, "lazy_parse", False) and
+                    None not in top_entities):
+                fileset = dep_solver.parse_on_demand(
+                    fileset, top_entities, parse_cache=parse_cache,
+                    jobs=jobs, defines=None if any_defines else self._defines)
+            self._dep_index = dep_solver.solve(
+                fileset, self.tool.get_standard_libs(),
+                parse_cache=parse_cache, jobs=jobs, defines=self._defines,
+                any_defines=any_defines)
+            if parse_cache is not None:
+                parse_cache.log_stats()
+                parse_cache.evict_stale()
             self._deps_solved = True
+
+    def get_define_configurations(self):
+        """Get the list of the configurations of Verilog macros requested
+        by the user, every one of them being a tuple of macro names"""
+        defines_options = getattr(self.options, "defines", None)
+        if not defines_options:
+            return [()]
+        return [tuple(name.strip() for name in defines.split(",")
+                      if name.strip())
+                for defines in defines_options]
+
+    def select_defines(self, defines):
+        """Select the Verilog macros defined by the user. If the design
+        has already been solved for several configurations, the relations
+        of the files are selected again and only the solution of the files
+        that change is updated, without parsing anything again"""
+        self._defines = tuple(defines)
+        if not self._deps_solved:
+            return
+        changed_files = dep_solver.select_defines(self._dep_index.file_keys,
+                                                  self._defines)
+        if changed_files:
+            dep_solver.update_solution(changed_files, self._dep_index,
+                                       self.tool.get_standard_libs())
+
+    def _get_parse_cache(self):
+        """Get the ParseCache to be used when parsing the files, or None
+        if it has been disabled by the user"""
+        if getattr(self.options, "no_parse_cache", True):
+            return None
+        return ParseCache(getattr(self.options, "parse_cache_dir", None))
+
+    def solve_file_set(self):
+        """Build file set with only those files required by the top entity"""
+        self._solve_dependencies([self.top_entity])
         solved_files = SourceFileSet()
         solved_files.add(dep_solver.make_dependency_set(
-            self.parseable_fileset, self.top_entity))
+            self.parseable_fileset, self.top_entity,
+            dep_index=self._dep_index))
         self.parseable_fileset = solved_files
 
+    def solve_file_sets(self, top_entities):
+        """Build, for every one of the given top entities, the file set with
+        only those files required by it. The parseable fileset is kept"""
+        self._solve_dependencies(top_entities)
+        dep_sets = dep_solver.make_dependency_sets(
+            self.parseable_fileset, top_entities, dep_index=self._dep_index)
+        solved_file_sets = {}
+        for top_entity in top_entities:
+            solved_files = SourceFileSet()
+            solved_files.add(dep_sets[top_entity])
+            solved_file_sets[top_entity] = solved_files
+        return solved_file_sets
+
     def build_file_set(self):
         """Initialize the parseable and privative fileset contents"""
         total_files = self.build_complete_file_set()
+        self.file_registry.log_merged_paths()
         for file_aux in total_files:
             if any(isinstance(file_aux, file_type)
                    for file_type in self.tool.get_privative_files()):
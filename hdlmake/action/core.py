@@ -45,6 +45,7 @@ class ActionCore(Action):
         self.git_backend = Git()
         self.svn_backend = Svn()
         self.local_backend = Local()
+        self._compile_times = None
 
     def _check_all_fetched_or_quit(self):
         """Check if every module in the pool is fetched"""
@@ -59,15 +60,71 @@ class ActionCore(Action):
             quit()
 
     def makefile(self):
-        """Write the Makefile for the current design"""
+        """Write the Makefile for the current design. If several
+        configurations of Verilog macros are requested, a Makefile named
+        after its macros is written for every one of them"""
         self._check_all_fetched_or_quit()
+        configurations = self.get_define_configurations()
+        if len(configurations) > 1:
+            self._makefile_configurations(configurations)
+            return
+        self.select_defines(configurations[0])
         self.build_file_set()
         self.solve_file_set()
         combined_fileset = self.parseable_fileset
         combined_fileset.add(self.privative_fileset)
-        self.tool.write_makefile(self.config,
+        self.tool.reduce_deps = getattr(self.options, "reduce_deps", False)
+        config = self.config
+        if configurations[0]:
+            if self.tool.get_define_options(configurations[0]) is None:
+                logging.warning(
+                    "The Makefile of the selected tool can't define the "
+                    "Verilog macros %s: they only select the files, the "
+                    "manifest options have to define them",
+                    ", ".join(configurations[0]))
+            else:
+                config = self._get_define_config(self.tool,
+                                                 configurations[0])
+        self.tool.write_makefile(config,
                                  combined_fileset,
                                  filename=self.options.filename)
+        self.tool.makefile_close()
+
+    def _get_define_config(self, tool, defines):
+        """Get a copy of the configuration in which the options of the tool
+        define the provided Verilog macros"""
+        config = dict(self.config)
+        for key, value in tool.get_define_options(defines).items():
+            config[key] = " ".join([option for option in
+                                    [config.get(key, ""), value] if option])
+        return config
+
+    def _makefile_configurations(self, configurations):
+        """Write a Makefile for every one of the given configurations of
+        Verilog macros, parsing the design only once. The options of the
+        tool define the macros of every configuration, so that the tools
+        whose Makefile can't define them are rejected"""
+        if self.tool.get_define_options(()) is None:
+            logging.error("The Makefile of the selected tool can't define "
+                          "Verilog macros, so only one configuration can "
+                          "be given with --defines")
+            quit()
+        self.build_file_set()
+        filename = getattr(self.options, "filename", None) or "Makefile"
+        for index, defines in enumerate(configurations):
+            self.select_defines(defines)
+            solved_files = self.solve_file_sets([self.top_entity])
+            combined_fileset = solved_files[self.top_entity]
+            combined_fileset.add(self.privative_fileset)
+            # every Makefile is written by its own instance of the tool,
+            # from its own copy of the configuration that the tool updates
+            tool = self.tool if index == 0 else self.tool.__class__()
+            tool.reduce_deps = getattr(self.options, "reduce_deps", False)
+            tool.write_makefile(self._get_define_config(tool, defines),
+                                combined_fileset,
+                                filename="%s.%s" % (
+                                    filename, "_".join(defines) or "default"))
+            tool.makefile_close()
 
     def _fetch_all(self):
         """Fetch all the modules declared in the design"""
@@ -147,19 +204,94 @@ class ActionCore(Action):
         for mod_aux in unfetched_modules:
             logging.warning(
                 "List incomplete, module %s has not been fetched!", mod_aux)
-        self.top_entity = self.options.top
-        self.build_file_set()
-        self.solve_file_set()
-        file_list = dep_solver.make_dependency_sorted_list(
-            self.parseable_fileset)
-        files_str = [file_aux.path for file_aux in file_list]
-        if self.options.reverse is True:
-            files_str.reverse()
         if self.options.delimiter is None:
             delimiter = "\n"
         else:
             delimiter = self.options.delimiter
+        configurations = self.get_define_configurations()
+        if self.options.top is not None and ',' in self.options.top:
+            top_entities = self.options.top.split(',')
+        elif len(configurations) > 1:
+            top_entities = [self.options.top]
+        else:
+            self.select_defines(configurations[0])
+            self.top_entity = self.options.top
+            self.build_file_set()
+            self.solve_file_set()
+            self._print_solved_files(self.parseable_fileset, delimiter)
+            return
+        self.build_file_set()
+        for defines in configurations:
+            if len(configurations) > 1:
+                print("# DEFINES START -> %s" %
+                      (",".join(defines) or "default"))
+            self.select_defines(defines)
+            self._list_files_multiple_tops(top_entities, delimiter)
+            if len(configurations) > 1:
+                print("# DEFINES END -> %s" %
+                      (",".join(defines) or "default"))
+
+    def _get_sorted_paths(self, fileset):
+        """Get the paths of the files sorted in order of dependency"""
+        file_list = dep_solver.make_dependency_sorted_list(fileset)
+        files_str = [file_aux.path for file_aux in file_list]
+        if self.options.reverse is True:
+            files_str.reverse()
+        return files_str
+
+    def _list_files_multiple_tops(self, top_entities, delimiter):
+        """List the files required by each one of the given top entities,
+        solving the dependencies of the design only once"""
+        solved_file_sets = self.solve_file_sets(top_entities)
+        for top_entity in top_entities:
+            if len(top_entities) > 1:
+                print("# TOP START -> %s" % top_entity)
+            self._print_solved_files(solved_file_sets[top_entity], delimiter)
+            if len(top_entities) > 1:
+                print("# TOP END -> %s" % top_entity)
+
+    def _print_solved_files(self, fileset, delimiter):
+        """Print the solved files, either as a list sorted in order of
+        dependency, grouped in compile waves or sorted by compile priority"""
+        if getattr(self.options, "compile_times", None) is not None:
+            self._print_priority_files(fileset, delimiter)
+            return
+        if not getattr(self.options, "waves", False):
+            print(delimiter.join(self._get_sorted_paths(fileset)))
+            return
+        waves = dep_solver.make_compile_waves(fileset)
+        wave_order = list(range(len(waves)))
+        if self.options.reverse is True:
+            wave_order.reverse()
+        for wave_index in wave_order:
+            wave = waves[wave_index]
+            for library in sorted(wave):
+                print("# WAVE %d -> %s" % (wave_index, library))
+                print(delimiter.join(
+                    [file_aux.path for file_aux in wave[library]]))
+        stats = dep_solver.get_compile_waves_stats(waves)
+        print("# WAVES: %d files, depth %d, max width %d, average width %.1f"
+              % (stats["files"], stats["depth"], stats["max_width"],
+                 stats["average_width"]))
+
+    def _print_priority_files(self, fileset, delimiter):
+        """Print the solved files in a compile order that starts first the
+        files with the longest chain of dependents, as weighted by the
+        compile time history, followed by the critical path of the design"""
+        if self._compile_times is None:
+            self._compile_times = dep_solver.read_compile_times(
+                self.options.compile_times)
+        critical_path, critical_length, total_work, tails = \
+            dep_solver.make_critical_path(fileset, self._compile_times)
+        files_str = [file_aux.path for file_aux in
+                     dep_solver.make_priority_sorted_list(fileset, tails)]
+        if self.options.reverse is True:
+            files_str.reverse()
         print(delimiter.join(files_str))
+        print("# CRITICAL PATH: %.2f s, total work %.2f s" %
+              (critical_length, total_work))
+        for file_aux in critical_path:
+            print("# %s" % file_aux.path)
 
     def _print_comment(self, message):
         """Private method that prints a message to stdout if not terse"""
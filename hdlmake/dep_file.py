@@ -24,15 +24,23 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import os
-import logging
 
 from .util import path as path_mod
+from .vlog_guard import ALWAYS, NEVER, guard_or, guard_holds
 import six
+from six.moves import intern
 
 
 class DepRelation(object):
 
-    """Class used to create instances representing HDL dependency relations"""
+    """Class used to create instances representing HDL dependency relations.
+    The instances are interned: creating a relation identical to an already
+    existing one returns the existing instance, so the same relation found
+    in many files is shared and can be hashed and compared cheaply. The
+    table of the interned instances is cleared at the start of every parse
+    run, the relations created before being still equal to the new ones"""
+
+    __slots__ = ('direction', 'rel_type', 'obj_name', '_hash')
 
     # direction
     PROVIDE = 1
@@ -44,18 +52,45 @@ class DepRelation(object):
     INCLUDE = 3
     ARCHITECTURE = 4
     MODULE = ARCHITECTURE
-
-    def __init__(self, obj_name, direction, rel_type):
+    # SystemVerilog X::name references outside of an import: X may be a
+    # package but also a class, a module or a built-in scope like std, so
+    # the relation is only resolved if a package named X is provided
+    SCOPE = 5
+
+    # (obj_name, direction, rel_type) -> interned DepRelation instance
+    _instances = {}
+
+    def __new__(cls, obj_name, direction, rel_type):
+        obj_name = obj_name.lower()
+        key = (obj_name, direction, rel_type)
+        try:
+            return cls._instances[key]
+        except KeyError:
+            pass
         assert direction in [DepRelation.PROVIDE, DepRelation.USE]
         assert rel_type in [
             DepRelation.ENTITY,
             DepRelation.PACKAGE,
             DepRelation.INCLUDE,
             DepRelation.ARCHITECTURE,
-            DepRelation.MODULE]
-        self.direction = direction
-        self.rel_type = rel_type
-        self.obj_name = obj_name.lower()
+            DepRelation.MODULE,
+            DepRelation.SCOPE]
+        new_rel = super(DepRelation, cls).__new__(cls)
+        new_rel.direction = direction
+        new_rel.rel_type = rel_type
+        new_rel.obj_name = intern(obj_name)
+        new_rel._hash = hash(key)
+        cls._instances[key] = new_rel
+        return new_rel
+
+    @classmethod
+    def clear_instances(cls):
+        """Forget the interned instances, so that the table does not grow
+        with the relations of every parse run of the process"""
+        cls._instances.clear()
+
+    def __reduce__(self):
+        return (DepRelation, (self.obj_name, self.direction, self.rel_type))
 
     def satisfies(self, rel_b):
         """Check if the current dependency relation matches the provided one"""
@@ -85,17 +120,25 @@ class DepRelation(object):
             self.PACKAGE: "package",
             self.INCLUDE: "include/header",
             self.ARCHITECTURE: "architecture",
-            self.MODULE: "module"}
+            self.MODULE: "module",
+            self.SCOPE: "package scope"}
         return "%s %s '%s'" % (dstr[self.direction],
                                ostr[self.rel_type],
                                self.obj_name)
 
     def __hash__(self):
-        return hash(self.__repr__())
+        return self._hash
 
     def __eq__(self, other):
-        return (isinstance(other, self.__class__)
-                and self.__dict__ == other.__dict__)
+        # Relations are interned, so identical relations are the same object
+        # unless they were created before the table was cleared
+        if self is other:
+            return True
+        if not isinstance(other, DepRelation) or self._hash != other._hash:
+            return False
+        return (self.obj_name == other.obj_name and
+                self.direction == other.direction and
+                self.rel_type == other.rel_type)
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -105,8 +148,11 @@ class File(object):
 
     """This is the base class for all of the different files in HDLMake"""
 
+    # Designs can have tens of thousands of files, so they are kept compact
+    __slots__ = ('path', 'module')
+
     def __init__(self, path, module=None):
-        self.path = path
+        self.path = intern(path)
         assert not isinstance(module, six.string_types)
         self.module = module
 
@@ -181,22 +227,57 @@ class File(object):
 class DepFile(File):
 
     """Class that serves as base to all those HDL files that can be
-    parsed and solved (Verilog, SystemVerilog, VHDL)"""
+    parsed and solved (Verilog, SystemVerilog, VHDL). The relations found
+    in `ifdef guarded Verilog code are kept in guarded_rels with their
+    guards, and only those holding for the selected defines are in rels"""
+
+    __slots__ = ('file_path', 'rels', 'depends_on', 'dep_level', 'is_parsed',
+                 'include_paths', 'guarded_rels')
 
     def __init__(self, file_path, module):
         assert isinstance(file_path, six.string_types)
         File.__init__(self, path=file_path, module=module)
-        self.file_path = file_path
+        self.file_path = self.path
         self.rels = set()
         self.depends_on = set()
         self.dep_level = None
         self.is_parsed = False
-        self.file_path = file_path
-        self.include_paths = []
-
-    def add_relation(self, rel):
-        """Add a new relation to the set provided by the file"""
-        self.rels.add(rel)
+        self.include_paths = ()
+        self.guarded_rels = None
+
+    def add_relation(self, rel, guard=None):
+        """Add a new relation to the set provided by the file. If a guard
+        is given, the relation is only found in the code compiled when the
+        guard holds, and it is not selected until select_defines is used"""
+        if guard is not None and self.guarded_rels is not None:
+            guard = guard_or(self.guarded_rels.get(rel, NEVER), guard)
+        if guard is None or guard == ALWAYS:
+            self.rels.add(rel)
+            if self.guarded_rels is not None:
+                self.guarded_rels.pop(rel, None)
+            return
+        if rel in self.rels and (self.guarded_rels is None or
+                                 rel not in self.guarded_rels):
+            return
+        if self.guarded_rels is None:
+            self.guarded_rels = {}
+        self.guarded_rels[rel] = guard
+
+    def select_defines(self, defines):
+        """Select the guarded relations that hold when the provided macros
+        are defined. It returns True if the relations have changed"""
+        if not self.guarded_rels:
+            return False
+        changed = False
+        for rel, guard in six.iteritems(self.guarded_rels):
+            if guard_holds(guard, defines):
+                if rel not in self.rels:
+                    self.rels.add(rel)
+                    changed = True
+            elif rel in self.rels:
+                self.rels.discard(rel)
+                changed = True
+        return changed
 
     def satisfies(self, rel_b):
         """Check if any of the file object relations match any of the relations
@@ -216,25 +297,3 @@ class DepFile(File):
         """Property defined as a method that checks the basename of the file
         path in the host, i.e. the name of the last directory on the path"""
         return os.path.basename(self.file_path)
-
-    def get_dep_level(self):
-        """Get the dependency level for the file instance, so we can order
-        later the full fileset"""
-        if self.dep_level is None:
-            if len(self.depends_on) == 0:
-                self.dep_level = 0
-            else:
-                # set dep_level to a negative value so we can detect
-                # if the recusion below brings us back to
-                # this file in a circular reference, that would otherwise
-                # result in an infinite loop.
-                self.dep_level = -1
-                # recurse, to find the largest number of levels below.
-                self.dep_level = 1 + \
-                    max([dep.get_dep_level() for dep in self.depends_on])
-        elif self.dep_level < 0:
-            logging.warning("Probably run into a circular reference of file "
-                            "dependencies. It appears %s depends on itself, "
-                            "indirectly via atleast one other file.",
-                            self.file_path)
-        return self.dep_level
@@ -62,6 +62,11 @@ class ManifestParser(ConfigParser):
              'default': [],
              'help': "List of files from the current module",
              'type': ''},
+            {'name': 'netlist_files',
+             'default': [],
+             'help': "List of files or patterns of the current module that "
+             "are netlists, only scanned for their declarations",
+             'type': []},
             {'name': 'modules',
              'default': {},
              'help': "List of local modules",
@@ -71,6 +76,7 @@ class ManifestParser(ConfigParser):
         self.add_type('include_dirs', type_new="")
         self.add_type('incl_makefiles', type_new='')
         self.add_type('files', type_new=[])
+        self.add_type('netlist_files', type_new='')
         self.add_allowed_key('modules', key="svn")
         self.add_allowed_key('modules', key="git")
         self.add_allowed_key('modules', key="local")
@@ -2,6 +2,7 @@
 from files to required submodules"""
 
 from __future__ import absolute_import
+import fnmatch
 import logging
 from hdlmake import fetch
 from hdlmake.util import path as path_mod
@@ -167,19 +168,36 @@ class ModuleContent(ModuleCore):
                 include_dirs = self.top_module.manifest_dict['include_dirs']
             else:
                 include_dirs = []
+        netlist_patterns = self.manifest_dict.get("netlist_files", [])
+        if isinstance(netlist_patterns, six.string_types):
+            netlist_patterns = [netlist_patterns]
+        netlist_patterns = [os.path.normpath(os.path.join(self.path, pattern))
+                            for pattern in netlist_patterns]
+
+        def _is_netlist(path):
+            """Netlists are told by their extension, unless the path matches
+            one of the netlist_files patterns of the manifest"""
+            path = os.path.normpath(os.path.join(self.path, path))
+            for pattern in netlist_patterns:
+                if fnmatch.fnmatch(path, pattern):
+                    return True
+            return None
         for path_aux in paths:
             if os.path.isdir(path_aux):
                 dir_ = os.listdir(path_aux)
                 for f_dir in dir_:
                     f_dir = os.path.join(self.path, path_aux, f_dir)
                     if not os.path.isdir(f_dir):
-                        srcs.add(create_source_file(path=f_dir,
-                                                    module=self,
-                                                    library=self.library,
-                                                    include_dirs=include_dirs))
+                        srcs.add(create_source_file(
+                            path=f_dir,
+                            module=self,
+                            library=self.library,
+                            include_dirs=include_dirs,
+                            netlist=_is_netlist(f_dir)))
             else:
                 srcs.add(create_source_file(path=path_aux,
                                             module=self,
                                             library=self.library,
-                                            include_dirs=include_dirs))
+                                            include_dirs=include_dirs,
+                                            netlist=_is_netlist(path_aux)))
         return srcs
@@ -34,5 +34,6 @@ class ModulePool(ActionCore, ActionTree):
     """
 
     def __init__(self, *args):
-        ActionCore.__init__(self, *args)
-        ActionTree.__init__(self, *args)
+        # the cooperative __init__ chain of the actions runs Action.__init__
+        # once, so the manifests are only parsed once
+        super(ModulePool, self).__init__(*args)
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Module providing the parsers for the netlists generated by the HDL
+tools, that are scanned for their declarations only"""
+
+from __future__ import absolute_import
+import logging
+import re
+
+from .new_dep_solver import DepParser
+from .dep_file import DepRelation
+from .util.mapped_file import decode
+
+
+class NetlistParser(DepParser):
+
+    """Base class for the netlist parsers. Generated netlists are made of
+    a few declarations and of millions of instances of primitive cells
+    that are provided by the vendor libraries, so they are not parsed
+    like the hand-written sources: the file is streamed in chunks of
+    whole lines, looking only for the lines with a declaration and for
+    the names of the instantiated cells. Every different cell name is
+    used once, and the cells that are not provided by any file of the
+    design are left to the vendor libraries without a warning.
+    The prescan streams the whole netlist too, so its result is kept until
+    the file is parsed in the same run, and the netlist is only read
+    once when the files are parsed on demand"""
+
+    # Size of the chunks the netlist is read in
+    CHUNK_SIZE = 4 * 1024 * 1024
+    # Patterns applied to every chunk, they must match a single line
+    declaration_pattern = None
+    cell_pattern = None
+    # Names matched by the cell pattern that are not cells
+    keywords = frozenset()
+
+    def __init__(self):
+        DepParser.__init__(self)
+        # path -> result of the scan done by the prescan of the file
+        self._prescans = {}
+
+    def start_run(self, defines):
+        """Drop the scans kept from the previous run"""
+        self._prescans = {}
+
+    def keeps_prescan(self, dep_file):
+        """The scan of a prescanned netlist is kept until it is parsed"""
+        return dep_file.path in self._prescans
+
+    def _scan(self, dep_file):
+        """Stream the netlist and return the groups of the declarations
+        found and the set of different (library, name) cells it
+        instantiates"""
+        declarations = []
+        cells = set()
+        with open(dep_file.file_path, "rb") as netlist:
+            pending = b""
+            while True:
+                chunk = netlist.read(self.CHUNK_SIZE)
+                if not chunk:
+                    lines = pending
+                else:
+                    last_line = chunk.rfind(b"\n") + 1
+                    lines = pending + chunk[:last_line]
+                    pending = chunk[last_line:]
+                declarations.extend(
+                    match.groupdict()
+                    for match in self.declaration_pattern.finditer(lines))
+                cells.update(self.cell_pattern.findall(lines))
+                if not chunk:
+                    break
+        return declarations, cells
+
+    def get_cache_config(self, dep_file):
+        """Netlists are not parsed like the other files of the same type"""
+        return ("netlist",)
+
+    def prescan(self, dep_file):
+        """The declarations are the only thing needed by the prescan, but
+        the whole scan is kept for the parse of the file"""
+        declarations, cells = self._scan(dep_file)
+        self._prescans[dep_file.path] = (declarations, cells)
+        provided = set()
+        for groups in declarations:
+            for rel in self._get_declaration_relations(dep_file, groups):
+                if rel.direction == DepRelation.PROVIDE:
+                    provided.add((rel.rel_type, rel.obj_name))
+        return provided
+
+    def parse(self, dep_file):
+        """Scan the netlist and add its declarations and the cells it
+        instantiates to the relations of the file"""
+        if dep_file.is_parsed:
+            return
+        logging.debug("Parsing netlist %s", dep_file.path)
+        try:
+            declarations, cells = self._prescans.pop(dep_file.path)
+        except KeyError:
+            declarations, cells = self._scan(dep_file)
+        for groups in declarations:
+            for rel in self._get_declaration_relations(dep_file, groups):
+                dep_file.add_relation(rel)
+        for library, name in cells:
+            name = decode(name)
+            if name.lower() in self.keywords:
+                continue
+            library = decode(library)
+            if not library or library.lower() == "work":
+                library = dep_file.library
+            self._add_cell(dep_file, library, name)
+        logging.debug("%s instantiates %d different cells",
+                      dep_file.path, len(cells))
+        dep_file.is_parsed = True
+
+    def _get_declaration_relations(self, dep_file, groups):
+        """Base dummy interface method to get the relations of a declaration
+        found in the netlist, from the groups matched by the declaration
+        pattern"""
+        return []
+
+    def _add_cell(self, dep_file, library, name):
+        """Base dummy interface method to add the relation for a cell
+        instantiated in the netlist"""
+        pass
+
+
+class VHDLNetlistParser(NetlistParser):
+
+    """Class providing the parser for the VHDL netlists (.vho)"""
+
+    declaration_pattern = re.compile(
+        br"^[ \t]*(?:(?P<kind>entity|package)[ \t]+(?P<name>\w+)[ \t]+is\b"
+        br"|architecture[ \t]+\w+[ \t]+of[ \t]+(?P<arch_entity>\w+)"
+        br"[ \t]+is\b"
+        br"|use[ \t]+(?P<use_lib>\w+)[ \t]*\.[ \t]*(?P<use_name>\w+))",
+        re.MULTILINE | re.IGNORECASE)
+    # A cell is instantiated after the label of the instance, which is an
+    # escaped identifier in most netlists, and followed by its maps
+    cell_pattern = re.compile(
+        br"^[ \t]*(?:\\[^\\\n]*\\|\w+)[ \t]*:[ \t]*"
+        br"(?:component[ \t]+|entity[ \t]+(\w+)[ \t]*\.[ \t]*)?"
+        br"(\w+)(?=[ \t]*(?:port\b|generic\b|\r?$))",
+        re.MULTILINE | re.IGNORECASE)
+    keywords = frozenset(["block", "process", "postponed", "component",
+                          "configuration", "entity", "in", "out", "inout",
+                          "buffer", "linkage"])
+
+    def _get_declaration_relations(self, dep_file, groups):
+        library = dep_file.library
+        if groups["kind"] is not None:
+            name = "%s.%s" % (library, decode(groups["name"]))
+            if groups["kind"].lower() == b"entity":
+                return [DepRelation(name, DepRelation.PROVIDE,
+                                    DepRelation.ENTITY)]
+            return [DepRelation(name, DepRelation.PROVIDE,
+                                DepRelation.PACKAGE)]
+        if groups["arch_entity"] is not None:
+            name = "%s.%s" % (library, decode(groups["arch_entity"]))
+            return [DepRelation(name, DepRelation.PROVIDE,
+                                DepRelation.ARCHITECTURE),
+                    DepRelation(name, DepRelation.USE, DepRelation.ENTITY)]
+        use_lib = decode(groups["use_lib"])
+        if use_lib.lower() == "work":
+            use_lib = library
+        return [DepRelation("%s.%s" % (use_lib,
+                                       decode(groups["use_name"])),
+                            DepRelation.USE, DepRelation.PACKAGE)]
+
+    def _add_cell(self, dep_file, library, name):
+        dep_file.add_relation(DepRelation("%s.%s" % (library, name),
+                                          DepRelation.USE,
+                                          DepRelation.ARCHITECTURE))
+
+
+class VerilogNetlistParser(NetlistParser):
+
+    """Class providing the parser for the Verilog netlists (.vo, .vm)"""
+
+    declaration_pattern = re.compile(
+        br"^[ \t]*(?P<kind>module|macromodule|interface|package)[ \t]+"
+        br"(?P<name>\\?[\w$]+)",
+        re.MULTILINE)
+    # A cell is instantiated with its parameters or followed by the name
+    # of the instance and its port list
+    cell_pattern = re.compile(
+        br"^[ \t]*()([A-Za-z_][\w$]*)[ \t]+"
+        br"(?:#|\\\S+[ \t]*\(|[A-Za-z_][\w$]*[ \t]*\()",
+        re.MULTILINE)
+
+    def __init__(self):
+        from .vlog_parser import VerilogParser
+        NetlistParser.__init__(self)
+        self.keywords = VerilogParser.reserved_words
+
+    def _get_declaration_relations(self, dep_file, groups):
+        name = "%s.%s" % (dep_file.library, decode(groups["name"]))
+        if groups["kind"] == b"package":
+            return [DepRelation(name, DepRelation.PROVIDE,
+                                DepRelation.PACKAGE)]
+        return [DepRelation(name, DepRelation.PROVIDE, DepRelation.MODULE)]
+
+    def _add_cell(self, dep_file, library, name):
+        dep_file.add_relation(DepRelation("%s.%s" % (library, name),
+                                          DepRelation.USE,
+                                          DepRelation.MODULE))
+
+    def parse(self, dep_file):
+        if dep_file.is_parsed:
+            return
+        NetlistParser.parse(self, dep_file)
+        dep_file.add_relation(DepRelation(dep_file.path, DepRelation.PROVIDE,
+                                          DepRelation.INCLUDE))
@@ -26,27 +26,346 @@
 from __future__ import print_function
 from __future__ import absolute_import
 import logging
+import collections
+import heapq
+import itertools
+import json
+import os
 
 from .dep_file import DepFile
+import six
 
 
 class DepParser(object):
 
-    """Base Class for the different HDL parsers (VHDL and Verilog)"""
+    """Base Class for the different HDL parsers (VHDL and Verilog). The
+    parsers keep no state of the files they parse beyond the current parse
+    run, so a single instance of every parser class is shared by all of
+    the files"""
 
-    def __init__(self, dep_file):
-        self.dep_file = dep_file
+    # parser class -> instance shared by the files
+    _shared_instances = {}
+    # Verilog macros defined in the current parse run, None if the files
+    # are parsed for any of them
+    run_defines = None
+
+    @classmethod
+    def get_shared(cls):
+        """Get the instance of the parser class shared by all the files"""
+        try:
+            return DepParser._shared_instances[cls]
+        except KeyError:
+            parser = cls()
+            parser.start_run(DepParser.run_defines)
+            DepParser._shared_instances[cls] = parser
+            return parser
+
+    @classmethod
+    def start_parse_run(cls, defines=None):
+        """Tell the shared parsers that a new fileset is going to be parsed
+        for the provided Verilog macros, or for any of them if None, so
+        that they drop what they keep from the previous one. The interned
+        relations of the previous run are dropped too"""
+        from .dep_file import DepRelation
+        DepRelation.clear_instances()
+        if defines is not None:
+            defines = tuple(defines)
+        DepParser.run_defines = defines
+        for parser in DepParser._shared_instances.values():
+            parser.start_run(defines)
+
+    def start_run(self, defines):
+        """Base dummy interface method called before parsing a fileset"""
+        pass
 
     def parse(self, dep_file):
         """Base dummy interface method for the HDL parse execution"""
         pass
 
+    def prescan(self, dep_file):
+        """Base interface method for a cheap scan of the file that returns
+        a set with the (rel_type, obj_name) pairs the file may provide.
+        The set can contain pairs that are not really provided, but it
+        must contain all of those that are. None is returned when this
+        can't be known without parsing the file"""
+        return None
+
+    def keeps_prescan(self, dep_file):
+        """Base interface method telling if the parser keeps the result of
+        the prescan of the file to parse it, so that the file must be
+        parsed by the process that prescanned it"""
+        return False
+
+    def get_cache_config(self, dep_file):
+        """Get a tuple with the parser options, other than the file path
+        and library, that can change the relations found in the file. It is
+        part of the key of the file in the parse cache"""
+        return ()
+
+
+def _parse_job(job):
+    """Parse the file described by the job tuple in a worker process, and
+    return its relations, guarded relations and includes as plain tuples
+    and paths. If the parser exits, None is returned so that the file is
+    parsed again by the main process and the error is reported there"""
+    from .srcfile import create_source_file
+    path, library, include_dirs, netlist = job
+    dep_file = create_source_file(path, None, library=library,
+                                  include_dirs=include_dirs,
+                                  netlist=netlist)
+    if include_dirs is not None:
+        dep_file.include_dirs = tuple(include_dirs)
+    try:
+        dep_file.parser.parse(dep_file)
+    except SystemExit:
+        return None
+    guarded_rels = dep_file.guarded_rels or {}
+    return ([(rel.obj_name, rel.direction, rel.rel_type)
+             for rel in dep_file.rels if rel not in guarded_rels],
+            [(rel.obj_name, rel.direction, rel.rel_type, guard)
+             for rel, guard in guarded_rels.items()],
+            [dep.path for dep in dep_file.depends_on])
+
+
+def _make_pool(processes):
+    """Start a pool of worker processes to parse files, whose parse runs
+    have the Verilog macros of the current one"""
+    import multiprocessing
+    return multiprocessing.Pool(processes, DepParser.start_parse_run,
+                                (DepParser.run_defines,))
+
+
+def parse_files(dep_files, parse_cache=None, jobs=1, pool=None):
+    """Parse the provided DepFiles, loading from the parse cache those that
+    have not changed. If more than one job is requested, the files that
+    need to be parsed are sent to a pool of worker processes, but for the
+    ones whose prescan is kept by their parser in this process, and their
+    relations are added to the DepFiles in the order they were provided,
+    so that the result does not depend on the number of jobs.
+    The pool is started and closed by the call unless one is provided,
+    so that the callers parsing several batches can reuse it"""
+    from .srcfile import create_source_file
+    from .dep_file import DepRelation
+    pending_files = []
+    for dep_file in dep_files:
+        if dep_file.is_parsed:
+            continue
+        if parse_cache is not None and parse_cache.load(dep_file):
+            continue
+        pending_files.append(dep_file)
+    # the files whose prescan is kept by their parser are parsed here
+    pool_files = [dep_file for dep_file in pending_files
+                  if not dep_file.parser.keeps_prescan(dep_file)]
+    results = {}
+    if jobs > 1 and len(pool_files) > 1:
+        own_pool = pool is None
+        if own_pool:
+            pool = _make_pool(min(jobs, len(pool_files)))
+        try:
+            results = dict(zip(pool_files, pool.map(
+                _parse_job,
+                [(dep_file.path, dep_file.library,
+                  getattr(dep_file, "include_dirs", None),
+                  getattr(dep_file, "is_netlist", False))
+                 for dep_file in pool_files],
+                chunksize=max(1, len(pool_files) // (jobs * 4)))))
+        finally:
+            if own_pool:
+                pool.close()
+                pool.join()
+    for dep_file in pending_files:
+        result = results.get(dep_file)
+        deps_before = set(dep_file.depends_on)
+        if result is None:
+            dep_file.parser.parse(dep_file)
+        else:
+            rels, guarded_rels, includes = result
+            for obj_name, direction, rel_type in rels:
+                dep_file.add_relation(
+                    DepRelation(obj_name, direction, rel_type))
+            for obj_name, direction, rel_type, guard in guarded_rels:
+                dep_file.add_relation(
+                    DepRelation(obj_name, direction, rel_type), guard)
+            for path in includes:
+                dep_file.depends_on.add(
+                    create_source_file(path=path, module=dep_file.module))
+            dep_file.is_parsed = True
+        if parse_cache is not None:
+            parse_cache.store(dep_file,
+                              [dep.path for dep in dep_file.depends_on
+                               if dep not in deps_before])
+
+
+def select_defines(dep_files, defines):
+    """Select the relations of the parsed DepFiles that are found in the
+    code compiled when the provided Verilog macros are defined, so that a
+    fileset parsed once can be solved for several define configurations.
+    It returns the list of files whose relations have changed"""
+    defines = frozenset(defines)
+    return [dep_file for dep_file in dep_files
+            if dep_file.select_defines(defines)]
+
+
+class DepIndex(object):
+
+    """Class providing an index of the relations provided and used by the
+    files in a solved fileset, so that a relation can be resolved with a
+    single lookup and the solution can be updated when only a few files
+    change, without scanning the whole fileset again"""
+
+    def __init__(self):
+        # (rel_type, obj_name) -> set of files providing/using it
+        self.providers = {}
+        self.users = {}
+        # file -> (provided keys, used keys) as they were indexed
+        self.file_keys = {}
+        # file -> dependencies added to depends_on by the solver
+        self.solved_deps = {}
+        # file -> set of files whose depends_on contains it
+        self.dependents = {}
+        # file -> number of its scope relations not naming any package
+        self.ignored_scopes = {}
+
+    def add_file(self, dep_file):
+        """Index the relations provided and used by the file"""
+        from .dep_file import DepRelation
+        provided = set()
+        used = set()
+        for rel in dep_file.rels:
+            if rel.direction == DepRelation.PROVIDE:
+                provided.add((rel.rel_type, rel.obj_name))
+            else:
+                used.add(_get_provider_key(rel))
+        self.file_keys[dep_file] = (provided, used)
+        for key in provided:
+            self.providers.setdefault(key, set()).add(dep_file)
+        for key in used:
+            self.users.setdefault(key, set()).add(dep_file)
+
+    def remove_file(self, dep_file):
+        """Remove the file relations from the index, returning the keys
+        that were provided and used by the file"""
+        provided, used = self.file_keys.pop(dep_file)
+        self.ignored_scopes.pop(dep_file, None)
+        for index, keys in [(self.providers, provided), (self.users, used)]:
+            for key in keys:
+                index[key].discard(dep_file)
+                if not index[key]:
+                    del index[key]
+        return provided, used
+
+    def get_providers(self, rel_type, obj_name):
+        """Get the set of files providing the (rel_type, obj_name) pair"""
+        return self.providers.get((rel_type, obj_name), set())
+
+    def set_solved_deps(self, dep_file, solved_deps):
+        """Replace the dependencies the solver added to the file, keeping
+        those that were added by the parser (e.g. Verilog includes)"""
+        old_deps = self.solved_deps.pop(dep_file, set())
+        for dep in old_deps:
+            dep_file.depends_on.discard(dep)
+            self.dependents[dep].discard(dep_file)
+        new_deps = solved_deps - dep_file.depends_on
+        dep_file.depends_on.update(new_deps)
+        self.solved_deps[dep_file] = new_deps
+        for dep in dep_file.depends_on:
+            self.dependents.setdefault(dep, set()).add(dep_file)
 
-def solve(fileset, standard_libs=None):
+
+def _get_provider_key(rel):
+    """Get the (rel_type, obj_name) key of the relations that can satisfy
+    the provided USE relation: scope relations are satisfied by packages"""
+    from .dep_file import DepRelation
+    if rel.rel_type == DepRelation.SCOPE:
+        return (DepRelation.PACKAGE, rel.obj_name)
+    return (rel.rel_type, rel.obj_name)
+
+
+def make_dep_index(fileset):
+    """Build the DepIndex for the files in the fileset"""
+    dep_index = DepIndex()
+    for dep_file in fileset:
+        dep_index.add_file(dep_file)
+    return dep_index
+
+
+def _solve_file(investigated_file, dep_index, standard_libs=None):
+    """Resolve the USE relations of the file through the index and update
+    its dependencies. It returns the number of relations that were not
+    satisfied by any source file"""
+    from .dep_file import DepRelation
+    not_satisfied = 0
+    ignored_scopes = 0
+    solved_deps = set()
+    for rel in investigated_file.rels:
+        # logging.info("- relation: %s" % rel)
+        # logging.info("- direction: %s" % rel.direction)
+        # Only analyze USE relations, we are looking for dependencies
+        if rel.direction == DepRelation.USE:
+            satisfied_by = dep_index.get_providers(*_get_provider_key(rel))
+            if not satisfied_by and rel.rel_type == DepRelation.SCOPE:
+                # a class, a module or an enum, not a package
+                logging.debug("Relation %s in %s does not name any "
+                              "package, it is ignored",
+                              str(rel), investigated_file.name)
+                ignored_scopes += 1
+                continue
+            for dep_file in satisfied_by:
+                if dep_file is not investigated_file:
+                    solved_deps.add(dep_file)
+            if len(satisfied_by) > 1:
+                logging.warning(
+                    "Relation %s satisfied by multpiple (%d) files: %s",
+                    str(rel),
+                    len(satisfied_by),
+                    '\n'.join([file_aux.path for
+                               file_aux in list(satisfied_by)]))
+            elif len(satisfied_by) == 0:
+                # if relation is a USE PACKAGE, check against
+                # the standard libs provided by the tool HDL compiler
+                required_lib = rel.obj_name.split('.')[0]
+                if (not standard_libs is None and
+                    required_lib in standard_libs and
+                    rel.direction is DepRelation.USE and
+                        rel.rel_type is DepRelation.PACKAGE):
+                    logging.debug("Not satisfied relation %s in %s will "
+                                  "be covered by the target compiler "
+                                  "standard libs.",
+                                  str(rel), investigated_file.name)
+                elif getattr(investigated_file, "is_netlist", False):
+                    # the cells of the netlists not provided by the design
+                    # are expected to be found in the vendor libraries
+                    logging.debug("Not satisfied relation %s in netlist %s "
+                                  "will be covered by the vendor libraries.",
+                                  str(rel), investigated_file.name)
+                else:
+                    logging.warning("Relation %s in %s not satisfied by "
+                                    "any source file",
+                                    str(rel), investigated_file.name)
+                    not_satisfied += 1
+    dep_index.set_solved_deps(investigated_file, solved_deps)
+    if ignored_scopes:
+        dep_index.ignored_scopes[investigated_file] = ignored_scopes
+    else:
+        dep_index.ignored_scopes.pop(investigated_file, None)
+    return not_satisfied
+
+
+def solve(fileset, standard_libs=None, parse_cache=None, jobs=1,
+          defines=(), any_defines=False):
     """Function that Parses and Solves the provided HDL fileset. Note
-       that it doesn't return a new fileset, but modifies the original one"""
+       that it doesn't return a new fileset, but modifies the original one.
+       The DepIndex built while solving is returned, so that it can be
+       reused by make_dependency_set and update_solution. If a ParseCache
+       is provided, it is used to avoid parsing the unchanged files, and
+       the files are parsed by the given number of parallel jobs. The
+       relations in `ifdef guarded code are those compiled when the
+       provided Verilog macros are defined. If any_defines is set, the
+       code of every `ifdef branch is parsed with its guard, so that the
+       relations of other macros can then be chosen by select_defines
+       without parsing the files again; otherwise the `ifdefs are
+       evaluated while parsing, which is faster"""
     from .srcfile import SourceFileSet
-    from .dep_file import DepRelation
     assert isinstance(fileset, SourceFileSet)
     fset = fileset.filter(DepFile)
     # print(fileset)
@@ -54,52 +373,24 @@ def solve(fileset, standard_libs=None):
     not_satisfied = 0
     logging.debug("PARSE BEGIN: Here, we will parse all the files in the "
                   "fileset: no parsing should be done beyond this point")
-    for investigated_file in fset:
-        logging.debug("INVESTIGATED FILE: %s", investigated_file)
-        if not investigated_file.is_parsed:
-            logging.debug("Not parsed yet, let's go!")
-            investigated_file.parser.parse(investigated_file)
+    DepParser.start_parse_run(None if any_defines else defines)
+    parse_files(fset, parse_cache, jobs)
+    if any_defines:
+        select_defines(fset, defines)
     logging.debug("PARSE END: now the parsing is done")
     logging.debug("SOLVE BEGIN")
+    dep_index = make_dep_index(fset)
     for investigated_file in fset:
         # logging.info("INVESTIGATED FILE: %s" % investigated_file)
         # print(investigated_file.rels)
-        for rel in investigated_file.rels:
-            # logging.info("- relation: %s" % rel)
-            # logging.info("- direction: %s" % rel.direction)
-            # Only analyze USE relations, we are looking for dependencies
-            if rel.direction == DepRelation.USE:
-                satisfied_by = set()
-                for dep_file in fset:
-                    if dep_file.satisfies(rel):
-                        if dep_file is not investigated_file:
-                            investigated_file.depends_on.add(dep_file)
-                        satisfied_by.add(dep_file)
-                if len(satisfied_by) > 1:
-                    logging.warning(
-                        "Relation %s satisfied by multpiple (%d) files: %s",
-                        str(rel),
-                        len(satisfied_by),
-                        '\n'.join([file_aux.path for
-                                   file_aux in list(satisfied_by)]))
-                elif len(satisfied_by) == 0:
-                    # if relation is a USE PACKAGE, check against
-                    # the standard libs provided by the tool HDL compiler
-                    required_lib = rel.obj_name.split('.')[0]
-                    if (not standard_libs is None and
-                        required_lib in standard_libs and
-                        rel.direction is DepRelation.USE and
-                            rel.rel_type is DepRelation.PACKAGE):
-                        logging.debug("Not satisfied relation %s in %s will "
-                                      "be covered by the target compiler "
-                                      "standard libs.",
-                                      str(rel), investigated_file.name)
-                    else:
-                        logging.warning("Relation %s in %s not satisfied by "
-                                        "any source file",
-                                        str(rel), investigated_file.name)
-                        not_satisfied += 1
+        not_satisfied += _solve_file(investigated_file, dep_index,
+                                     standard_libs)
     logging.debug("SOLVE END")
+    ignored_scopes = sum(dep_index.ignored_scopes.values())
+    if ignored_scopes:
+        logging.info("%d SystemVerilog scope references (name::) not "
+                     "naming any package of the design were ignored",
+                     ignored_scopes)
     if not_satisfied != 0:
         logging.warning(
             "Dependencies solved, but %d relations were not satisfied",
@@ -107,6 +398,455 @@ def solve(fileset, standard_libs=None):
     else:
         logging.info(
             "Dependencies solved, all of the relations were satisfied!")
+    return dep_index
+
+
+def parse_on_demand(fileset, top_level_entities, parse_cache=None, jobs=1,
+                    defines=None):
+    """Parse only those files in the fileset that can be required to build
+    the named top level entities, and return them as a new fileset. The
+    files are prescanned to find the candidate providers of every name,
+    and a candidate is parsed only when a name it may provide is used by
+    an already parsed file, starting from the top level ones. Solving the
+    returned fileset gives the same file set for the top level entities
+    as solving the full one, whatever the Verilog macros defined, as the
+    guarded relations are followed too. The files are parsed for the
+    provided Verilog macros, or for any of them if None, as done by solve
+    with the same macros. If a top level entity is not provided by any of
+    the parsed files, the whole fileset is used to build it, so the
+    fileset is returned unchanged for solve to parse all of its files"""
+    from .srcfile import SourceFileSet
+    from .dep_file import DepRelation
+    assert isinstance(fileset, SourceFileSet)
+    fset = fileset.filter(DepFile)
+    # the parsers may keep the prescan of the files for this run
+    DepParser.start_parse_run(defines)
+    candidates = {}
+    pending_files = []
+    for dep_file in fset:
+        if dep_file.is_parsed:
+            provided = None
+        else:
+            provided = dep_file.parser.prescan(dep_file)
+        if provided is None:
+            # we can't know what the file provides, so it is always parsed
+            pending_files.append(dep_file)
+            continue
+        for key in provided:
+            candidates.setdefault(key, set()).add(dep_file)
+    top_names = [("%s.%s" % ("work", top_level_entity)).lower()
+                 for top_level_entity in top_level_entities]
+    for top_name in top_names:
+        for rel_type in [DepRelation.ENTITY, DepRelation.MODULE]:
+            pending_files.extend(candidates.pop((rel_type, top_name), ()))
+    parsed_files = SourceFileSet()
+    # a single pool of workers parses all of the batches
+    pool = None
+    if jobs > 1:
+        pool = _make_pool(jobs)
+    try:
+        while pending_files:
+            # the files found at every step are parsed together, so that
+            # they can be parsed in parallel
+            batch = []
+            for dep_file in pending_files:
+                if dep_file not in parsed_files:
+                    parsed_files.add(dep_file)
+                    batch.append(dep_file)
+            parse_files(batch, parse_cache, jobs, pool)
+            pending_files = []
+            for dep_file in batch:
+                for rel in itertools.chain(dep_file.rels,
+                                           dep_file.guarded_rels or ()):
+                    if rel.direction == DepRelation.USE:
+                        pending_files.extend(
+                            candidates.pop(_get_provider_key(rel), ()))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    # only the relations found whatever the macros provide the tops for
+    # every configuration
+    provided = set((rel.rel_type, rel.obj_name)
+                   for dep_file in parsed_files for rel in dep_file.rels
+                   if rel.direction == DepRelation.PROVIDE)
+    for top_name in top_names:
+        if not any((rel_type, top_name) in provided
+                   for rel_type in [DepRelation.ENTITY, DepRelation.MODULE]):
+            logging.info("No file parsed on demand provides %s, all of the "
+                         "files are parsed", top_name)
+            return fileset
+    logging.info("Parsed %d files on demand, %d files were skipped",
+                 len(parsed_files), len(fset) - len(parsed_files))
+    return parsed_files
+
+
+def _update_levels(changed_files, dep_index):
+    """Compute again the dependency levels of the provided files and of
+    every file depending on them, directly or indirectly. It returns False
+    if the levels could not be updated this way, i.e. because a circular
+    dependency has been found or some dependency has no level yet"""
+    region = set(changed_files)
+    pending_nodes = list(region)
+    while pending_nodes:
+        for user in dep_index.dependents.get(pending_nodes.pop(), ()):
+            if user not in region:
+                region.add(user)
+                pending_nodes.append(user)
+    pending = {}
+    for node in region:
+        pending[node] = len([dep for dep in node.depends_on
+                             if dep is not node and dep in region])
+    ready = [node for node in region if pending[node] == 0]
+    n_solved = 0
+    while ready:
+        node = ready.pop()
+        n_solved += 1
+        level = 0
+        for dep_file in node.depends_on:
+            if dep_file is node:
+                continue
+            if dep_file.dep_level is None:
+                if dep_file.depends_on:
+                    return False
+                dep_file.dep_level = 0
+            level = max(level, dep_file.dep_level + 1)
+        node.dep_level = level
+        for user in dep_index.dependents.get(node, ()):
+            if user in region and user is not node:
+                pending[user] -= 1
+                if pending[user] == 0:
+                    ready.append(user)
+    return n_solved == len(region)
+
+
+def update_solution(changed_files, dep_index, standard_libs=None):
+    """Update the solution of a fileset previously solved into dep_index
+    after the relations of the changed_files have been modified (e.g. the
+    files have been parsed again). Only the dependencies of the changed
+    files, and those of the files using something they provided before or
+    provide now, are resolved again. If the dependency levels were already
+    computed, they are updated for the files affected by the changes"""
+    affected_files = set()
+    for dep_file in changed_files:
+        if dep_file in dep_index.file_keys:
+            old_provided, _ = dep_index.remove_file(dep_file)
+        else:
+            old_provided = set()
+        dep_index.add_file(dep_file)
+        new_provided, _ = dep_index.file_keys[dep_file]
+        for key in old_provided ^ new_provided:
+            affected_files.update(dep_index.users.get(key, ()))
+        affected_files.add(dep_file)
+    not_satisfied = 0
+    for dep_file in affected_files:
+        not_satisfied += _solve_file(dep_file, dep_index, standard_libs)
+    logging.info("Dependencies updated for %d files, %d relations were not "
+                 "satisfied", len(affected_files), not_satisfied)
+    if any(dep_file.dep_level is not None for dep_file in affected_files):
+        if not _update_levels(affected_files, dep_index):
+            make_dependency_levels(dep_index.file_keys)
+    return affected_files
+
+
+def _get_dependency_closure(fileset):
+    """Get the set of DepFiles in the fileset together with every file
+    they depend on, directly or indirectly, even if it is not in the
+    fileset (e.g. Verilog included files)"""
+    nodes = set(f for f in fileset if isinstance(f, DepFile))
+    pending_nodes = list(nodes)
+    while pending_nodes:
+        for dep_file in pending_nodes.pop().depends_on:
+            if dep_file not in nodes:
+                nodes.add(dep_file)
+                pending_nodes.append(dep_file)
+    return nodes
+
+
+def _get_sorted_deps(dep_file):
+    """Get the files the provided one depends on, sorted by path"""
+    return sorted([dep for dep in dep_file.depends_on if dep is not dep_file],
+                  key=lambda f: f.path)
+
+
+def make_dependency_levels(fileset):
+    """Compute the dependency level of every DepFile in the fileset, and of
+    any file they depend on, by using an iterative Kahn's topological sort.
+    Files with no dependencies get level 0, any other file gets one level
+    more than the highest level among its dependencies. The level is stored
+    in the dep_level property of the file and a dictionary mapping every
+    file to its level is returned.
+    If circular dependencies are found, the files involved are reported and
+    every cycle is broken at the file with the lowest path among those of
+    its strongly connected component that only wait for files of the same
+    component, so that a complete ordering is always produced without
+    breaking any dependency that is not part of a cycle"""
+    nodes = _get_dependency_closure(fileset)
+    component_of = {}
+    for component in make_strong_components(nodes):
+        for member in component:
+            component_of[member] = component
+    # files are released in order of path, ties being broken once
+    rank = dict((node, index) for index, node in
+                enumerate(sorted(nodes, key=lambda f: f.path)))
+    users = dict((node, []) for node in nodes)
+    pending = {}
+    # number of pending dependencies out of the component of the file
+    outside = {}
+    # files of circular components that only wait for their component
+    candidates = []
+    for node in nodes:
+        deps = [dep for dep in node.depends_on if dep is not node]
+        pending[node] = len(deps)
+        outside[node] = len([dep for dep in deps
+                             if component_of[dep] is not component_of[node]])
+        for dep_file in deps:
+            users[dep_file].append(node)
+        if len(component_of[node]) > 1 and outside[node] == 0:
+            heapq.heappush(candidates, (rank[node], node))
+    levels = dict((node, 0) for node in nodes)
+    ready = [node for node in nodes if pending[node] == 0]
+    cyclic_files = []
+    while True:
+        while ready:
+            node = ready.pop()
+            pending[node] = None
+            for user in users[node]:
+                if pending[user] is None:
+                    continue
+                levels[user] = max(levels[user], levels[node] + 1)
+                pending[user] -= 1
+                if pending[user] == 0:
+                    ready.append(user)
+                elif component_of[user] is not component_of[node]:
+                    outside[user] -= 1
+                    if outside[user] == 0:
+                        heapq.heappush(candidates, (rank[user], user))
+        while candidates and pending[candidates[0][1]] is None:
+            heapq.heappop(candidates)
+        if not candidates:
+            break
+        # Every file left is blocked by a circular dependency: release the
+        # first one of a cycle that is not waiting for any other file, so
+        # that the files depending on it can still be sorted
+        node = heapq.heappop(candidates)[1]
+        cyclic_files.append(node)
+        ready.append(node)
+    if cyclic_files:
+        logging.error("Circular dependencies found, the compile order was "
+                      "forced by breaking them at:\n%s",
+                      '\n'.join([file_aux.path for file_aux in cyclic_files]))
+        report_dependency_cycles(nodes)
+    for node, level in six.iteritems(levels):
+        node.dep_level = level
+    return levels
+
+
+def make_strong_components(fileset):
+    """Find the strongly connected components of the dependency graph of
+    the fileset by using an iterative version of Tarjan's algorithm, so
+    that it runs in linear time without being limited by the recursion
+    depth. Every component is a list of files sorted by path, and the
+    components are returned in compile order: no component depends on a
+    component listed after it. Any component with more than one file is
+    a set of circular dependencies"""
+    nodes = _get_dependency_closure(fileset)
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in sorted(nodes, key=lambda f: f.path):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(_get_sorted_deps(root)))]
+        while work:
+            node, deps = work[-1]
+            for dep_file in deps:
+                if dep_file not in index:
+                    index[dep_file] = lowlink[dep_file] = len(index)
+                    stack.append(dep_file)
+                    on_stack.add(dep_file)
+                    work.append((dep_file, iter(_get_sorted_deps(dep_file))))
+                    break
+                elif dep_file in on_stack:
+                    lowlink[node] = min(lowlink[node], index[dep_file])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member is node:
+                            break
+                    component.sort(key=lambda f: f.path)
+                    components.append(component)
+    return components
+
+
+def make_condensation(fileset):
+    """Build the condensation of the dependency graph of the fileset, i.e.
+    the DAG obtained by collapsing every strongly connected component into
+    a single node. It returns a tuple with the list of components, as given
+    by make_strong_components, and a list that holds for every component
+    the set of indexes of the components it depends on"""
+    components = make_strong_components(fileset)
+    component_of = {}
+    for comp_index, component in enumerate(components):
+        for member in component:
+            component_of[member] = comp_index
+    comp_deps = []
+    for comp_index, component in enumerate(components):
+        deps = set()
+        for member in component:
+            for dep_file in member.depends_on:
+                if component_of[dep_file] != comp_index:
+                    deps.add(component_of[dep_file])
+        comp_deps.append(deps)
+    return components, comp_deps
+
+
+def make_transitive_reduction(fileset):
+    """Compute the transitive reduction of the dependency graph of the
+    fileset: a dependency is redundant if the file also depends on it
+    indirectly, through another one of its dependencies, so that it can be
+    removed without changing the compile order. Dependencies between files
+    in the same circular dependency are always kept.
+    A dependency is only implied through files of the fileset, as they are
+    the ones with a stamp target that is rebuilt when any of their own
+    dependencies changes; a file out of the fileset, such as an include,
+    is a source prerequisite and does not carry the changes of the files
+    it depends on.
+    It returns a dictionary that maps every DepFile in the fileset to the
+    set of its dependencies that are not redundant"""
+    components, comp_deps = make_condensation(fileset)
+    component_of = {}
+    for comp_index, component in enumerate(components):
+        for member in component:
+            component_of[member] = comp_index
+    is_stamp = [all(member in fileset for member in component)
+                for component in components]
+    pending_users = [0] * len(components)
+    for deps in comp_deps:
+        for dep_index in deps:
+            pending_users[dep_index] += 1
+    # reach holds for every component a bitmask with the components it
+    # depends on, directly or not, and is released once all of its users
+    # have been reduced. A dependency can only be reached through another
+    # one with a higher index, so they are visited from the highest one.
+    # The reach of a component out of the fileset is only itself
+    reach = [None] * len(components)
+    kept_comp_deps = []
+    for comp_index, deps in enumerate(comp_deps):
+        mask = 0
+        kept_deps = set()
+        for dep_index in sorted(deps, reverse=True):
+            if not (mask >> dep_index) & 1:
+                kept_deps.add(dep_index)
+                mask |= reach[dep_index]
+            pending_users[dep_index] -= 1
+            if pending_users[dep_index] == 0:
+                reach[dep_index] = None
+        if pending_users[comp_index]:
+            if not is_stamp[comp_index]:
+                mask = 0
+            reach[comp_index] = mask | (1 << comp_index)
+        kept_comp_deps.append(kept_deps)
+    reduced_deps = {}
+    n_edges = 0
+    n_kept_edges = 0
+    for dep_file in fileset:
+        if not isinstance(dep_file, DepFile):
+            continue
+        comp_index = component_of[dep_file]
+        kept_deps = set()
+        for dep in dep_file.depends_on:
+            if dep is dep_file:
+                continue
+            n_edges += 1
+            if (component_of[dep] == comp_index or
+                    component_of[dep] in kept_comp_deps[comp_index]):
+                kept_deps.add(dep)
+        n_kept_edges += len(kept_deps)
+        reduced_deps[dep_file] = kept_deps
+    logging.info("Transitive reduction removed %d of %d dependencies",
+                 n_edges - n_kept_edges, n_edges)
+    return reduced_deps
+
+
+def _get_closing_relation(dep_file, dependency):
+    """Get the USE relation of dep_file that is provided by dependency,
+    or None if the dependency comes from a Verilog include"""
+    from .dep_file import DepRelation
+    provided = set((rel.rel_type, rel.obj_name) for rel in dependency.rels
+                   if rel.direction == DepRelation.PROVIDE)
+    for rel in sorted(dep_file.rels, key=str):
+        if (rel.direction == DepRelation.USE and
+                _get_provider_key(rel) in provided):
+            return rel
+    return None
+
+
+def _find_cycle(component):
+    """Find a dependency cycle across the files in a strongly connected
+    component, starting and ending at its first file. It returns the
+    list of (file, dependency) edges forming the cycle"""
+    members = set(component)
+    start = component[0]
+    parent = {start: None}
+    queue = collections.deque([start])
+    while queue:
+        node = queue.popleft()
+        for dep_file in _get_sorted_deps(node):
+            if dep_file not in members:
+                continue
+            if dep_file is start:
+                edges = [(node, start)]
+                while parent[node] is not None:
+                    edges.append((parent[node], node))
+                    node = parent[node]
+                edges.reverse()
+                return edges
+            if dep_file not in parent:
+                parent[dep_file] = node
+                queue.append(dep_file)
+    return []
+
+
+def report_dependency_cycles(fileset):
+    """Report every set of circular dependencies in the fileset. For each
+    one, the files involved are listed together with a cycle across them
+    and the relation closing it. The list of cycles is returned, each one
+    as a list of (file, dependency, relation) tuples, where relation is
+    None for Verilog includes"""
+    cycles = []
+    for component in make_strong_components(fileset):
+        if len(component) < 2:
+            continue
+        cycle = [(dep_file, dependency,
+                  _get_closing_relation(dep_file, dependency))
+                 for dep_file, dependency in _find_cycle(component)]
+        cycles.append(cycle)
+        edges_str = []
+        for dep_file, dependency, rel in cycle:
+            edges_str.append("%s -> %s (%s)" % (
+                dep_file.path, dependency.path,
+                str(rel) if rel is not None else "include"))
+        closing_file, _, closing_rel = cycle[-1]
+        logging.error("Circular dependency among %d files:\n%s\n"
+                      "The cycle is closed by %s in %s",
+                      len(component), '\n'.join(edges_str),
+                      str(closing_rel) if closing_rel is not None
+                      else "an include", closing_file.path)
+    return cycles
 
 
 def make_dependency_sorted_list(fileset, reverse=False):
@@ -115,38 +855,199 @@ def make_dependency_sorted_list(fileset, reverse=False):
     All files that another depends on will be earlier in the list."""
     dependable = [f for f in fileset if isinstance(f, DepFile)]
     non_dependable = [f for f in fileset if not isinstance(f, DepFile)]
-    dependable.sort(key=lambda f: f.file_path.lower())
-    # Not necessary, but will tend to group files more nicely
-    # in the output.
-    dependable.sort(key=DepFile.get_dep_level)
+    levels = make_dependency_levels(dependable)
+    # Sorting by path is not necessary, but will tend to group files
+    # more nicely in the output.
+    dependable.sort(key=lambda f: (levels[f], f.file_path.lower()))
     sorted_list = non_dependable + dependable
     if reverse:
         sorted_list = list(reversed(sorted_list))
     return sorted_list
 
 
-def make_dependency_set(fileset, top_level_entity):
+def make_compile_waves(fileset):
+    """Split the DepFiles in the fileset into compile waves: every wave is
+    a group of files with no dependencies among them, so they can be
+    compiled concurrently once all of the previous waves are compiled.
+    The waves are returned in compile order as a list of dictionaries,
+    each one mapping every library to the list of files of the wave that
+    are compiled into it, sorted by path"""
+    dependable = [f for f in fileset if isinstance(f, DepFile)]
+    levels = make_dependency_levels(dependable)
+    waves = {}
+    for dep_file in dependable:
+        wave = waves.setdefault(levels[dep_file], {})
+        wave.setdefault(getattr(dep_file, "library", "work"),
+                        []).append(dep_file)
+    sorted_waves = []
+    for level in sorted(waves):
+        for files in six.itervalues(waves[level]):
+            files.sort(key=lambda f: f.path)
+        sorted_waves.append(waves[level])
+    return sorted_waves
+
+
+def get_compile_waves_stats(waves):
+    """Get a dictionary with statistics about the parallelism available
+    in the provided compile waves: number of files, depth (number of
+    waves), maximum and average width (files per wave)"""
+    widths = [sum(len(files) for files in six.itervalues(wave))
+              for wave in waves]
+    n_files = sum(widths)
+    return {"files": n_files,
+            "depth": len(widths),
+            "max_width": max(widths) if widths else 0,
+            "average_width": float(n_files) / len(widths) if widths else 0.0}
+
+
+def read_compile_times(history_file):
+    """Read the compile duration of the files from a timing history file.
+    The file is a JSON object mapping every file path to its compile time in
+    seconds, or to a list with the times of several runs, whose average is
+    used. Relative paths are taken from the directory of the history file.
+    A dictionary mapping every absolute path to its compile time is
+    returned"""
+    try:
+        with open(history_file) as history:
+            history_times = json.load(history)
+    except (IOError, ValueError) as error:
+        logging.critical("Cannot read the compile time history %s: %s",
+                         history_file, error)
+        quit()
+    if not isinstance(history_times, dict):
+        logging.critical("The compile time history %s does not contain a "
+                         "JSON object", history_file)
+        quit()
+    base_dir = os.path.dirname(os.path.abspath(history_file))
+    compile_times = {}
+    for path, times in six.iteritems(history_times):
+        if not isinstance(times, list):
+            times = [times]
+        try:
+            times = [float(time_aux) for time_aux in times]
+        except (TypeError, ValueError):
+            logging.warning("Ignoring the invalid compile time of %s", path)
+            continue
+        if not times:
+            continue
+        path = os.path.normpath(os.path.join(base_dir, path))
+        compile_times[path] = sum(times) / len(times)
+    return compile_times
+
+
+def make_critical_path(fileset, compile_times, default_time=None):
+    """Weight the dependency graph of the DepFiles in the fileset with the
+    provided compile times (a dictionary mapping the absolute path of the
+    files to seconds) and find the chain of dependencies that bounds the
+    compile time of the design no matter how many files are compiled in
+    parallel. Files missing from compile_times are weighted with
+    default_time, or with the average of the known times if it is None.
+    Files depended on that are not in the fileset (e.g. Verilog included
+    files) are not compiled on their own, so they have no weight.
+    Returns a tuple with the critical path as a list of files in compile
+    order, its length, the total work in seconds and a dictionary mapping
+    every file to its tail: the length of the longest chain of compile
+    times starting at that file and ending at any file depending on it"""
+    dependable = [f for f in fileset if isinstance(f, DepFile)]
+    levels = make_dependency_levels(dependable)
+    if default_time is None:
+        default_time = (sum(six.itervalues(compile_times)) /
+                        len(compile_times) if compile_times else 1.0)
+    weights = dict((node, 0.0) for node in levels)
+    for dep_file in dependable:
+        weights[dep_file] = compile_times.get(dep_file.path, default_time)
+    # Sorting by level gives a topological order in which the edges closing
+    # a circular dependency (those not going to a lower level) are ignored
+    nodes = sorted(levels, key=lambda f: (levels[f], f.path))
+    users = dict((node, []) for node in nodes)
+    heads = {}
+    head_deps = {}
+    for node in nodes:
+        head_dep = None
+        for dep_file in node.depends_on:
+            if levels[dep_file] < levels[node]:
+                users[dep_file].append(node)
+                if head_dep is None or heads[dep_file] > heads[head_dep]:
+                    head_dep = dep_file
+        heads[node] = weights[node] + (heads[head_dep]
+                                       if head_dep is not None else 0.0)
+        head_deps[node] = head_dep
+    tails = {}
+    for node in reversed(nodes):
+        tails[node] = weights[node] + max(
+            [tails[user] for user in users[node]] or [0.0])
+    dependable_set = set(dependable)
+    critical_path = []
+    critical_length = 0.0
+    if nodes:
+        node = max(nodes, key=lambda f: heads[f])
+        critical_length = heads[node]
+        while node is not None:
+            if node in dependable_set:
+                critical_path.append(node)
+            node = head_deps[node]
+        critical_path.reverse()
+    total_work = sum(weights[dep_file] for dep_file in dependable)
+    return (critical_path, critical_length, total_work,
+            dict((dep_file, tails[dep_file]) for dep_file in dependable))
+
+
+def make_priority_sorted_list(fileset, tails):
+    """Sort the DepFiles in the fileset in a valid compile order that, among
+    the files whose dependencies have already been compiled, always starts
+    first the one with the longest tail (as computed by
+    make_critical_path), so that the critical path is not delayed when
+    the files are handed to parallel compile jobs in this order"""
+    dependable = [f for f in fileset if isinstance(f, DepFile)]
+    levels = make_dependency_levels(dependable)
+    dependable_set = set(dependable)
+    order = dict((dep_file, index)
+                 for index, dep_file in enumerate(dependable))
+    users = dict((dep_file, []) for dep_file in dependable)
+    pending = {}
+    for dep_file in dependable:
+        deps = [dep for dep in dep_file.depends_on
+                if dep in dependable_set and levels[dep] < levels[dep_file]]
+        pending[dep_file] = len(deps)
+        for dep in deps:
+            users[dep].append(dep_file)
+    ready = [(-tails.get(dep_file, 0.0), dep_file.path, order[dep_file],
+              dep_file)
+             for dep_file in dependable if pending[dep_file] == 0]
+    heapq.heapify(ready)
+    sorted_list = []
+    while ready:
+        dep_file = heapq.heappop(ready)[-1]
+        sorted_list.append(dep_file)
+        for user in users[dep_file]:
+            pending[user] -= 1
+            if pending[user] == 0:
+                heapq.heappush(ready, (-tails.get(user, 0.0), user.path,
+                                       order[user], user))
+    return sorted_list
+
+
+def _find_top_file(dep_index, top_level_entity):
+    """Find the file that provides the named top level entity or module,
+    or None if there is no such file in the index"""
+    from hdlmake.dep_file import DepRelation
+    top_name = "%s.%s" % ("work", top_level_entity)
+    for rel_type in [DepRelation.ENTITY, DepRelation.MODULE]:
+        top_files = dep_index.get_providers(rel_type, top_name.lower())
+        if top_files:
+            return min(top_files, key=lambda f: f.path)
+    return None
+
+
+def make_dependency_set(fileset, top_level_entity, dep_index=None):
     """Create the set of all files required to build the named
-     top_level_entity."""
+     top_level_entity. The DepIndex returned by solve can be
+     supplied so that it doesn't need to be rebuilt here."""
     from hdlmake.srcfile import SourceFileSet
-    from hdlmake.dep_file import DepRelation
     assert isinstance(fileset, SourceFileSet)
-    fset = fileset.filter(DepFile)
-    # Find the file that provides the named top level entity
-    top_rel_vhdl = DepRelation(
-        "%s.%s" %
-        ("work", top_level_entity), DepRelation.PROVIDE, DepRelation.ENTITY)
-    top_rel_vlog = DepRelation(
-        "%s.%s" %
-        ("work", top_level_entity), DepRelation.PROVIDE, DepRelation.MODULE)
-    top_file = None
-    for chk_file in fset:
-        for rel in chk_file.rels:
-            if (rel == top_rel_vhdl) or (rel == top_rel_vlog):
-                top_file = chk_file
-                break
-        if top_file:
-            break
+    if dep_index is None:
+        dep_index = make_dep_index(fileset.filter(DepFile))
+    top_file = _find_top_file(dep_index, top_level_entity)
     if top_file is None:
         logging.critical('Could not find a top level file that provides the '
                          'top_module="%s". Continuing with the full file set.',
@@ -169,3 +1070,61 @@ def make_dependency_set(fileset, top_level_entity):
     # for dep_file in dep_file_set:
     #    logging.info("\t" + str(dep_file))
     return dep_file_set
+
+
+def make_dependency_sets(fileset, top_level_entities, dep_index=None):
+    """Create, for every one of the named top_level_entities, the set of
+    all files required to build it, returning a dictionary that maps every
+    top level entity to its set. All of the sets are computed in a single
+    traversal of the condensed dependency graph: every top is given a bit,
+    and the bitmasks are propagated from each file to its dependencies in
+    reverse compile order, so that shared subgraphs are visited once.
+    As in make_dependency_set, the full fileset is used for any top level
+    entity that is not provided by any file."""
+    from hdlmake.srcfile import SourceFileSet
+    assert isinstance(fileset, SourceFileSet)
+    if dep_index is None:
+        dep_index = make_dep_index(fileset.filter(DepFile))
+    top_files = {}
+    for top_level_entity in top_level_entities:
+        top_file = _find_top_file(dep_index, top_level_entity)
+        if top_file is None:
+            logging.critical('Could not find a top level file that provides '
+                             'the top_module="%s". Continuing with the full '
+                             'file set.', top_level_entity)
+            continue
+        top_files[top_level_entity] = top_file
+    # only the subgraph reachable from the top files needs to be condensed
+    components, comp_deps = make_condensation(list(top_files.values()))
+    comp_index = {}
+    for index, component in enumerate(components):
+        for member in component:
+            comp_index[member] = index
+    comp_masks = [0] * len(components)
+    dep_sets = {}
+    top_bits = []
+    for top_level_entity in top_level_entities:
+        if top_level_entity not in top_files:
+            dep_sets[top_level_entity] = fileset
+            continue
+        top_bit = 1 << len(top_bits)
+        top_bits.append(top_level_entity)
+        comp_masks[comp_index[top_files[top_level_entity]]] |= top_bit
+        dep_sets[top_level_entity] = set()
+    # components are in compile order, so walking them backwards visits
+    # every component after all the components that depend on it
+    for index in range(len(components) - 1, -1, -1):
+        mask = comp_masks[index]
+        if not mask:
+            continue
+        for dep_comp in comp_deps[index]:
+            comp_masks[dep_comp] |= mask
+        while mask:
+            lowest_bit = mask & -mask
+            dep_sets[top_bits[lowest_bit.bit_length() - 1]].update(
+                components[index])
+            mask ^= lowest_bit
+    for top_level_entity in top_bits:
+        logging.info("Found %d files as dependancies of %s.",
+                     len(dep_sets[top_level_entity]), top_level_entity)
+    return dep_sets
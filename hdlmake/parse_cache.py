@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""This module provides a persistent cache for the relations found by
+the HDL parsers, so that unchanged files don't need to be parsed again"""
+
+from __future__ import absolute_import
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from .dep_file import DepRelation
+
+
+class ParseCache(object):
+
+    """Class providing an on-disk cache of the parse results of the
+    DepFiles. Every entry is stored in its own file, named after the hash
+    of the parse configuration of the source file: its path, library and
+    the options of its parser (e.g. Verilog include dirs and defines).
+    The entry holds the fingerprint of the source file and of its includes
+    (size, mtime and content hash), so that it is only used if none of
+    them has changed. The content is only hashed again when the size or
+    the mtime of a file differ from the ones of its fingerprint.
+    Entries are written to a temporary file that is then renamed, so that
+    concurrent runs sharing the cache never see a partial entry. Entries
+    that have not been used for max_age days are evicted.
+    The entries are JSON documents, so that loading an entry never runs
+    any code even if the cache directory is shared. By default the cache
+    is kept in the hdlmake directory of the user cache directory
+    ($XDG_CACHE_HOME, ~/.cache or %LOCALAPPDATA% on Windows)"""
+
+    # Increase it whenever the parsers change what they find in a file
+    VERSION = 9
+    EVICTION_STAMP = ".last_eviction"
+    HASH_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, cache_dir=None, max_age=30):
+        if cache_dir is None:
+            cache_dir = self.get_default_dir()
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._writable = True
+
+    @staticmethod
+    def get_default_dir():
+        """Get the directory of the parse cache of the user"""
+        cache_home = os.environ.get("XDG_CACHE_HOME")
+        if not cache_home and os.name == "nt":
+            cache_home = os.environ.get("LOCALAPPDATA")
+        if not cache_home:
+            cache_home = os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(cache_home, "hdlmake", "parse")
+
+    def _get_entry_path(self, dep_file):
+        """Get the path of the entry for the provided file"""
+        key = repr((self.VERSION, sys.version_info[0], dep_file.path,
+                    dep_file.library,
+                    dep_file.parser.get_cache_config(dep_file)))
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest[2:])
+
+    @classmethod
+    def _get_fingerprint(cls, path, old_fingerprint=None):
+        """Get the (size, mtime, content hash) fingerprint of a file, or
+        None if it can't be read. If the size and the mtime of the file
+        are the ones of old_fingerprint it is returned without reading the
+        file, otherwise the file is hashed in chunks"""
+        try:
+            with open(path, "rb") as source_file:
+                file_stat = os.fstat(source_file.fileno())
+                if (old_fingerprint is not None and
+                        old_fingerprint[0] == file_stat.st_size and
+                        old_fingerprint[1] == file_stat.st_mtime):
+                    return old_fingerprint
+                content_hash = hashlib.sha1()
+                while True:
+                    chunk = source_file.read(cls.HASH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    content_hash.update(chunk)
+        except (IOError, OSError):
+            return None
+        return (file_stat.st_size, file_stat.st_mtime,
+                content_hash.hexdigest())
+
+    @staticmethod
+    def _same_content(fingerprint, old_fingerprint):
+        """Check if two fingerprints belong to the same content, a touched
+        file with the same size and hash is not considered as changed"""
+        return (fingerprint is not None and old_fingerprint is not None and
+                fingerprint[0] == old_fingerprint[0] and
+                fingerprint[2] == old_fingerprint[2])
+
+    def load(self, dep_file):
+        """Fill the relations and the includes of the provided file from
+        the cache. It returns True and marks the file as parsed if a valid
+        entry is found, otherwise the file is left untouched"""
+        from .srcfile import create_source_file
+        entry_path = self._get_entry_path(dep_file)
+        try:
+            with open(entry_path, "r") as entry_file:
+                entry = json.load(entry_file)
+            fingerprints = [(path, tuple(fingerprint))
+                            for path, fingerprint in entry["fingerprints"]]
+            rels = entry["rels"]
+            guarded_rels = [(obj_name, direction, rel_type,
+                             _load_guard(guard))
+                            for obj_name, direction, rel_type, guard
+                            in entry["guarded_rels"]]
+            includes = entry["includes"]
+        except Exception:  # missing or corrupted entries are just misses
+            self.misses += 1
+            return False
+        for path, old_fingerprint in fingerprints:
+            if not self._same_content(
+                    self._get_fingerprint(path, old_fingerprint),
+                    old_fingerprint):
+                self.misses += 1
+                return False
+        for obj_name, direction, rel_type in rels:
+            dep_file.add_relation(DepRelation(obj_name, direction, rel_type))
+        for obj_name, direction, rel_type, guard in guarded_rels:
+            dep_file.add_relation(DepRelation(obj_name, direction, rel_type),
+                                  guard)
+        for path in includes:
+            dep_file.depends_on.add(
+                create_source_file(path=path, module=dep_file.module))
+        dep_file.is_parsed = True
+        self.hits += 1
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+        return True
+
+    def store(self, dep_file, includes):
+        """Store the relations of the provided, already parsed, file in the
+        cache together with the paths of the files it includes"""
+        if not self._writable:
+            return
+        fingerprints = []
+        for path in [dep_file.path] + sorted(includes):
+            fingerprint = self._get_fingerprint(path)
+            if fingerprint is None:
+                return
+            fingerprints.append((path, fingerprint))
+        guarded_rels = dep_file.guarded_rels or {}
+        entry = {"fingerprints": fingerprints,
+                 "rels": sorted([(rel.obj_name, rel.direction, rel.rel_type)
+                                 for rel in dep_file.rels
+                                 if rel not in guarded_rels]),
+                 "guarded_rels": sorted([(rel.obj_name, rel.direction,
+                                          rel.rel_type, _dump_guard(guard))
+                                         for rel, guard in
+                                         guarded_rels.items()]),
+                 "includes": sorted(includes)}
+        entry_path = self._get_entry_path(dep_file)
+        entry_dir = os.path.dirname(entry_path)
+        try:
+            if not os.path.isdir(entry_dir):
+                try:
+                    os.makedirs(entry_dir)
+                except OSError:
+                    # another run may have created it in the meantime
+                    if not os.path.isdir(entry_dir):
+                        raise
+            temp_fd, temp_path = tempfile.mkstemp(dir=entry_dir)
+            with os.fdopen(temp_fd, "w") as temp_file:
+                json.dump(entry, temp_file)
+            _replace_file(temp_path, entry_path)
+        except (IOError, OSError) as error:
+            logging.warning("Can't write the parse cache at %s, it will "
+                            "not be updated: %s", self.cache_dir, error)
+            self._writable = False
+
+    def evict_stale(self):
+        """Remove the entries that have not been used for max_age days.
+        The cache is only scanned once a day, as told by a stamp file"""
+        stamp_path = os.path.join(self.cache_dir, self.EVICTION_STAMP)
+        now = time.time()
+        try:
+            if now - os.path.getmtime(stamp_path) < 24 * 3600:
+                return
+        except OSError:
+            if not os.path.isdir(self.cache_dir):
+                return
+        try:
+            open(stamp_path, "w").close()
+        except (IOError, OSError):
+            return
+        evicted = 0
+        limit = now - self.max_age * 24 * 3600
+        for shard in os.listdir(self.cache_dir):
+            shard_dir = os.path.join(self.cache_dir, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for entry_name in os.listdir(shard_dir):
+                entry_path = os.path.join(shard_dir, entry_name)
+                try:
+                    if os.path.getmtime(entry_path) < limit:
+                        os.remove(entry_path)
+                        evicted += 1
+                except OSError:
+                    # already evicted by a concurrent run
+                    pass
+        logging.debug("%d stale entries evicted from the parse cache",
+                      evicted)
+
+    def log_stats(self):
+        """Log the number of files found and not found in the cache"""
+        logging.info("Parse cache %s: %d files loaded, %d files parsed",
+                     self.cache_dir, self.hits, self.misses)
+
+
+def _dump_guard(guard):
+    """Get the provided guard as sorted lists, that can be written in JSON"""
+    return sorted(sorted([name, defined] for name, defined in term)
+                  for term in guard)
+
+
+def _load_guard(guard):
+    """Get the guard written by _dump_guard back as frozensets"""
+    return frozenset(frozenset((name, defined) for name, defined in term)
+                     for term in guard)
+
+
+def _replace_file(source, destination):
+    """Atomically rename source as destination, overwriting it"""
+    if hasattr(os, "replace"):
+        os.replace(source, destination)
+    elif os.name == "nt":
+        try:
+            os.remove(destination)
+        except OSError:
+            pass
+        os.rename(source, destination)
+    else:
+        os.rename(source, destination)
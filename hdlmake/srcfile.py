@@ -31,6 +31,7 @@ import logging
 from .util import path as path_mod
 from .dep_file import DepFile, File
 import six
+from six.moves import intern
 
 
 class SourceFile(DepFile):
@@ -38,13 +39,16 @@ class SourceFile(DepFile):
     """This is a class acting as a base for the different
     HDL sources files, i.e. those that can be parsed"""
 
+    __slots__ = ('library', 'is_netlist')
+
     cur_index = 0
 
     def __init__(self, path, module, library):
         assert isinstance(path, six.string_types)
-        self.library = library
         if not library:
-            self.library = "work"
+            library = "work"
+        self.library = intern(library)
+        self.is_netlist = False
         DepFile.__init__(self,
                          file_path=path,
                          module=module)
@@ -59,10 +63,20 @@ class VHDLFile(SourceFile):
 
     """This is the class providing the generic VHDL file"""
 
-    def __init__(self, path, module, library=None):
+    __slots__ = ()
+
+    def __init__(self, path, module, library=None, netlist=False):
         SourceFile.__init__(self, path=path, module=module, library=library)
+        self.is_netlist = netlist
+
+    @property
+    def parser(self):
+        """The VHDL parser shared by all of the VHDL files"""
+        if self.is_netlist:
+            from hdlmake.netlist_parser import VHDLNetlistParser
+            return VHDLNetlistParser.get_shared()
         from hdlmake.vhdl_parser import VHDLParser
-        self.parser = VHDLParser(self)
+        return VHDLParser.get_shared()
 
     def _check_encryption(self):
         """Check if the VHDL is encrypted (in Xilinx toolchain)"""
@@ -79,22 +93,34 @@ class VerilogFile(SourceFile):
 
     """This is the class providing the generic Verilog file"""
 
+    __slots__ = ('include_dirs',)
+
+    # include dirs tuple -> the same tuple, shared by the files using it
+    _shared_include_dirs = {}
+
     def __init__(self, path, module, library=None,
-                 include_dirs=None):
+                 include_dirs=None, netlist=False):
         SourceFile.__init__(self, path=path, module=module, library=library)
+        self.is_netlist = netlist
+        include_dirs = list(include_dirs or [])
+        include_dirs.append(path_mod.relpath(self.dirname))
+        include_dirs = tuple([intern(dir_aux) for dir_aux in include_dirs])
+        self.include_dirs = self._shared_include_dirs.setdefault(
+            include_dirs, include_dirs)
+
+    @property
+    def parser(self):
+        """The Verilog parser shared by all of the Verilog files"""
+        if self.is_netlist:
+            from hdlmake.netlist_parser import VerilogNetlistParser
+            return VerilogNetlistParser.get_shared()
         from hdlmake.vlog_parser import VerilogParser
-        self.include_dirs = []
-        if include_dirs:
-            self.include_dirs.extend(include_dirs)
-        self.include_dirs.append(path_mod.relpath(self.dirname))
-        self.parser = VerilogParser(self)
-        for dir_aux in self.include_paths:
-            self.parser.add_search_path(dir_aux)
+        return VerilogParser.get_shared()
 
 
 class SVFile(VerilogFile):
     """This is the class providing the generic SystemVerilog file"""
-    pass
+    __slots__ = ()
 
 
 # TCL COMMAND FILE
@@ -325,15 +351,25 @@ class SourceFileSet(set):
 
     """Class providing a extension of the 'set' object that includes
     methods that allow for an easier management of a collection of HDL
-    source files"""
+    source files. The files are iterated in the order they were added,
+    so a dependency sorted fileset keeps its compile order"""
 
     def __init__(self):
         super(SourceFileSet, self).__init__()
-        self = []
+        self._order = []
 
     def __str__(self):
         return str([str(f) for f in self])
 
+    def __iter__(self):
+        return iter(self._order)
+
+    def _add_file(self, file_aux):
+        """Add a single file to the fileset if it is not already there"""
+        if file_aux not in self:
+            super(SourceFileSet, self).add(file_aux)
+            self._order.append(file_aux)
+
     def add(self, files):
         """Add a set of files to the source fileset instance"""
         if isinstance(files, str):
@@ -343,9 +379,9 @@ class SourceFileSet(set):
         else:
             try:
                 for file_aux in files:
-                    super(SourceFileSet, self).add(file_aux)
+                    self._add_file(file_aux)
             except TypeError:  # single file, not a list
-                super(SourceFileSet, self).add(files)
+                self._add_file(files)
 
     def filter(self, filetype):
         """Method that filters and returns all of the HDL source files
@@ -378,28 +414,121 @@ class SourceFileSet(set):
         return ret
 
 
+# Extensions of the netlists written by the HDL tools, that are only scanned
+# for their declarations
+NETLIST_EXTENSIONS = ['vho', 'vo', 'vm']
+
+
+class SourceFileRegistry(object):
+
+    """Class providing the registry of the files of a module pool. A file
+    is identified by its device and inode, or by its real path when it
+    can't be stat'ed, so that the paths going through symbolic links or
+    hard links to an already known file get its File instance. These
+    merged paths are kept to be reported. The files listed in the
+    manifests are registered for their library, while the included files
+    have none and get the first File registered for the same file, so
+    that a header listed in the manifest of any library is not created
+    again when it is included"""
+
+    def __init__(self):
+        # (file identity, library) -> File instance
+        self._files = {}
+        # file identity -> first File instance registered for it
+        self._first_files = {}
+        # File instance -> other paths it has been reached through
+        self.merged_paths = {}
+
+    @staticmethod
+    def _get_identity(path):
+        """Get the identity of the file, whatever the path to it"""
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return os.path.realpath(path)
+        return (file_stat.st_dev, file_stat.st_ino)
+
+    def get(self, path, library):
+        """Get the File already registered for the path and library, or
+        for the path only if the library is None, or None if the file is
+        not known"""
+        identity = self._get_identity(path)
+        if library is None:
+            file_aux = self._first_files.get(identity)
+        else:
+            file_aux = self._files.get((identity, library))
+        if file_aux is not None and file_aux.path != path:
+            logging.debug("%s is the same file as %s", path, file_aux.path)
+            self.merged_paths.setdefault(file_aux, set()).add(path)
+        return file_aux
+
+    def add(self, file_aux, library):
+        """Register the new File for its library, if it has one"""
+        identity = self._get_identity(file_aux.path)
+        if library is not None:
+            self._files[(identity, library)] = file_aux
+        self._first_files.setdefault(identity, file_aux)
+
+    def log_merged_paths(self):
+        """Report the files that have been reached through several paths
+        and that have been merged into a single File"""
+        if not self.merged_paths:
+            return
+        logging.info("%d files were found under several paths, each one "
+                     "is parsed and compiled once", len(self.merged_paths))
+        for file_aux in sorted(self.merged_paths,
+                               key=lambda file_aux: file_aux.path):
+            logging.info("%s also found as: %s", file_aux.path,
+                         ", ".join(sorted(self.merged_paths[file_aux])))
+
+
 def create_source_file(path, module, library=None,
-                       include_dirs=None):
+                       include_dirs=None, netlist=None):
     """Function that analyzes the given arguments and returns a new HDL source
-    file of the appropriated type"""
+    file of the appropriated type. HDL files are parsed as netlists if
+    netlist is True or, when it is None, if they have a netlist extension.
+    If the module belongs to a pool, the file is interned in the pool
+    registry: the File already created for the same file and library is
+    returned, so that every file of the design is a single instance
+    whether it is listed in the manifests or included, and whatever the
+    path it is reached through"""
     if path is None or path == "":
         raise RuntimeError("Expected a file path, got: " + str(path))
     if not os.path.isabs(path):
         path = os.path.abspath(path)
+    registry = getattr(getattr(module, "pool", None), "file_registry", None)
+    if registry is not None:
+        known_file = registry.get(path, library)
+        if known_file is not None:
+            return known_file
+    new_file = _create_source_file(path, module, library, include_dirs,
+                                   netlist)
+    if registry is not None and new_file is not None:
+        registry.add(new_file, library)
+    return new_file
+
+
+def _create_source_file(path, module, library, include_dirs, netlist):
+    """Create the new file of the type matching the path extension"""
     tmp = path.rsplit('.')
     extension = tmp[len(tmp) - 1]
     logging.debug("add file " + path)
 
+    if netlist is None:
+        netlist = extension in NETLIST_EXTENSIONS
+
     new_file = None
     if extension in ['vhd', 'vhdl', 'vho']:
         new_file = VHDLFile(path=path,
                             module=module,
-                            library=library)
+                            library=library,
+                            netlist=netlist)
     elif extension in ['v', 'vh', 'vo', 'vm']:
         new_file = VerilogFile(path=path,
                                module=module,
                                library=library,
-                               include_dirs=include_dirs)
+                               include_dirs=include_dirs,
+                               netlist=netlist)
     elif extension == 'sv' or extension == 'svh':
         new_file = SVFile(path=path,
                           module=module,
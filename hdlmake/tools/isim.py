@@ -101,6 +101,10 @@ XILINX_INI_PATH := """ + __get_xilinxsim_ini_dir() +
                      """
 """)
 
+    def get_define_options(self, defines):
+        """The macros are defined by the vlogcomp options"""
+        return {"vlog_opt": " ".join(["-d " + name for name in defines])}
+
     def _makefile_sim_options(self):
         """Print the Xilinx ISim simulation options in the Makefile"""
         def __get_rid_of_isim_incdirs(vlog_opt):
@@ -195,7 +199,9 @@ fuse:
                 ': ')
             self.write(vl_file.rel_path() + ' ')
             self.writeln(
-                ' '.join([fname.rel_path() for fname in vl_file.depends_on]))
+                ' '.join([fname.rel_path()
+                          for fname in self.get_file_deps(vl_file,
+                                                          reduced=False)]))
             self.write("\t\tvlogcomp -work " + vl_file.library
                        + "=." + shell.slash_char() + vl_file.library)
             self.write(" $(VLOGCOMP_FLAGS) ")
@@ -249,7 +255,7 @@ fuse:
             # recompile only what is needed (out of date)
             # if len(vhdl_file.depends_on) != 0:
             self.write(os.path.join(lib, purename, "." + purename) + ":")
-            for dep_file in vhdl_file.depends_on:
+            for dep_file in self.get_file_deps(vhdl_file):
                 if dep_file in fileset:
                     name = dep_file.purename
                     self.write(
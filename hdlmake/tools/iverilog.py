@@ -76,6 +76,10 @@ class ToolIVerilog(ToolSim):
         self.writeln('\n')
         self._makefile_sim_dep_files()
 
+    def get_define_options(self, defines):
+        """The macros are defined by the iverilog options"""
+        return {"iverilog_opt": " ".join(["-D" + name for name in defines])}
+
     def _makefile_sim_options(self):
         """Print the IVerilog options to the Makefile"""
         iverilog_opt = self.manifest_dict.get("iverilog_opt", '')
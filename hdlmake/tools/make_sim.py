@@ -121,8 +121,7 @@ PWD := $$(shell pwd)
                     ".%s_%s" % (file_aux.purename, file_aux.extension())),
                     file_aux.rel_path()))
                 # list dependencies, do not include the target file
-                for dep_file in [dfile for dfile in file_aux.depends_on
-                                 if dfile is not file_aux]:
+                for dep_file in self.get_file_deps(file_aux):
                     if dep_file in fileset:
                         name = dep_file.purename
                         extension = dep_file.extension()
@@ -29,6 +29,8 @@ import logging
 import six
 
 from hdlmake.util import shell
+from hdlmake import new_dep_solver as dep_solver
+from hdlmake.srcfile import SourceFileSet
 
 
 class ToolMakefile(object):
@@ -46,12 +48,20 @@ class ToolMakefile(object):
         self._supported_files = {}
         self._standard_libs = []
         self.fileset = None
+        self.reduce_deps = False
+        self._reduced_deps = None
         self.manifest_dict = {}
         self._filename = "Makefile"
 
     def __del__(self):
+        self.makefile_close()
+
+    def makefile_close(self):
+        """Close the Makefile, so that all of its contents are written
+        without depending on when the tool instance is collected"""
         if self._file:
             self._file.close()
+            self._file = None
 
     def get_standard_libs(self):
         """Get the standard libs supported by the tool"""
@@ -66,12 +76,37 @@ class ToolMakefile(object):
         return self._supported_files
 
     def makefile_setup(self, manifest_project_dict, fileset, filename=None):
-        """Set the Makefile configuration"""
+        """Set the Makefile configuration, the fileset is stored sorted
+        in compile order"""
         self.manifest_dict = manifest_project_dict
-        self.fileset = fileset
+        self.fileset = SourceFileSet()
+        self.fileset.add(dep_solver.make_dependency_sorted_list(fileset))
+        if self.reduce_deps:
+            self._reduced_deps = dep_solver.make_transitive_reduction(
+                self.fileset)
         if filename:
             self._filename = filename
 
+    def get_file_deps(self, file_aux, reduced=True):
+        """Get the files the provided one depends on, excluding itself and,
+        if reduce_deps is set, the dependencies implied by other ones.
+        Rules that list the dependencies as source files instead of as
+        their stamp targets must not be reduced, so they set reduced to
+        False"""
+        if (reduced and self._reduced_deps is not None and
+                file_aux in self._reduced_deps):
+            reduced_deps = self._reduced_deps[file_aux]
+            return [dep_file for dep_file in file_aux.depends_on
+                    if dep_file in reduced_deps]
+        return [dep_file for dep_file in file_aux.depends_on
+                if dep_file is not file_aux]
+
+    def get_define_options(self, defines):
+        """Get a dictionary with the manifest options, and their values,
+        that define the provided Verilog macros to the compilers run by
+        the Makefile, or None if the tool can't be given them this way"""
+        return None
+
     def _get_name_bin(self):
         """Get the name and binary values"""
         if shell.check_windows():
@@ -56,6 +56,11 @@ class VsimMakefileWriter(ToolSim):
         self.copy_rules = {}
         self._hdl_files.update(VsimMakefileWriter.HDL_FILES)
 
+    def get_define_options(self, defines):
+        """The macros are defined by the vlog options"""
+        return {"vlog_opt": " ".join(["+define+" + name
+                                      for name in defines])}
+
     def _makefile_sim_options(self):
         """Print the vsim options to the Makefile"""
         def __get_rid_of_vsim_incdirs(vlog_opt=""):
@@ -132,8 +137,7 @@ class VsimMakefileWriter(ToolSim):
                 ".%s_%s" % (vlog.purename, vlog.extension())),
                 vlog.rel_path()))
             # list dependencies, do not include the target file
-            for dep_file in [dfile for dfile
-                             in vlog.depends_on if dfile is not vlog]:
+            for dep_file in self.get_file_deps(vlog):
                 if dep_file in fileset:
                     name = dep_file.purename
                     extension = dep_file.extension()
@@ -161,8 +165,7 @@ class VsimMakefileWriter(ToolSim):
                 lib, purename, "." + purename + "_" + vhdl.extension()),
                 vhdl.rel_path()))
             # list dependencies, do not include the target file
-            for dep_file in [dfile for dfile in vhdl.depends_on
-                             if dfile is not vhdl]:
+            for dep_file in self.get_file_deps(vhdl):
                 if dep_file in fileset:
                     name = dep_file.purename
                     extension = dep_file.extension()
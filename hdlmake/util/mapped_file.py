@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""This module provides read-only, memory mapped access to the source files,
+so that very large files can be scanned without reading them in memory"""
+
+from __future__ import absolute_import
+import mmap
+import os
+
+
+class MappedFile(object):
+
+    """Context manager that maps the contents of a file in memory as a
+    read-only bytes-like object, that can be scanned by bytes regexes
+    without decoding it. The pages of the file are loaded by the OS as
+    they are scanned, and release() can be used to drop those that are no
+    longer needed, so that the memory used does not grow with the size of
+    the file"""
+
+    # Size of the scanned data that is kept before releasing it
+    RELEASE_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.buf = None
+        self._file = None
+        self._released = 0
+
+    def __enter__(self):
+        self._file = open(self.path, "rb")
+        if os.fstat(self._file.fileno()).st_size == 0:
+            # empty files can't be mapped
+            self.buf = b""
+        else:
+            self.buf = mmap.mmap(self._file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self._file.close()
+        self.buf = None
+        return False
+
+    def release(self, position):
+        """Tell the OS that the contents of the file before the provided
+        position are not going to be scanned again, so that its pages can
+        be dropped from memory. It is only done once enough data has been
+        scanned, and only where mmap supports it"""
+        if (position - self._released < self.RELEASE_SIZE or
+                not hasattr(self.buf, "madvise") or
+                not hasattr(mmap, "MADV_DONTNEED")):
+            return
+        end = position - position % mmap.PAGESIZE
+        self.buf.madvise(mmap.MADV_DONTNEED, 0, end)
+        self._released = end
+
+
+def decode(name):
+    """Decode a name found by a bytes regex into a string"""
+    if isinstance(name, str):
+        return name
+    return name.decode("utf-8", "replace")
@@ -28,232 +28,303 @@ import logging
 import re
 
 from .new_dep_solver import DepParser
+from .util.mapped_file import MappedFile, decode
 
 
 class VHDLParser(DepParser):
 
     """Class providing the container for VHDL parser instances"""
 
-    def __init__(self, dep_file):
-        DepParser.__init__(self, dep_file)
-        # self.preprocessor = VHDLPreprocessor()
+    # The declarations start a statement, as the parser finds them: at the
+    # beginning of a line or after a semicolon
+    prescan_pattern = re.compile(
+        br"(?:^|;)\s*(entity|package|architecture)\s+(?:\w+\s+of\s+)?"
+        br"(\w+)\s+is\b", re.MULTILINE | re.IGNORECASE)
 
-    def parse(self, dep_file):
-        """Parse the provided VHDL file and add the detected relations to it"""
+    def prescan(self, dep_file):
+        """Scan the VHDL file for the names of the entities, architectures
+        and packages it may provide, without parsing it"""
         from .dep_file import DepRelation
+        rel_types = {"entity": DepRelation.ENTITY,
+                     "package": DepRelation.PACKAGE,
+                     "architecture": DepRelation.ARCHITECTURE}
+        provided = set()
+        with MappedFile(dep_file.file_path) as mapped_file:
+            for match in self.prescan_pattern.finditer(mapped_file.buf):
+                provided.add((rel_types[decode(match.group(1)).lower()],
+                              ("%s.%s" % (dep_file.library,
+                                          decode(match.group(2)))).lower()))
+        return provided
+
+    # The constructs are looked for at the start of a statement, i.e. at
+    # the beginning of a line or after a semicolon. Port, generic and
+    # parameter lists and records are matched too, so that their contents
+    # can be skipped: the declarations in them look like instances.
+    # The (?=(?P<x>...))(?P=x) construct matches like an atomic group, so
+    # that the regex engine does not backtrack over the whitespace or the
+    # labels of the lines that can't match
+    _statements = (
+        br"(?=(?P<ws>\s*))(?P=ws)(?:"
+        br"library\s+(?P<library>\w+)"
+        br"|(?P<use>use\s+(?P<use_lib>\w+)\s*\.\s*(?P<use_name>\w+)"
+        br"(?:\s*\.\s*(?P<use_item>\w+))?)"
+        br"|entity\s+(?P<entity>\w+)\s+is\b"
+        br"|architecture\s+\w+\s+of\s+(?P<arch_entity>\w+)\s+is\b"
+        br"|configuration\s+\w+\s+of\s+(?P<config_entity>\w+)\s+is\b"
+        br"|package\s+(?P<package>\w+)\s+is\b"
+        br"|(?P<package_body>package\s+body\s+\w+\s+is\b)"
+        br"|(?P<component>component\s+\w+(?:\s+is\b)?)"
+        br"|(?P<paren_list>(?:port|generic|(?:(?:pure|impure)\s+)?"
+        br"(?:function|procedure)\s+(?:\w+|\"[^\"\n]*\"))\s*\()"
+        br"|(?P<record>type\s+\w+\s+is\s+record\b)"
+        br"|(?P<binding>for\s+(?P<bind_labels>\w+(?:\s*,\s*\w+)*)\s*:\s*"
+        br"(?P<bind_comp>\w+)\s+use\s+entity\s+(?P<bind_lib>\w+)\s*\.\s*"
+        br"(?P<bind_entity>\w+))"
+        br"|(?=(?P<label>\w+))(?P=label)\s*:\s*(?:"
+        br"entity\s+(?P<inst_lib>\w+)\s*\.\s*(?P<inst_entity>\w+)"
+        br"(?=\s*(?:port\s+map|generic\s+map|;|\())"
+        br"|(?:component\s+)?"
+        br"(?P<inst_name>\w+)(?=\s*(?:port\s+map|generic\s+map|;))))")
+    # Every match starts with one of a few characters, so that the regex
+    # engine can quickly skip the text in between. Comments, strings and
+    # character literals are matched to skip them
+    scanner_pattern = re.compile(
+        br"[;\n\"/'-](?:(?<=[;\n])" + _statements +
+        br"|(?<=-)-[^\n]*|(?<=/)\*.*?\*/|(?<=\")[^\"\n]*\""
+        br"|(?<=')(?<![\w)]')[^\n]')",
+        re.DOTALL | re.IGNORECASE)
+    first_statement_pattern = re.compile(_statements,
+                                         re.DOTALL | re.IGNORECASE)
+    label_list_pattern = re.compile(br"\s*,\s*")
+    header_list_pattern = re.compile(br"\s*(?:port|generic)\s*\(",
+                                     re.IGNORECASE)
+    paren_pattern = re.compile(
+        br"--[^\n]*|/\*.*?\*/|\"[^\"\n]*\"|'(?<![\w)]')[^\n]'"
+        br"|(?P<paren>[()])",
+        re.DOTALL)
+    end_record_pattern = re.compile(
+        br"--[^\n]*|/\*.*?\*/|\"[^\"\n]*\"|(?P<end>\bend\s+record\b)",
+        re.DOTALL | re.IGNORECASE)
+
+    def parse(self, dep_file):
+        """Parse the provided VHDL file and add the detected relations to it.
+        The file is scanned in a single pass, in linear time"""
         if dep_file.is_parsed:
             return
         logging.debug("Parsing %s", dep_file.path)
+        with MappedFile(dep_file.file_path) as mapped_file:
+            self._scan(dep_file, mapped_file)
+        dep_file.is_parsed = True
 
-        def _preprocess(vhdl_file):
-            """Preprocess the supplied VHDL file instance"""
-            def _preprocess_file(file_content, file_name, library):
-                """Preprocess the suplied string using the arguments"""
-                def _remove_comments_and_strings(text):
-                    """Remove the comments and strings from the VHDL code"""
-                    pattern = re.compile('--.*?$|".?"',
-                                         re.DOTALL | re.MULTILINE)
-                    return re.sub(pattern, "", text)
-                logging.debug(
-                    "preprocess file %s (of length %d) in library %s",
-                    file_name, len(file_content), library)
-                return _remove_comments_and_strings(file_content)
-            file_path = vhdl_file.file_path
-            buf = open(file_path, "r").read()
-            return _preprocess_file(file_content=buf,
-                                    file_name=file_path,
-                                    library=vhdl_file.library)
-        buf = _preprocess(dep_file)
-        # use packages
-        use_pattern = re.compile(
-            r"^\s*use\s+(\w+)\s*\.\s*(\w+)",
-            re.DOTALL | re.MULTILINE | re.IGNORECASE)
-
-        def do_use(text):
-            """Function to be applied by re.sub to every match of the
-            use_pattern in the VHDL code -- group() returns positive matches
-            as indexed plain strings. It adds the found USE relations to the
-            file"""
-            if text.group(1).lower() == "work":
-                logging.debug("use package %s.%s",
-                              dep_file.library, text.group(2))
-                dep_file.add_relation(
-                    DepRelation("%s.%s" % (dep_file.library, text.group(2)),
-                                DepRelation.USE,
-                                DepRelation.PACKAGE))
-            else:
-                logging.debug("use package %s.%s",
-                              text.group(1), text.group(2))
-                dep_file.add_relation(
-                    DepRelation("%s.%s" % (text.group(1), text.group(2)),
-                                DepRelation.USE,
-                                DepRelation.PACKAGE))
-            return "<hdlmake use_pattern %s.%s>" % (text.group(1),
-                                                    text.group(2))
-        buf = re.sub(use_pattern, do_use, buf)
-        # new entity
-        entity_pattern = re.compile(
-            r"^\s*entity\s+(?P<name>\w+)\s+is\s+(?:port|generic|end)"
-            r".*?(?P=name)\s*;",
-            re.DOTALL | re.MULTILINE | re.IGNORECASE)
-
-        def do_entity(text):
-            """Function to be applied by re.sub to every match of the
-            entity_pattern in the VHDL code -- group() returns positive matches
-            as indexed plain strings. It adds the found PROVIDE relations
-            to the file"""
-            logging.debug("found entity %s.%s",
-                          dep_file.library, text.group(1))
-            dep_file.add_relation(
-                DepRelation("%s.%s" % (dep_file.library, text.group(1)),
-                            DepRelation.PROVIDE,
-                            DepRelation.ENTITY))
-            return "<hdlmake entity_pattern %s.%s>" % (dep_file.library,
-                                                       text.group(1))
-        buf = re.sub(entity_pattern, do_entity, buf)
-        # new architecture
-        architecture_pattern = re.compile(
-            r"^\s*architecture\s+(\w+)\s+of\s+(\w+)\s+is",
-            re.DOTALL | re.MULTILINE | re.IGNORECASE)
-
-        def do_architecture(text):
-            """Function to be applied by re.sub to every match of the
-            architecture_pattern in the VHDL code -- group() returns positive
-            matches as indexed plain strings. It adds the found PROVIDE
-            relations to the file"""
-            logging.debug("found architecture %s of entity %s.%s",
-                          text.group(1), dep_file.library, text.group(2))
-            dep_file.add_relation(
-                DepRelation("%s.%s" % (dep_file.library, text.group(2)),
-                            DepRelation.PROVIDE,
-                            DepRelation.ARCHITECTURE))
-            dep_file.add_relation(
-                DepRelation("%s.%s" % (dep_file.library, text.group(2)),
-                            DepRelation.USE,
-                            DepRelation.ENTITY))
-            return "<hdlmake architecture %s.%s>" % (dep_file.library,
-                                                     text.group(2))
-        buf = re.sub(architecture_pattern, do_architecture, buf)
-        # new package
-        package_pattern = re.compile(
-            r"^\s*package\s+(\w+)\s+is",
-            re.DOTALL | re.MULTILINE | re.IGNORECASE)
+    def _scan(self, dep_file, mapped_file):
+        """Scan the memory mapped contents of the file, as bytes, and add
+        the relations found to the file"""
+        from .dep_file import DepRelation
+        buf = mapped_file.buf
+        library = dep_file.library
 
-        def do_package(text):
-            """Function to be applied by re.sub to every match of the
-            package_pattern in the VHDL code -- group() returns positive
-            matches as indexed plain strings. It adds the found PROVIDE
-            relations to the file"""
-            logging.debug("found package %s.%s", dep_file.library,
-                          text.group(1))
-            dep_file.add_relation(
-                DepRelation("%s.%s" % (dep_file.library, text.group(1)),
-                            DepRelation.PROVIDE,
-                            DepRelation.PACKAGE))
-            return "<hdlmake package %s.%s>" % (dep_file.library,
-                                                text.group(1))
-        buf = re.sub(package_pattern, do_package, buf)
-        # component declaration
-        component_pattern = re.compile(
-            r"^\s*component\s+(\w+).*?end\s+component.*?;",
-            re.DOTALL | re.MULTILINE | re.IGNORECASE)
+        def _get_lib(match, lib_group):
+            """Get the library of a match, work being the file one"""
+            lib = decode(match.group(lib_group))
+            if lib.lower() == "work":
+                return library
+            return lib
 
-        def do_component(text):
-            """Function to be applied by re.sub to every match of the
-            component_pattern in the VHDL code -- group() returns positive
-            matches as indexed plain strings. It doesn't add any relation
-            to the file"""
-            logging.debug("found component declaration %s", text.group(1))
-            return "<hdlmake component %s>" % text.group(1)
-        buf = re.sub(component_pattern, do_component, buf)
-        # record declaration
-        record_pattern = re.compile(
-            r"^\s*type\s+(\w+)\s+is\s+record.*?end\s+record.*?;",
-            re.DOTALL | re.MULTILINE | re.IGNORECASE)
+        def _get_name(match, lib_group, name_group):
+            """Get the library.name of a match, work being the file one"""
+            return "%s.%s" % (_get_lib(match, lib_group),
+                              decode(match.group(name_group)))
 
-        def do_record(text):
-            """Function to be applied by re.sub to every match of the
-            record_pattern in the VHDL code -- group() returns positive matches
-            as indexed plain strings. It doesn't add any relation to the
-            file"""
-            logging.debug("found record declaration %s", text.group(1))
-            return "<hdlmake record %s>" % text.group(1)
-        buf = re.sub(record_pattern, do_record, buf)
-        # function declaration
-        function_pattern = re.compile(
-            r"^\s*function\s+(\w+).*?return.*?(?:is|;)",
-            re.DOTALL | re.MULTILINE | re.IGNORECASE)
+        # The context of the design unit being scanned: the units made
+        # visible by "use lib.name" clauses, the libraries made visible
+        # by "use lib.all" clauses and the entities bound to the
+        # components by the configuration specifications.
+        # The context clause of a unit is made of the library and use
+        # clauses right before its declaration: they are collected in
+        # next_context, which is dropped by any other statement, as a use
+        # clause can be found in the declarations of a unit too
+        context = ({}, [])
+        next_context = None
+        bindings = {}
+        entity_contexts = {}
+        # the units used by "use lib.name" can be packages or entities,
+        # they are packages unless they are instantiated
+        used_units = set()
+        instantiated = set()
+        in_unit = False
+        in_configuration = False
+        match = self.first_statement_pattern.match(buf)
+        if match is None:
+            match = self.scanner_pattern.search(buf)
+        while match is not None:
+            position = match.end()
+            mapped_file.release(position)
+            kind = match.lastgroup
+            if kind in ("entity", "component"):
+                # the port list may follow in the same line
+                header_match = self.header_list_pattern.match(buf, position)
+                if header_match is not None:
+                    position = self._skip_paren_list(buf, header_match.end())
+            if kind in ("entity", "arch_entity", "config_entity",
+                        "package", "package_body"):
+                if next_context is None:
+                    next_context = ({}, [])
+                context = next_context
+                next_context = None
+                in_unit = True
+                in_configuration = kind == "config_entity"
+                bindings = {}
+            if kind == "paren_list":
+                position = self._skip_paren_list(buf, position)
+            elif kind == "record":
+                position = self._skip_record(buf, position)
+            elif kind == "library":
+                if next_context is None:
+                    next_context = ({}, [])
+            elif kind == "use":
+                if next_context is None:
+                    next_context = ({}, [])
+                use_lib = _get_lib(match, "use_lib")
+                self._add_use_clause(dep_file, match, use_lib,
+                                     next_context, used_units)
+                if in_unit:
+                    # it can be in the declarations of the current unit,
+                    # whose context is copied so that the one kept for
+                    # its entity is not modified
+                    context = (dict(context[0]), list(context[1]))
+                    self._add_use_clause(dep_file, match, use_lib,
+                                         context, used_units)
+            elif kind == "entity":
+                entity = decode(match.group("entity"))
+                name = "%s.%s" % (library, entity)
+                logging.debug("found entity %s", name)
+                dep_file.add_relation(DepRelation(
+                    name, DepRelation.PROVIDE, DepRelation.ENTITY))
+                entity_contexts[entity.lower()] = context
+            elif kind == "arch_entity":
+                entity = decode(match.group("arch_entity"))
+                name = "%s.%s" % (library, entity)
+                logging.debug("found architecture of entity %s", name)
+                dep_file.add_relation(DepRelation(
+                    name, DepRelation.PROVIDE, DepRelation.ARCHITECTURE))
+                dep_file.add_relation(DepRelation(
+                    name, DepRelation.USE, DepRelation.ENTITY))
+                # the architecture sees the context of its entity too
+                entity_context = entity_contexts.get(entity.lower())
+                if entity_context is not None:
+                    context[0].update(
+                        (unit, lib) for unit, lib in
+                        entity_context[0].items() if unit not in context[0])
+                    context[1].extend(lib for lib in entity_context[1]
+                                      if lib not in context[1])
+            elif kind == "package":
+                name = "%s.%s" % (library, decode(match.group("package")))
+                logging.debug("found package %s", name)
+                dep_file.add_relation(DepRelation(
+                    name, DepRelation.PROVIDE, DepRelation.PACKAGE))
+            elif kind == "binding":
+                name = _get_name(match, "bind_lib", "bind_entity")
+                component = decode(match.group("bind_comp")).lower()
+                for label in self.label_list_pattern.split(
+                        match.group("bind_labels")):
+                    label = decode(label).lower()
+                    if label in ("all", "others"):
+                        label = None
+                    bindings[(label, component)] = name
+                if in_configuration:
+                    logging.debug("-> configures %s", name)
+                    dep_file.add_relation(DepRelation(
+                        name, DepRelation.USE, DepRelation.ARCHITECTURE))
+            elif kind == "inst_entity":
+                name = _get_name(match, "inst_lib", "inst_entity")
+                logging.debug("-> instantiates %s", name)
+                dep_file.add_relation(DepRelation(
+                    name, DepRelation.USE, DepRelation.ARCHITECTURE))
+                instantiated.add(name.lower())
+            elif kind == "inst_name":
+                name = self._get_bound_entity(
+                    library, decode(match.group("label")),
+                    decode(match.group("inst_name")), context, bindings)
+                logging.debug("-> instantiates %s", name)
+                dep_file.add_relation(DepRelation(
+                    name, DepRelation.USE, DepRelation.ARCHITECTURE))
+                instantiated.add(name.lower())
+            if kind not in (None, "library", "use"):
+                # comments do not break the context clause
+                next_context = None
+            match = self.scanner_pattern.search(buf, position)
+        for name in used_units:
+            if name.lower() not in instantiated:
+                logging.debug("use package %s", name)
+                dep_file.add_relation(DepRelation(
+                    name, DepRelation.USE, DepRelation.PACKAGE))
 
-        def do_function(text):
-            """Function to be applied by re.sub to every match of the
-            funtion_pattern in the VHDL code -- group() returns positive
-            matches as indexed plain strings. It doesn't add the relations
-            to the file"""
-            logging.debug("found function declaration %s", text.group(1))
-            return "<hdlmake function %s>" % text.group(1)
-        buf = re.sub(function_pattern, do_function, buf)
-        # instantions
-        libraries = set([dep_file.library])
-        instance_pattern = re.compile(
-            r"^\s*(\w+)\s*\:\s*(\w+)\s*(?:port\s+map.*?;"
-            r"|generic\s+map.*?;|\s*;)",
-            re.DOTALL | re.MULTILINE | re.IGNORECASE)
+    @staticmethod
+    def _add_use_clause(dep_file, match, use_lib, context, used_units):
+        """Add the relation of a use clause to the file, and the units or
+        the library it makes visible to the context of the unit. The
+        units used by name are only added to used_units, as they can be
+        packages or entities"""
+        from .dep_file import DepRelation
+        use_name = decode(match.group("use_name"))
+        if match.group("use_item") is None:
+            if use_name.lower() == "all":
+                # use lib.all: every unit of the library is visible
+                logging.debug("use library %s", use_lib)
+                if use_lib.lower() not in context[1]:
+                    context[1].append(use_lib.lower())
+                return
+            # use lib.name: the unit is visible, it can be an entity
+            context[0][use_name.lower()] = use_lib
+            used_units.add("%s.%s" % (use_lib, use_name))
+            return
+        name = "%s.%s" % (use_lib, use_name)
+        logging.debug("use package %s", name)
+        dep_file.add_relation(DepRelation(
+            name, DepRelation.USE, DepRelation.PACKAGE))
 
-        def do_instance(text):
-            """Function to be applied by re.sub to every match of the
-            instance_pattern in the VHDL code -- group() returns positive
-            matches as indexed plain strings. It adds the found USE
-            relations to the file"""
-            for lib in libraries:
-                logging.debug("-> instantiates %s.%s as %s",
-                              lib, text.group(2), text.group(1))
-                dep_file.add_relation(DepRelation(
-                    "%s.%s" % (lib, text.group(2)),
-                    DepRelation.USE, DepRelation.ARCHITECTURE))
-            return "<hdlmake instance %s|%s>" % (text.group(1),
-                                                 text.group(2))
-        buf = re.sub(instance_pattern, do_instance, buf)
-        instance_from_library_pattern = re.compile(
-            r"^\s*(\w+)\s*\:\s*entity\s*(\w+)\s*\.\s*(\w+)\s*(?:port"
-            r"\s+map.*?;|generic\s+map.*?;|\s*;)",
-            re.DOTALL | re.MULTILINE | re.IGNORECASE)
+    @staticmethod
+    def _get_bound_entity(library, label, component, context, bindings):
+        """Get the library.entity name of the entity a component instance
+        is bound to. The binding of a configuration specification is used
+        if any, otherwise the default binding: the entity with the same
+        name made visible by a use clause, or the one in the working
+        library"""
+        lower_component = component.lower()
+        for key in [(label.lower(), lower_component),
+                    (None, lower_component)]:
+            if key in bindings:
+                return bindings[key]
+        if lower_component in context[0]:
+            return "%s.%s" % (context[0][lower_component], component)
+        if len(context[1]) == 1:
+            return "%s.%s" % (context[1][0], component)
+        if len(context[1]) > 1:
+            # several libraries can provide it, only a tool knowing what
+            # they contain can tell
+            logging.debug("%s can be provided by any of the libraries %s, "
+                          "it is looked for in %s", component,
+                          ", ".join(context[1]), library)
+        return "%s.%s" % (library, component)
 
-        def do_instance_from_library(text):
-            """Function to be applied by re.sub to every match of the
-            instance_from_library_pattern in the VHDL code -- group()
-            returns positive matches as indexed plain strings.
-            It adds the found USE relations to the file"""
-            if text.group(2).lower() == "work":
-                logging.debug("-> instantiates %s.%s as %s",
-                              dep_file.library, text.group(3), text.group(1))
-                dep_file.add_relation(
-                    DepRelation("%s.%s" % (dep_file.library, text.group(3)),
-                                DepRelation.USE,
-                                DepRelation.ARCHITECTURE))
-            else:
-                logging.debug("-> instantiates %s.%s as %s",
-                              text.group(2), text.group(3), text.group(1))
-                dep_file.add_relation(
-                    DepRelation("%s.%s" % (text.group(2), text.group(3)),
-                                DepRelation.USE,
-                                DepRelation.ARCHITECTURE))
-            return "<hdlmake instance_from_library %s|%s>" % (text.group(1),
-                                                              text.group(3))
-        buf = re.sub(instance_from_library_pattern,
-                     do_instance_from_library, buf)
-        # libraries
-        library_pattern = re.compile(
-            r"^\s*library\s*(\w+)\s*;",
-            re.DOTALL | re.MULTILINE | re.IGNORECASE)
+    def _skip_paren_list(self, buf, position):
+        """Get the position right after the parenthesis closing the list
+        that has been opened just before the provided position"""
+        depth = 1
+        for match in self.paren_pattern.finditer(buf, position):
+            paren = match.group("paren")
+            if paren == b"(":
+                depth += 1
+            elif paren == b")":
+                depth -= 1
+                if depth == 0:
+                    return match.end()
+        return len(buf)
 
-        def do_library(text):
-            """Function to be applied by re.sub to every match of the
-            library_pattern in the VHDL code -- group() returns positive
-            matches as indexed plain strings. It adds the used libraries
-            to the file's 'library' property"""
-            logging.debug("use library %s", text.group(1))
-            libraries.add(text.group(1))
-            return "<hdlmake library %s>" % text.group(1)
-        buf = re.sub(library_pattern, do_library, buf)
-        # logging.debug("\n" + buf) # print modified buffer.
-        dep_file.is_parsed = True
+    def _skip_record(self, buf, position):
+        """Get the position right after the end of the record whose
+        declaration has been started just before the provided position"""
+        for match in self.end_record_pattern.finditer(buf, position):
+            if match.group("end"):
+                return match.end()
+        return len(buf)
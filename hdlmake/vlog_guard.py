@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Module providing the guards of the Verilog code, i.e. the conditions on
+the macros defined by the user that the `ifdef directives put on the code.
+A guard is kept in disjunctive normal form: a frozenset of terms, every
+term being a frozenset of (macro name, defined) literals that must all
+hold. The guards are small, so they are simplified as they are built"""
+
+from __future__ import absolute_import
+
+# The code that is always compiled and the code that never is
+ALWAYS = frozenset([frozenset()])
+NEVER = frozenset()
+
+
+def guard_macro(name):
+    """Get the guard of the code compiled when the macro is defined"""
+    return frozenset([frozenset([(name, True)])])
+
+
+def _simplify(terms):
+    """Get the guard of the provided terms, dropping the contradictory
+    terms and those implied by other ones and merging the pairs of terms
+    that only differ in the polarity of a literal"""
+    terms = set(term for term in terms
+                if not any((name, not defined) in term
+                           for name, defined in term))
+    merged = True
+    while merged:
+        merged = False
+        for term in list(terms):
+            for name, defined in term:
+                other = term - frozenset([(name, defined)]) | frozenset(
+                    [(name, not defined)])
+                if other in terms:
+                    terms.discard(term)
+                    terms.discard(other)
+                    terms.add(term - frozenset([(name, defined)]))
+                    merged = True
+                    break
+            if merged:
+                break
+    return frozenset(term for term in terms
+                     if not any(other < term for other in terms))
+
+
+def guard_and(guard_a, guard_b):
+    """Get the guard of the code compiled when both guards hold"""
+    if guard_a == ALWAYS:
+        return guard_b
+    if guard_b == ALWAYS:
+        return guard_a
+    return _simplify([term_a | term_b
+                      for term_a in guard_a for term_b in guard_b])
+
+
+def guard_or(guard_a, guard_b):
+    """Get the guard of the code compiled when any of the guards holds"""
+    if guard_a == NEVER:
+        return guard_b
+    if guard_b == NEVER:
+        return guard_a
+    return _simplify(guard_a | guard_b)
+
+
+def guard_not(guard):
+    """Get the guard of the code compiled when the guard does not hold"""
+    result = ALWAYS
+    for term in guard:
+        result = guard_and(result, frozenset(
+            frozenset([(name, not defined)]) for name, defined in term))
+    return result
+
+
+def guard_holds(guard, defines):
+    """Check if the guard holds when the provided macros are defined"""
+    return any(all((name in defines) == defined for name, defined in term)
+               for term in guard)
+
+
+def guard_str(guard):
+    """Get the guard as a readable string, for logging"""
+    if guard == ALWAYS:
+        return "always"
+    if guard == NEVER:
+        return "never"
+    return " || ".join(sorted(
+        " && ".join(sorted(("" if defined else "!") + name
+                           for name, defined in term))
+        for term in guard))
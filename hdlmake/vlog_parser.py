@@ -31,13 +31,54 @@ import os
 import re
 import sys
 import logging
+import collections
 
 from .new_dep_solver import DepParser
 from .dep_file import DepRelation
+from .vlog_guard import (ALWAYS, NEVER, guard_macro, guard_and, guard_or,
+                         guard_not, guard_holds, guard_str)
 from hdlmake.srcfile import create_source_file
+from hdlmake.util.mapped_file import MappedFile, decode
 import six
 
 
+class IncludeCache(object):
+
+    """Class providing a bounded cache of the include files preprocessed in
+    a parse run. The entries of an include, path and context, are only
+    reused when the macros it reads have the values they had when it was
+    preprocessed. The least recently used includes are dropped first"""
+
+    def __init__(self, max_includes=256, max_variants=8):
+        self.max_includes = max_includes
+        self.max_variants = max_variants
+        # key -> list of (content, includes, macros read, macros written)
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, macros):
+        """Get the entry of the include with the provided key whose macros
+        read have the values given by the macros dictionary, or None"""
+        variants = self._entries.pop(key, None)
+        if variants is None:
+            return None
+        self._entries[key] = variants
+        for entry in variants:
+            if all(_get_macro_key(macros.get(name)) == macro_key
+                   for name, macro_key in entry[2]):
+                return entry
+        return None
+
+    def put(self, key, entry):
+        """Add the entry of an include, dropping the oldest ones if the
+        cache is full"""
+        variants = self._entries.pop(key, [])
+        variants.append(entry)
+        del variants[:-self.max_variants]
+        self._entries[key] = variants
+        while len(self._entries) > self.max_includes:
+            self._entries.popitem(last=False)
+
+
 class VerilogPreprocessor(object):
 
     """This class provides the Verilog Preprocessor"""
@@ -62,54 +103,174 @@ class VerilogPreprocessor(object):
             self.name = name
             self.args = args
             self.expansion = expansion
+            # pattern matching the uses of the arguments in the expansion
+            self.args_pattern = None
+            if args:
+                self.args_pattern = re.compile(r"\b(?:%s)\b" % "|".join(
+                    [re.escape(arg) for arg in args]))
 
     class VLStack(object):
 
-        """Class that provides a simple binary (true/false) stack
-        for Verilog Defines for nested `ifdefs evaluation"""
+        """Class that provides the stack of the nested `ifdefs, keeping
+        the guard of the code in every one of their levels"""
 
         def __init__(self):
+            # (guard of the branch, guard of the branches taken so far)
             self.stack = []
+            # guard of the code in every level, the last is the current
+            self.guards = [ALWAYS]
 
-        def push(self, v_element):
-            """Push element to the stack"""
-            self.stack.append(v_element)
+        def push(self, cond):
+            """Enter an `ifdef whose first branch is taken if cond holds"""
+            self.stack.append((cond, cond))
+            self.guards.append(guard_and(self.guards[-1], cond))
 
         def pop(self):
-            "Pop element from the stack"""
-            return self.stack.pop()
+            """Leave the innermost `ifdef"""
+            branch = self.stack.pop()
+            self.guards.pop()
+            return branch
 
-        def all_true(self):
-            """Returns true if the stack is empty or all the contained
-            elements are True"""
-            return len(self.stack) == 0 or all(self.stack)
+        def elsif(self, cond):
+            """Enter an `elsif branch, taken if cond holds and none of the
+            previous branches was taken"""
+            taken = self.stack[-1][1]
+            self._set_branch(guard_and(guard_not(taken), cond),
+                             guard_or(taken, cond))
 
         def flip(self):
-            """Toggle the following element"""
-            self.push(not self.pop())
+            """Enter the `else branch"""
+            self._set_branch(guard_not(self.stack[-1][1]), ALWAYS)
 
-    def __init__(self):
+        def take_first(self):
+            """Take the first branch of the innermost `ifdef whatever the
+            macros defined by the user, e.g. for an include guard"""
+            self._set_branch(ALWAYS, ALWAYS)
+
+        def _set_branch(self, cond, taken):
+            """Replace the branch of the innermost `ifdef"""
+            self.stack[-1] = (cond, taken)
+            self.guards[-1] = guard_and(self.guards[-2], cond)
+
+        @property
+        def guard(self):
+            """Get the guard of the code at the current level"""
+            return self.guards[-1]
+
+    class AmbiguousMacro(Exception):
+
+        """Exception raised when a macro has several definitions in the
+        code being expanded, with the guards of every one of them"""
+
+        def __init__(self, name, guards):
+            Exception.__init__(self, name)
+            self.guards = guards
+
+    # Preprocessor directives, only looked for in the lines starting with `
+    vpp_directives = {
+        "include": re.compile(r"^\s*`include\s+\"(.+)\""),
+        "define": re.compile(r"^\s*`define\s+(\w+)(?:\(([\w\s,]*)\))?(.*)"),
+        "undef": re.compile(r"^\s*`undef\s+(\w+)\s*$"),
+        "ifdef_elsif": re.compile(r"^\s*`(ifdef|ifndef|elsif)\s+(\w+)\s*$"),
+        "endif_else": re.compile(r"^\s*`(endif|else)\s*$"),
+        "begin_protected":
+        re.compile(r"^\s*`pragma\s*protect\s*begin_protected\s*$"),
+        "end_protected":
+        re.compile(r"^\s*`pragma\s*protect\s*end_protected\s*$")}
+    # Comments and strings, a block comment not closed in the line is open
+    vpp_comment = re.compile(
+        r'//.*|/\*.*?\*/|"(?:\\.|[^\\"])*"|(?P<open>/\*.*)')
+    vpp_macro_use = re.compile(r"`(\w+)(?:\(([\w\s,]*)\))?")
+
+    def __init__(self, include_cache=None, defines=None):
         self.vpp_stack = self.VLStack()
+        # Verilog macros defined by the user, None to follow the `ifdef
+        # branches of every set of macros
+        self.defines = defines
+        # IncludeCache of the parse run, if any
+        self.include_cache = include_cache
+        # the macros read and written by every include being preprocessed,
+        # from the outermost to the innermost one
+        self._include_macros = []
         self.vlog_file = None
         # List of `include search paths
         self.vpp_searchdir = ["."]
-        # List of macro definitions
-        self.vpp_macros = []
+        # Dictionary of macro definitions, by name. Every macro has a tuple
+        # of (guard, VLDefine) definitions, None for the code where it has
+        # been undefined, and the guard of the code where the macro has
+        # not been defined nor undefined by the code, so it is defined
+        # only if the user defines it
+        self.vpp_macros = {}
         # Dictionary of files sub-included by each file parsed
         self.vpp_filedeps = {}
 
-    def _find_macro(self, name):
-        """Get the Verilog preprocessor macro named 'name'"""
-        for macro_aux in self.vpp_macros:
-            if macro_aux.name == name:
-                return macro_aux
-        return None
+    def _find_macro(self, name, guard=ALWAYS):
+        """Get the Verilog preprocessor macro named 'name' in the code with
+        the provided guard, or None if it is not defined there. If the macro
+        has different definitions in that code, AmbiguousMacro is raised"""
+        macro = self._get_macro(name)
+        if macro is None:
+            return None
+        definitions, undefined = macro
+        if undefined == NEVER and len(definitions) == 1:
+            return definitions[0][1]
+        found = []
+        for def_guard, mdef in definitions + ((undefined, None),):
+            def_guard = guard_and(def_guard, guard)
+            if def_guard != NEVER:
+                found.append((def_guard, mdef))
+        if len(set(id(mdef) for _, mdef in found)) > 1:
+            raise self.AmbiguousMacro(name, [def_guard for def_guard, _
+                                             in found])
+        return found[0][1] if found else None
+
+    def _set_macro(self, name, mdef, guard):
+        """Set the definition of the macro, None to undefine it, in the code
+        with the provided guard. Elsewhere it keeps its definitions"""
+        for _, written in self._include_macros:
+            written.add(name)
+        if guard == ALWAYS:
+            self.vpp_macros[name] = (((ALWAYS, mdef),), NEVER)
+            return
+        definitions, undefined = self._get_macro(name) or ((), ALWAYS)
+        not_guard = guard_not(guard)
+        definitions = tuple(
+            (guard_and(def_guard, not_guard), old_def)
+            for def_guard, old_def in definitions
+            if guard_and(def_guard, not_guard) != NEVER)
+        self.vpp_macros[name] = (definitions + ((guard, mdef),),
+                                 guard_and(undefined, not_guard))
+
+    def _get_defined_guard(self, name):
+        """Get the guard of the code in which the macro is defined"""
+        macro = self._get_macro(name)
+        if macro is None:
+            return self._get_user_guard(name)
+        definitions, undefined = macro
+        defined = NEVER
+        for def_guard, mdef in definitions:
+            if mdef is not None:
+                defined = guard_or(defined, def_guard)
+        if undefined != NEVER:
+            defined = guard_or(defined,
+                               guard_and(undefined,
+                                         self._get_user_guard(name)))
+        return defined
+
+    def _get_user_guard(self, name):
+        """Get the guard of the code in which the macro is defined by the
+        user, when the code has not defined nor undefined it"""
+        if self.defines is None:
+            return guard_macro(name)
+        return ALWAYS if name in self.defines else NEVER
 
-    def _search_include(self, filename, parent_dir=None):
+    def _search_include(self, filename, parent_dir=None, guard=ALWAYS):
         """Look for the 'filename' Verilog include file in the
         provided 'parent_dir'. If the directory is not provided, the method
         will search for the Verilog include in every defined Verilog
-        preprocessor search directory"""
+        preprocessor search directory. An include that is not found is an
+        error, unless its guard needs the user to define some macro: then
+        None is returned, as it may belong to another configuration"""
         if parent_dir is not None:
             possible_file = os.path.join(parent_dir, filename)
             if os.path.isfile(possible_file):
@@ -118,187 +279,353 @@ class VerilogPreprocessor(object):
             probable_file = os.path.join(searchdir, filename)
             if os.path.isfile(probable_file):
                 return os.path.abspath(probable_file)
+        if not guard_holds(guard, ()):
+            logging.debug("Can't find %s for %s, it is only included when "
+                          "%s", filename, self.vlog_file.file_path,
+                          guard_str(guard))
+            return None
         logging.error("Can't find %s for %s in any of the include "
                       "directories: %s", filename, self.vlog_file.file_path,
                       ', '.join(self.vlog_file.include_dirs))
         sys.exit("\nExiting")
 
-    def _parse_macro_def(self, macro):
+    def _parse_macro_def(self, macro, guard=ALWAYS):
         """Parse the provided 'macro' and, if it's not a reserved keyword,
         create a new VLDefine instance and add it to the Verilog preprocessor
-        list of macros"""
+        table of macros, replacing any previous definition in the code with
+        the provided guard"""
         name = macro.group(1)
         expansion = macro.group(3)
         if macro.group(2):
-            params = macro.group(2).split(",")
+            params = [param.strip() for param in macro.group(2).split(",")]
         else:
             params = []
         if name in self.vpp_keywords:
             logging.error("Attempt to `define a reserved preprocessor keyword")
             quit()
         mdef = self.VLDefine(name, params, expansion)
-        self.vpp_macros.append(mdef)
+        self._set_macro(name, mdef, guard)
         return mdef
 
-    def _preprocess_file(self, file_content, file_name, library):
-        """Preprocess the content of the Verilog file"""
-        def _remove_comment(text):
-            """Function that removes the comments from the Verilog code"""
-            def replacer(match):
-                """Funtion that replace the matching comments"""
-                text = match.group(0)
-                if text.startswith('/'):
-                    return ""
-                else:
-                    return text
-            pattern = re.compile(
-                r'//.*?$|/\*.*?\*/|"(?:\\.|[^\\"])*"',
-                re.DOTALL | re.MULTILINE)
-            return re.sub(pattern, replacer, text)
-
-        def _degapize(text):
-            """ Create a list in which the verilog sentences are
-            stored in an ordered way -- and without empty 'gaps'"""
-            lempty = re.compile(r"^\s*$")
-            cline = None
-            lines = []
-            for line_aux in text.splitlines(False):
-                if re.match(lempty, line_aux) is not None:
-                    continue
-                if line_aux.endswith('\\'):
-                    if cline is None:
-                        cline = ""
-                    cline += line_aux[:len(line_aux) - 1]
+    def _expand_macros(self, text, file_name, expanding=(), guard=ALWAYS):
+        """Expand the macros used in the text, and recursively the macros
+        used by their expansions, as they are defined in the code with the
+        provided guard. The names of the macros being expanded are tracked,
+        so that a macro that uses itself is reported instead of being
+        expanded forever"""
+        def do_expand(what):
+            """Function to be applied by re.sub to every match of the
+            vpp_macro_use in the Verilog code -- group() returns
+            positive matches as indexed plain strings."""
+            name = what.group(1)
+            if name in self.vpp_keywords:
+                return what.group(0)
+            macro = self._find_macro(name, guard)
+            if macro is None:
+                # the code of the other configurations may use it
+                log = logging.error if guard == ALWAYS else logging.debug
+                log("No expansion for macro '`%s' (%s) (%s)",
+                    name, text[:50] if len(text) > 50 else text, file_name)
+                return ""
+            if name in expanding:
+                logging.error("Recursive expansion of macro '`%s' (%s)",
+                              name, file_name)
+                return ""
+            expansion = macro.expansion
+            if macro.args and what.group(2) is not None:
+                values = dict(zip(macro.args, what.group(2).split(",")))
+                expansion = macro.args_pattern.sub(
+                    lambda arg: values.get(arg.group(0), "").strip(),
+                    expansion)
+            # `` only joins the tokens around it
+            expansion = expansion.replace("``", "")
+            return self._expand_macros(expansion, file_name,
+                                       expanding + (name,), guard)
+        return self.vpp_macro_use.sub(do_expand, text)
+
+    def _expand_line(self, line, file_name, guard):
+        """Expand the macros used in the line of code with the provided
+        guard. A macro with different definitions in that code splits it,
+        so a (line, guard) pair is returned for every one of them"""
+        expanded = []
+        pending = [guard]
+        while pending:
+            guard = pending.pop()
+            try:
+                expanded.append((self._expand_macros(line, file_name,
+                                                     guard=guard), guard))
+            except self.AmbiguousMacro as ambiguous:
+                pending.extend(reversed(ambiguous.guards))
+        return expanded
+
+    def _strip_comments(self, lines):
+        """Generator that removes the comments from the Verilog lines,
+        keeping track of the block comments spanning several lines"""
+        in_comment = False
+        for line in lines:
+            if in_comment:
+                end = line.find("*/")
+                if end < 0:
                     continue
-                elif cline:
-                    line_aux = cline + line_aux
-                    cline = None
-                else:
-                    cline = None
-                lines.append(line_aux)
-            return lines
-        exps = {"include": re.compile(r"^\s*`include\s+\"(.+)\""),
-                "define":
-                re.compile(r"^\s*`define\s+(\w+)(?:\(([\w\s,]*)\))?(.*)"),
-                "ifdef_elsif":
-                re.compile(r"^\s*`(ifdef|ifndef|elsif)\s+(\w+)\s*$"),
-                "endif_else": re.compile(r"^\s*`(endif|else)\s*$"),
-                "begin_protected":
-                re.compile(r"^\s*`pragma\s*protect\s*begin_protected\s*$"),
-                "end_protected":
-                re.compile(r"^\s*`pragma\s*protect\s*end_protected\s*$")}
-        vl_macro_expand = re.compile(r"`(\w+)(?:\(([\w\s,]*)\))?")
+                line = line[end + 2:]
+                in_comment = False
+            if '/' not in line:
+                yield line
+                continue
+            parts = []
+            position = 0
+            for match in self.vpp_comment.finditer(line):
+                if match.group(0).startswith('/'):
+                    parts.append(line[position:match.start()])
+                    position = match.end()
+                    if match.group("open") is not None:
+                        in_comment = True
+            parts.append(line[position:])
+            yield "".join(parts)
+
+    @staticmethod
+    def _degapize(lines):
+        """Generator that yields the verilog sentences in an ordered way --
+        and without empty 'gaps', joining the continued lines"""
+        cline = None
+        for line_aux in lines:
+            line_aux = line_aux.rstrip("\r\n")
+            if not line_aux.strip():
+                continue
+            if line_aux.endswith('\\'):
+                if cline is None:
+                    cline = ""
+                cline += line_aux[:len(line_aux) - 1]
+                continue
+            elif cline:
+                line_aux = cline + line_aux
+                cline = None
+            else:
+                cline = None
+            yield line_aux
+
+    def _match_directive(self, line):
+        """Get the name and the match of the directive in the line"""
+        for statement, stmt_regex in six.iteritems(self.vpp_directives):
+            match = stmt_regex.match(line)
+            if match:
+                return statement, match
+        return None, None
+
+    def _preprocess_lines(self, lines, file_name, library):
+        """Generator that preprocesses the lines of the Verilog file in a
+        single pass: the directives are applied in order, every line is
+        expanded once and the includes are replaced by their preprocessed
+        lines. The lines are yielded together with their guard: both
+        branches of the `ifdefs on the macros that can be defined by the
+        user are followed, so that the code can be resolved for any set of
+        defines. An `ifndef on an unknown macro that is defined right
+        after is an include guard, and not a macro for the user to define.
+        The lines without a backtick are only checked against the `ifdef
+        stack"""
         # init dependencies
         self.vpp_filedeps[file_name + library] = []
-        cur_iter = 0
-        logging.debug("preprocess file %s (of length %d) in library %s",
-                      file_name, len(file_content), library)
-        buf = _remove_comment(file_content)
+        logging.debug("preprocess file %s in library %s", file_name, library)
         protected_region = False
-        while True:
-            new_buf = ""
-            n_expansions = 0
-            cur_iter += 1
-            if cur_iter > 30:
-                raise Exception("Recursion level exceeded. Nested `includes?")
-            for line in _degapize(buf):
-                matches = {}
-                last = None
-                for statement, stmt_regex in six.iteritems(exps):
-                    matches[statement] = re.match(stmt_regex, line)
-                    if matches[statement]:
-                        last = matches[statement]
-                if matches["begin_protected"]:
-                    protected_region = True
-                    continue
-                if matches["end_protected"]:
-                    protected_region = False
-                    continue
-                if protected_region:
-                    continue
-                if matches["ifdef_elsif"]:
-                    cond_true = self._find_macro(last.group(2)) is not None
-                    if last.group(1) == "ifndef":
-                        cond_true = not cond_true
-                    elif last.group(1) == "elsif":
-                        self.vpp_stack.pop()
-                    self.vpp_stack.push(cond_true)
-                    continue
-                elif matches["endif_else"]:
-                    if last.group(1) == "endif":
-                        self.vpp_stack.pop()
-                    else:  # `else
-                        self.vpp_stack.flip()
-                    continue
-                if not self.vpp_stack.all_true():
-                    continue
-                if matches["include"]:
-                    included_file_path = self._search_include(
-                        last.group(1), os.path.dirname(file_name))
-                    logging.debug("File being parsed %s (library %s) "
-                                  "includes %s",
-                                  file_name, library, included_file_path)
-                    line = self._preprocess_file(
-                        file_content=open(included_file_path, "r").read(),
-                        file_name=included_file_path, library=library)
-                    self.vpp_filedeps[
-                        file_name +
-                        library].append(
-                        included_file_path)
-                    # add the whole include chain to the dependencies of the
-                    # currently parsed file
-                    self.vpp_filedeps[file_name + library].extend(
-                        self.vpp_filedeps[included_file_path + library])
-                    new_buf += line + '\n'
-                    n_expansions += 1
-                    continue
-                elif matches["define"]:
-                    self._parse_macro_def(matches["define"])
-
-                def do_expand(what):
-                    """Function to be applied by re.sub to every match of the
-                    vl_macro_expand in the Verilof code -- group() returns
-                    positive matches as indexed plain strings."""
-                    if what.group(1) in self.vpp_keywords:
-                        return '`' + what.group(1)
-                    macro = self._find_macro(what.group(1))
-                    if macro:
-                        return macro.expansion
+        # name of the macro of a possible include guard just entered
+        include_guard = None
+        # guards of the levels of the `ifdef stack, the last is the current
+        stack_guards = self.vpp_stack.guards
+        for line in self._degapize(self._strip_comments(lines)):
+            if '`' not in line:
+                if include_guard is not None and line.strip():
+                    include_guard = None
+                if not protected_region and stack_guards[-1] != NEVER:
+                    yield line, stack_guards[-1]
+                continue
+            statement, match = None, None
+            if line.lstrip().startswith('`'):
+                statement, match = self._match_directive(line)
+            if statement == "begin_protected":
+                protected_region = True
+                continue
+            if statement == "end_protected":
+                protected_region = False
+                continue
+            if protected_region:
+                continue
+            if (statement == "define" and include_guard is not None and
+                    match.group(1) == include_guard):
+                self.vpp_stack.take_first()
+            include_guard = None
+            if statement == "ifdef_elsif":
+                cond = self._get_defined_guard(match.group(2))
+                if match.group(1) == "ifndef":
+                    cond = guard_not(cond)
+                    if self._get_macro(match.group(2)) is None:
+                        include_guard = match.group(2)
+                if match.group(1) == "elsif":
+                    self.vpp_stack.elsif(cond)
+                else:
+                    self.vpp_stack.push(cond)
+                continue
+            elif statement == "endif_else":
+                if match.group(1) == "endif":
+                    self.vpp_stack.pop()
+                else:  # `else
+                    self.vpp_stack.flip()
+                continue
+            guard = self.vpp_stack.guard
+            if guard == NEVER:
+                continue
+            if statement == "define":
+                self._parse_macro_def(match, guard)
+                continue
+            elif statement == "undef":
+                self._set_macro(match.group(1), None, guard)
+                continue
+            elif statement == "include":
+                includes = [(match.group(1), guard)]
+            elif statement is None and line.lstrip().startswith("`include"):
+                # the name of the file may be given by a macro
+                includes = []
+                for expanded, expanded_guard in self._expand_line(
+                        line, file_name, guard):
+                    match = self.vpp_directives["include"].match(expanded)
+                    if match:
+                        includes.append((match.group(1), expanded_guard))
                     else:
-                        logging.error("No expansion for macro '`%s' (%s) (%s)",
-                                      what.group(1), line[:50]
-                                      if len(line) > 50 else line, file_name)
-                repl_line = re.sub(vl_macro_expand, do_expand, line)
-                new_buf += repl_line + '\n'
-                # if there was any expansion, then keep on iterating
-                if repl_line != line:
-                    n_expansions += 1
-            buf = new_buf
-            if n_expansions == 0:
-                return new_buf
+                        yield expanded, expanded_guard
+            else:
+                for expanded in self._expand_line(line, file_name, guard):
+                    yield expanded
+                continue
+            for include_name, included_guard in includes:
+                for included_line in self._include_file(
+                        include_name, file_name, library, included_guard):
+                    yield included_line
+
+    def _include_file(self, include_name, file_name, library, guard):
+        """Generator that yields the preprocessed lines of the file included
+        by file_name, in the code with the provided guard, and adds it to
+        the dependencies of the file"""
+        included_file_path = self._search_include(
+            include_name, os.path.dirname(file_name), guard)
+        if included_file_path is None:
+            return
+        logging.debug("File being parsed %s (library %s) "
+                      "includes %s",
+                      file_name, library, included_file_path)
+        # the include name may be given by a macro that is only defined
+        # in a part of the code
+        narrowed = guard != self.vpp_stack.guard
+        if narrowed:
+            self.vpp_stack.push(guard)
+        for included_line in self._preprocess_include(
+                included_file_path, library):
+            yield included_line
+        if narrowed:
+            self.vpp_stack.pop()
+        self.vpp_filedeps[
+            file_name +
+            library].append(
+            included_file_path)
+        # add the whole include chain to the dependencies of the
+        # currently parsed file
+        self.vpp_filedeps[file_name + library].extend(
+            self.vpp_filedeps[included_file_path + library])
+
+    def _get_macro(self, name):
+        """Get the (definitions, undefined guard) of the macro, or None if
+        the code has not defined nor undefined it. The macros read by the
+        includes being preprocessed before they set them are recorded, as
+        their preprocessed content depends on them"""
+        macro = self.vpp_macros.get(name)
+        for read, written in self._include_macros:
+            if name not in written and name not in read:
+                read[name] = _get_macro_key(macro)
+        return macro
+
+    def _preprocess_include(self, file_name, library):
+        """Generator that yields the preprocessed lines of the included
+        file. The result is kept in the include cache of the parse run,
+        together with the macros the include reads before setting them,
+        and reused when the include has not changed and is reached with the
+        same include dirs and the same values of those macros, so that
+        common headers are only read and expanded once. The macros set by
+        the include are set again and its own includes are recorded as if
+        it had been preprocessed"""
+        key = None
+        if self.include_cache is not None:
+            key = (file_name, os.path.getmtime(file_name),
+                   tuple(self.vlog_file.include_dirs), self.vpp_stack.guard)
+            entry = self.include_cache.get(key, self.vpp_macros)
+            if entry is not None:
+                logging.debug("Reusing the preprocessed include %s",
+                              file_name)
+                content, file_deps, read, macros = entry
+                for line in content:
+                    yield line
+                for outer_read, outer_written in self._include_macros:
+                    for name, macro_key in read:
+                        if (name not in outer_written and
+                                name not in outer_read):
+                            outer_read[name] = macro_key
+                    outer_written.update(macros)
+                self.vpp_macros.update(macros)
+                self.vpp_filedeps[file_name + library] = list(file_deps)
+                return
+        stack_depth = len(self.vpp_stack.stack)
+        read, written = {}, set()
+        self._include_macros.append((read, written))
+        content = []
+        try:
+            with open(file_name, "r") as include_file:
+                for line in self._preprocess_lines(include_file, file_name,
+                                                   library):
+                    content.append(line)
+                    yield line
+        finally:
+            self._include_macros.pop()
+        # includes with unbalanced `ifdefs depend on the including file
+        if key is not None and len(self.vpp_stack.stack) == stack_depth:
+            self.include_cache.put(
+                key, (tuple(content),
+                      tuple(self.vpp_filedeps[file_name + library]),
+                      tuple(six.iteritems(read)),
+                      dict((name, self.vpp_macros[name])
+                           for name in written)))
 
     def _define(self, name, expansion):
         """Define a new expansion Verilog macro and add it to the macro
         collection"""
         mdef = self.VLDefine(name, [], expansion)
-        self.vpp_macros.append(mdef)
+        self._set_macro(name, mdef, ALWAYS)
 
     def add_path(self, path):
         """Add a new path to the search directory list so that HDLMake
         will search for found includes on it"""
         self.vpp_searchdir.append(path)
 
-    def preprocess(self, vlog_file):
+    def preprocess(self, vlog_file, defines=()):
         """Assign the provided 'vlog_file' to the associated class property
-        and then preprocess and return the Verilog code"""
+        and then preprocess and return the Verilog code compiled when the
+        provided macros are defined. Unlike preprocess_lines, the whole
+        expanded text of the file and its includes is built; the parser
+        does not use it"""
         # assert isinstance(vlog_file, VerilogFile)
         # assert isinstance(vlog_file, DepFile)
+        lines = [line for line, guard in self.preprocess_lines(vlog_file)
+                 if guard_holds(guard, defines)]
+        lines.append("")
+        return "\n".join(lines)
+
+    def preprocess_lines(self, vlog_file):
+        """Generator that preprocesses the provided 'vlog_file' and yields
+        its Verilog code line by line, together with the guard of every
+        line, so that the whole expanded text of the file and its includes
+        is never held in memory"""
         self.vlog_file = vlog_file
         file_path = vlog_file.file_path
-        buf = open(file_path, "r").read()
-        return self._preprocess_file(file_content=buf,
-                                     file_name=file_path,
-                                     library=vlog_file.library)
+        with open(file_path, "r") as source_file:
+            for line in self._preprocess_lines(source_file, file_path,
+                                               vlog_file.library):
+                yield line
 
     def get_file_deps(self):
         """Look for all of the defined preprocessor filedeps and return a list
@@ -314,270 +641,358 @@ class VerilogParser(DepParser):
 
     """Class providing the Verilog Parser functionality"""
 
-    reserved_words = ["accept_on",
-                      "alias",
-                      "always",
-                      "always_comb",
-                      "always_ff",
-                      "always_latch",
-                      "assert",
-                      "assign",
-                      "assume",
-                      "automatic",
-                      "before",
-                      "begin",
-                      "bind",
-                      "bins",
-                      "binsof",
-                      "bit",
-                      "break",
-                      "buf",
-                      "bufif0",
-                      "bufif1",
-                      "byte",
-                      "case",
-                      "casex",
-                      "casez",
-                      "cell",
-                      "chandle",
-                      "checker",
-                      "class",
-                      "clocking",
-                      "cmos",
-                      "config",
-                      "const",
-                      "constraint",
-                      "context",
-                      "continue",
-                      "cover",
-                      "covergroup",
-                      "coverpoint",
-                      "cross",
-                      "deassign",
-                      "default",
-                      "defparam",
-                      "disable",
-                      "dist",
-                      "do",
-                      "edge",
-                      "else",
-                      "end",
-                      "endcase",
-                      "endchecker",
-                      "endclass",
-                      "endclocking",
-                      "endconfig",
-                      "endfunction",
-                      "endgenerate",
-                      "endgroup",
-                      "endinterface",
-                      "endmodule",
-                      "endpackage",
-                      "endprimitive",
-                      "endprogram",
-                      "endproperty",
-                      "endsequence",
-                      "endspecify",
-                      "endtable",
-                      "endtask",
-                      "enum",
-                      "event",
-                      "eventually",
-                      "expect",
-                      "export",
-                      "extends",
-                      "extern",
-                      "final",
-                      "first_match",
-                      "for",
-                      "force",
-                      "foreach",
-                      "forever",
-                      "fork",
-                      "forkjoin",
-                      "function",
-                      "generate",
-                      "genvar",
-                      "global",
-                      "highz0",
-                      "highz1",
-                      "if",
-                      "iff",
-                      "ifnone",
-                      "ignore_bins",
-                      "illegal_bins",
-                      "implies",
-                      "import",
-                      "incdir",
-                      "include",
-                      "initial",
-                      "inout",
-                      "input",
-                      "inside",
-                      "instance",
-                      "int",
-                      "integer",
-                      "interface",
-                      "intersect",
-                      "join",
-                      "join_any",
-                      "join_none",
-                      "large",
-                      "let",
-                      "liblist",
-                      "library",
-                      "local",
-                      "localparam",
-                      "logic",
-                      "longint",
-                      "macromodule",
-                      "matches",
-                      "medium",
-                      "modport",
-                      "module",
-                      "nand",
-                      "negedge",
-                      "new",
-                      "nexttime",
-                      "nmos",
-                      "nor",
-                      "noshowcancelled",
-                      "not",
-                      "notif0",
-                      "notif1",
-                      "null",
-                      "or",
-                      "output",
-                      "package",
-                      "packed",
-                      "parameter",
-                      "pmos",
-                      "posedge",
-                      "primitive",
-                      "priority",
-                      "program",
-                      "property",
-                      "protected",
-                      "pull0",
-                      "pull1",
-                      "pulldown",
-                      "pullup",
-                      "pulsestyle_ondetect",
-                      "pulsestyle_onevent",
-                      "pure",
-                      "rand",
-                      "randc",
-                      "randcase",
-                      "randsequence",
-                      "rcmos",
-                      "real",
-                      "realtime",
-                      "ref",
-                      "reg",
-                      "reject_on",
-                      "release",
-                      "repeat",
-                      "restrict",
-                      "return",
-                      "rnmos",
-                      "rpmos",
-                      "rtran",
-                      "rtranif0",
-                      "rtranif1",
-                      "s_always",
-                      "scalared",
-                      "sequence",
-                      "s_eventually",
-                      "shortint",
-                      "shortreal",
-                      "showcancelled",
-                      "signed",
-                      "small",
-                      "s_nexttime",
-                      "solve",
-                      "specify",
-                      "specparam",
-                      "static",
-                      "string",
-                      "strong",
-                      "strong0",
-                      "strong1",
-                      "struct",
-                      "s_until",
-                      "super",
-                      "supply0",
-                      "supply1",
-                      "sync_accept_on",
-                      "sync_reject_on",
-                      "table",
-                      "tagged",
-                      "task",
-                      "this",
-                      "throughout",
-                      "time",
-                      "timeprecision",
-                      "timeunit",
-                      "tran",
-                      "tranif0",
-                      "tranif1",
-                      "tri",
-                      "tri0",
-                      "tri1",
-                      "triand",
-                      "trior",
-                      "trireg",
-                      "type",
-                      "typedef",
-                      "union",
-                      "unique",
-                      "unique0",
-                      "unsigned",
-                      "until",
-                      "until_with",
-                      "untypted",
-                      "use",
-                      "var",
-                      "vectored",
-                      "virtual",
-                      "void",
-                      "wait",
-                      "wait_order",
-                      "wand",
-                      "weak",
-                      "weak0",
-                      "weak1",
-                      "while",
-                      "wildcard",
-                      "wire",
-                      "with",
-                      "within",
-                      "wor",
-                      "xnor",
-                      "xor"]
-
-    def __init__(self, dep_file):
-        DepParser.__init__(self, dep_file)
-        self.preprocessor = VerilogPreprocessor()
-        self.preprocessed = False
-
-    def add_search_path(self, path):
-        """Add a new candidate path to the Verilog preprocessor list
-        containing the include dir candidates"""
-        self.preprocessor.add_path(path)
+    reserved_words = frozenset(["accept_on",
+                               "alias",
+                               "always",
+                               "always_comb",
+                               "always_ff",
+                               "always_latch",
+                               "assert",
+                               "assign",
+                               "assume",
+                               "automatic",
+                               "before",
+                               "begin",
+                               "bind",
+                               "bins",
+                               "binsof",
+                               "bit",
+                               "break",
+                               "buf",
+                               "bufif0",
+                               "bufif1",
+                               "byte",
+                               "case",
+                               "casex",
+                               "casez",
+                               "cell",
+                               "chandle",
+                               "checker",
+                               "class",
+                               "clocking",
+                               "cmos",
+                               "config",
+                               "const",
+                               "constraint",
+                               "context",
+                               "continue",
+                               "cover",
+                               "covergroup",
+                               "coverpoint",
+                               "cross",
+                               "deassign",
+                               "default",
+                               "defparam",
+                               "disable",
+                               "dist",
+                               "do",
+                               "edge",
+                               "else",
+                               "end",
+                               "endcase",
+                               "endchecker",
+                               "endclass",
+                               "endclocking",
+                               "endconfig",
+                               "endfunction",
+                               "endgenerate",
+                               "endgroup",
+                               "endinterface",
+                               "endmodule",
+                               "endpackage",
+                               "endprimitive",
+                               "endprogram",
+                               "endproperty",
+                               "endsequence",
+                               "endspecify",
+                               "endtable",
+                               "endtask",
+                               "enum",
+                               "event",
+                               "eventually",
+                               "expect",
+                               "export",
+                               "extends",
+                               "extern",
+                               "final",
+                               "first_match",
+                               "for",
+                               "force",
+                               "foreach",
+                               "forever",
+                               "fork",
+                               "forkjoin",
+                               "function",
+                               "generate",
+                               "genvar",
+                               "global",
+                               "highz0",
+                               "highz1",
+                               "if",
+                               "iff",
+                               "ifnone",
+                               "ignore_bins",
+                               "illegal_bins",
+                               "implies",
+                               "import",
+                               "incdir",
+                               "include",
+                               "initial",
+                               "inout",
+                               "input",
+                               "inside",
+                               "instance",
+                               "int",
+                               "integer",
+                               "interface",
+                               "intersect",
+                               "join",
+                               "join_any",
+                               "join_none",
+                               "large",
+                               "let",
+                               "liblist",
+                               "library",
+                               "local",
+                               "localparam",
+                               "logic",
+                               "longint",
+                               "macromodule",
+                               "matches",
+                               "medium",
+                               "modport",
+                               "module",
+                               "nand",
+                               "negedge",
+                               "new",
+                               "nexttime",
+                               "nmos",
+                               "nor",
+                               "noshowcancelled",
+                               "not",
+                               "notif0",
+                               "notif1",
+                               "null",
+                               "or",
+                               "output",
+                               "package",
+                               "packed",
+                               "parameter",
+                               "pmos",
+                               "posedge",
+                               "primitive",
+                               "priority",
+                               "program",
+                               "property",
+                               "protected",
+                               "pull0",
+                               "pull1",
+                               "pulldown",
+                               "pullup",
+                               "pulsestyle_ondetect",
+                               "pulsestyle_onevent",
+                               "pure",
+                               "rand",
+                               "randc",
+                               "randcase",
+                               "randsequence",
+                               "rcmos",
+                               "real",
+                               "realtime",
+                               "ref",
+                               "reg",
+                               "reject_on",
+                               "release",
+                               "repeat",
+                               "restrict",
+                               "return",
+                               "rnmos",
+                               "rpmos",
+                               "rtran",
+                               "rtranif0",
+                               "rtranif1",
+                               "s_always",
+                               "scalared",
+                               "sequence",
+                               "s_eventually",
+                               "shortint",
+                               "shortreal",
+                               "showcancelled",
+                               "signed",
+                               "small",
+                               "s_nexttime",
+                               "solve",
+                               "specify",
+                               "specparam",
+                               "static",
+                               "string",
+                               "strong",
+                               "strong0",
+                               "strong1",
+                               "struct",
+                               "s_until",
+                               "super",
+                               "supply0",
+                               "supply1",
+                               "sync_accept_on",
+                               "sync_reject_on",
+                               "table",
+                               "tagged",
+                               "task",
+                               "this",
+                               "throughout",
+                               "time",
+                               "timeprecision",
+                               "timeunit",
+                               "tran",
+                               "tranif0",
+                               "tranif1",
+                               "tri",
+                               "tri0",
+                               "tri1",
+                               "triand",
+                               "trior",
+                               "trireg",
+                               "type",
+                               "typedef",
+                               "union",
+                               "unique",
+                               "unique0",
+                               "unsigned",
+                               "until",
+                               "until_with",
+                               "untypted",
+                               "use",
+                               "var",
+                               "vectored",
+                               "virtual",
+                               "void",
+                               "wait",
+                               "wait_order",
+                               "wand",
+                               "weak",
+                               "weak0",
+                               "weak1",
+                               "while",
+                               "wildcard",
+                               "wire",
+                               "with",
+                               "within",
+                               "wor",
+                               "xnor",
+                               "xor"])
+
+    # Scopes that are never packages of the design
+    builtin_scopes = frozenset(["std"])
+
+    # End of the constructs whose code is parsed as a whole
+    end_pattern = re.compile(r"\bend(?:module|interface|package)\b")
+    begin_keywords = frozenset(["module", "interface", "package"])
+    end_keywords = frozenset(["endmodule", "endinterface", "endpackage"])
+    # Strings, escaped identifiers, identifiers and system names, numbers
+    # and any other single character. Every alternative matches without
+    # backtracking, so the code is split in linear time
+    token_pattern = re.compile(
+        r'"(?:\\.|[^\\"\n])*"|\\\S+|\$?[A-Za-z_][\w$]*'
+        r"|[\d'][\w$']*|::|\S")
+
+    # The declarations as found in the tokens of the code, the comments
+    # between the keyword and the name being removed by the preprocessor
+    prescan_pattern = re.compile(
+        br"(?<![\w$])(module|interface|package)(?:\s|//[^\n]*|/\*.*?\*/)+"
+        br"(\\\S+|[A-Za-z_][\w$]*)", re.DOTALL)
+
+    def __init__(self):
+        super(VerilogParser, self).__init__()
+        self.defines = None
+        self.include_cache = IncludeCache()
+
+    def start_run(self, defines):
+        """The include files preprocessed for the files of a parse run are
+        not kept for the next one, whose `ifdefs are evaluated for the
+        provided macros, if not None"""
+        self.defines = None if defines is None else frozenset(defines)
+        self.include_cache = IncludeCache()
+
+    def get_cache_config(self, dep_file):
+        """The relations found in a Verilog file depend on the include
+        search paths and on the macros of the parse run"""
+        if self.defines is None:
+            return (tuple(dep_file.include_dirs),)
+        return (tuple(dep_file.include_dirs), tuple(sorted(self.defines)))
+
+    def prescan(self, dep_file):
+        """Scan the Verilog file for the names of the modules, interfaces
+        and packages it may provide, without preprocessing it. If the file
+        has includes or macros in the declaration names, it can't be known
+        what it provides and None is returned"""
+        with MappedFile(dep_file.file_path) as mapped_file:
+            buf = mapped_file.buf
+            if re.search(br"`include\b|(?:module|interface|package)\s+`",
+                         buf):
+                return None
+            if re.search(
+                    br"`define(?:[^\n]|\\\n)*(?:module|interface|package)",
+                    buf):
+                return None
+            # the pattern mimics the parser tokens, so no declaration is
+            # missed
+            provided = set()
+            for match in self.prescan_pattern.finditer(buf):
+                if match.group(1) == b"package":
+                    rel_type = DepRelation.PACKAGE
+                else:
+                    rel_type = DepRelation.MODULE
+                provided.add((rel_type,
+                              ("%s.%s" % (dep_file.library,
+                                          decode(match.group(2)))).lower()))
+        return provided
 
     def parse(self, dep_file):
         """Parse the provided Verilog file and add to its properties
-        all of the detected dependency relations"""
+        all of the detected dependency relations, every relation found in
+        `ifdef guarded code having the guard of the code.
+        The preprocessed lines are streamed, but the relations are
+        extracted from the code of a whole module, interface or package,
+        so the memory taken is bounded by the largest of them and not by
+        the largest line. The lines of the includes are also kept by the
+        include cache of the parse run"""
         if dep_file.is_parsed:
             return
         logging.debug("Parsing %s", dep_file.path)
         # assert isinstance(dep_file, DepFile), print("unexpected type: " +
         # str(type(dep_file)))
-        buf = self.preprocessor.preprocess(dep_file)
-        self.preprocessed = buf[:]
+        # the preprocessor holds the state of the file being parsed, the
+        # parser is shared by all of the files of the parse run
+        preprocessor = VerilogPreprocessor(self.include_cache, self.defines)
+        # the relations are extracted from the code of every construct as
+        # soon as its end is preprocessed
+        scope = []
+        # names found before a :: with their guards and names of the
+        # classes declared
+        scope_names = ({}, set())
+        # when the `ifdefs are evaluated for the macros of the run, every
+        # line is always compiled
+        guarded = self.defines is None
+        chunk = []
+        for line, guard in preprocessor.preprocess_lines(dep_file):
+            end = None
+            if self.end_pattern.search(line) is not None:
+                # only the end keywords out of the strings end a construct
+                for match in self.token_pattern.finditer(line):
+                    if match.group() in self.end_keywords:
+                        end = match.end()
+            if end is None:
+                chunk.append((line, guard))
+                continue
+            chunk.append((line[:end], guard))
+            self._parse_chunk(dep_file, chunk, scope, scope_names, guarded)
+            chunk = [(line[end:], guard)]
+        self._parse_chunk(dep_file, chunk, scope, scope_names, guarded)
+        self._add_scope_relations(dep_file, scope_names)
         # add includes as dependencies
         try:
-            includes = self.preprocessor.vpp_filedeps[
+            includes = preprocessor.vpp_filedeps[
                 dep_file.path + dep_file.library]
             for file_aux in includes:
                 dep_file.depends_on.add(
@@ -587,83 +1002,198 @@ class VerilogParser(DepParser):
                           str(dep_file), len(includes))
         except KeyError:
             logging.debug(str(dep_file) + " has no includes.")
-        # look for packages used inside in file
-        # it may generate false dependencies as package in SV can be used by:
-        #    import my_package::*;
-        # or directly
-        #    logic var = my_package::MY_CONST;
-        # The same way constants and others can be imported directly from
-        # other modules:
-        #    logic var = my_other_module::MY_CONST;
-        # and HdlMake will anyway create dependency marking my_other_module as
-        # requested package
-        import_pattern = re.compile(r"(\w+) *::(\w+|\\*)")
-
-        def do_imports(text):
-            """Function to be applied by re.subn to every match of the
-            import_pattern in the Verilog code -- group() returns positive
-            matches as indexed plain strings. It adds the found USE
-            relations to the file"""
-            logging.debug("file %s imports/uses %s.%s package",
-                          dep_file.path, dep_file.library, text.group(1))
-            dep_file.add_relation(
-                DepRelation("%s.%s" % (dep_file.library, text.group(1)),
-                            DepRelation.USE, DepRelation.PACKAGE))
-        re.subn(import_pattern, do_imports, buf)
-        # packages
-        m_inside_package = re.compile(
-            r"package\s+(\w+)\s*(?:\(.*?\))?\s*(.+?)endpackage",
-            re.DOTALL | re.MULTILINE)
-
-        def do_package(text):
-            """Function to be applied by re.subn to every match of the
-            m_inside_pattern in the Verilog code -- group() returns positive
-            matches as indexed plain strings. It adds the found PROVIDE
-            relations to the file"""
-            logging.debug("found pacakge %s.%s", dep_file.library,
-                          text.group(1))
-            dep_file.add_relation(
-                DepRelation("%s.%s" % (dep_file.library, text.group(1)),
-                            DepRelation.PROVIDE, DepRelation.PACKAGE))
-        re.subn(m_inside_package, do_package, buf)
-        # modules and instatniations
-        m_inside_module = re.compile(
-            r"(?:module|interface)\s+(\w+)\s*(?:\(.*?\))?\s*(.+?)"
-            r"(?:endmodule|endinterface)",
-            re.DOTALL | re.MULTILINE)
-        m_instantiation = re.compile(
-            r"(?:\A|\s*)\s*(\w+)\s+(?:#\s*\(.*?\)\s*)?(\w+)\s*\(.*?\)\s*",
-            re.DOTALL | re.MULTILINE)
-
-        def do_module(text):
-            """Function to be applied by re.sub to every match of the
-            m_inside_module in the Verilog code -- group() returns
-            positive  matches as indexed plain strings. It adds the found
-            PROVIDE relations to the file"""
-            logging.debug("found module %s.%s", dep_file.library,
-                          text.group(1))
-            dep_file.add_relation(
-                DepRelation("%s.%s" % (dep_file.library, text.group(1)),
-                            DepRelation.PROVIDE, DepRelation.MODULE))
-
-            def do_inst(text):
-                """Function to be applied by re.sub to every match of the
-                m_instantiation in the Verilog code -- group() returns positive
-                matches as indexed plain strings. It adds the found USE
-                relations to the file"""
-                mod_name = text.group(1)
-                if mod_name in self.reserved_words:
-                    return
-                logging.debug("-> instantiates %s.%s as %s",
-                              dep_file.library, text.group(1), text.group(2))
-                dep_file.add_relation(
-                    DepRelation("%s.%s" % (dep_file.library, text.group(1)),
-                                DepRelation.USE, DepRelation.MODULE))
-            re.subn(m_instantiation, do_inst, text.group(2))
-        re.subn(m_inside_module, do_module, buf)
         dep_file.add_relation(
             DepRelation(
                 dep_file.path,
                 DepRelation.PROVIDE,
                 DepRelation.INCLUDE))
         dep_file.is_parsed = True
+
+    def _parse_chunk(self, dep_file, chunk, scope, scope_names, guarded):
+        """Add to the file the relations found in the preprocessed (line,
+        guard) chunk of code of its constructs, scope being the list of the
+        constructs the code is in. The code is split in tokens that are
+        scanned in a single pass, the declarations and instantiations being
+        recognized by the few tokens that follow their first identifier, so
+        that the time spent is linear in the length of the code. Every
+        relation gets the guard of its first token, unless the chunk is
+        not guarded"""
+        library = dep_file.library
+        keywords = self.reserved_words
+        guards = None
+        if not guarded or all(guard == ALWAYS for _, guard in chunk):
+            tokens = self.token_pattern.findall(
+                "\n".join([line for line, _ in chunk]))
+        else:
+            # the code of every branch of the `ifdefs is scanned, and the
+            # guard of every token is kept
+            tokens = []
+            guards = []
+            for line, guard in chunk:
+                line_tokens = self.token_pattern.findall(line)
+                tokens.extend(line_tokens)
+                guards.extend([guard] * len(line_tokens))
+        self._scan_scopes(dep_file, tokens, guards, scope_names)
+        n_tokens = len(tokens)
+        index = 0
+        while index < n_tokens:
+            token = tokens[index]
+            if token in self.begin_keywords:
+                if (index + 1 < n_tokens and
+                        _is_identifier(tokens[index + 1])):
+                    name = "%s.%s" % (library, tokens[index + 1])
+                    scope.append(token)
+                    guard = guards[index] if guards else None
+                    if token == "package":
+                        logging.debug("found package %s", name)
+                        dep_file.add_relation(DepRelation(
+                            name, DepRelation.PROVIDE, DepRelation.PACKAGE),
+                            guard)
+                    else:
+                        logging.debug("found module %s", name)
+                        dep_file.add_relation(DepRelation(
+                            name, DepRelation.PROVIDE, DepRelation.MODULE),
+                            guard)
+                    index += 2
+                    continue
+            elif token in self.end_keywords:
+                if scope:
+                    scope.pop()
+            elif (scope and scope[-1] != "package" and
+                  _is_identifier(token) and token not in keywords):
+                # module_name [#(parameters)] instance_name [range] (ports)
+                position = index + 1
+                if position < n_tokens and tokens[position] == "#":
+                    position += 1
+                    if position < n_tokens and tokens[position] == "(":
+                        position = _skip_group(tokens, position + 1)
+                    else:
+                        position += 1
+                if (position < n_tokens and
+                        _is_identifier(tokens[position]) and
+                        tokens[position] not in keywords):
+                    position += 1
+                    while position < n_tokens and tokens[position] == "[":
+                        position = _skip_group(tokens, position + 1)
+                    if position < n_tokens and tokens[position] == "(":
+                        logging.debug("-> instantiates %s.%s",
+                                      library, token)
+                        dep_file.add_relation(DepRelation(
+                            "%s.%s" % (library, token),
+                            DepRelation.USE, DepRelation.MODULE),
+                            guards[index] if guards else None)
+                        index = _skip_group(tokens, position + 1)
+                        if guards and guards[position:index].count(
+                                guards[position]) != index - position:
+                            # the port list is shared by the instances of
+                            # several `ifdef branches, that have to be
+                            # found too
+                            index = position + 1
+                        continue
+                # the tokens that were looked at can't start anything else
+                index = max(index + 1, position - 1)
+                continue
+            index += 1
+
+    def _scan_scopes(self, dep_file, tokens, guards, scope_names):
+        """Look for the packages used by the tokens of the code. Only the
+        names in an import (or export) statement are sure to be packages:
+            import my_package::*;
+        the names found before a :: anywhere else can be packages too:
+            logic var = my_package::MY_CONST;
+        but also classes, modules, enums or built-in scopes:
+            logic var = my_class::MY_CONST;
+            process proc = std::process::self();
+        so they are only collected in scope_names, with the guards of the
+        code they are found in, together with the names of the classes
+        declared in the file"""
+        used_scopes, classes = scope_names
+        keywords = self.reserved_words
+        importing = False
+        previous = ""
+        for index, token in enumerate(tokens):
+            if token == "::":
+                # only the first name of a pkg::class::member chain
+                if (_is_identifier(previous) and previous not in keywords and
+                        (index < 2 or tokens[index - 2] != "::")):
+                    guard = guards[index - 1] if guards else ALWAYS
+                    if importing:
+                        logging.debug("file %s imports %s.%s package",
+                                      dep_file.path, dep_file.library,
+                                      previous)
+                        dep_file.add_relation(DepRelation(
+                            "%s.%s" % (dep_file.library, previous),
+                            DepRelation.USE, DepRelation.PACKAGE), guard)
+                    elif previous not in self.builtin_scopes:
+                        used_scopes[previous] = guard_or(
+                            used_scopes.get(previous, NEVER), guard)
+            elif token == "import" or token == "export":
+                importing = True
+            elif token == ";":
+                importing = False
+            elif previous == "class" and _is_identifier(token):
+                classes.add(token)
+            previous = token
+
+    @staticmethod
+    def _add_scope_relations(dep_file, scope_names):
+        """Add to the file the scope relations of the names that are not
+        classes declared in the file itself. The relations are resolved by
+        the solver only if a package with the same name is provided. A
+        name is not used as a scope where the file imports the package of
+        the same name, the package relation being enough"""
+        used_scopes, classes = scope_names
+        guarded_rels = dep_file.guarded_rels or {}
+        for name, guard in six.iteritems(used_scopes):
+            if name in classes:
+                continue
+            package_rel = DepRelation("%s.%s" % (dep_file.library, name),
+                                      DepRelation.USE, DepRelation.PACKAGE)
+            if package_rel in guarded_rels:
+                guard = guard_and(guard,
+                                  guard_not(guarded_rels[package_rel]))
+            elif package_rel in dep_file.rels:
+                guard = NEVER
+            if guard == NEVER:
+                continue
+            logging.debug("file %s uses scope %s.%s", dep_file.path,
+                          dep_file.library, name)
+            dep_file.add_relation(DepRelation(
+                "%s.%s" % (dep_file.library, name),
+                DepRelation.USE, DepRelation.SCOPE), guard)
+
+
+def _get_macro_key(macro):
+    """Get a hashable value of the (definitions, undefined guard) of a
+    macro, None if it has not been defined nor undefined"""
+    if macro is None:
+        return None
+    definitions, undefined = macro
+    return (undefined, tuple(
+        (def_guard, None if mdef is None else
+         (tuple(mdef.args), mdef.expansion))
+        for def_guard, mdef in definitions))
+
+
+def _is_identifier(token):
+    """Check if the token is a simple or escaped Verilog identifier"""
+    return token[0].isalpha() or token[0] in "_\\"
+
+
+def _skip_group(tokens, index):
+    """Get the index of the token after the one closing the parenthesis or
+    bracket group whose opening token is right before the provided index"""
+    closing = {"(": ")", "[": "]"}[tokens[index - 1]]
+    opening = tokens[index - 1]
+    depth = 1
+    n_tokens = len(tokens)
+    while index < n_tokens:
+        token = tokens[index]
+        if token == opening:
+            depth += 1
+        elif token == closing:
+            depth -= 1
+            if depth == 0:
+                return index + 1
+        index += 1
+    return n_tokens
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the interned dependency relations"""
+
+from __future__ import absolute_import
+import pickle
+
+from hdlmake.dep_file import DepRelation
+from hdlmake.new_dep_solver import DepParser
+
+
+def test_relations_are_interned():
+    """Identical relations are the same object, whatever the case of their
+    name, and are only equal to themselves"""
+    rel = DepRelation("Work.Counter", DepRelation.USE, DepRelation.ENTITY)
+    assert DepRelation("work.counter", DepRelation.USE,
+                       DepRelation.ENTITY) is rel
+    assert rel == DepRelation("WORK.COUNTER", DepRelation.USE,
+                              DepRelation.ENTITY)
+    for other in [DepRelation("work.counter", DepRelation.PROVIDE,
+                              DepRelation.ENTITY),
+                  DepRelation("work.counter", DepRelation.USE,
+                              DepRelation.PACKAGE),
+                  DepRelation("work.other", DepRelation.USE,
+                              DepRelation.ENTITY),
+                  "Use entity 'work.counter'"]:
+        assert rel != other
+        assert not rel == other
+
+
+def test_pickled_relations_are_interned():
+    """Unpickling a relation gives back the interned instance"""
+    rel = DepRelation("work.pkg", DepRelation.PROVIDE, DepRelation.PACKAGE)
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        assert pickle.loads(pickle.dumps(rel, protocol)) is rel
+    assert pickle.loads(pickle.dumps([rel, rel]))[1] is rel
+
+
+def test_parse_run_clears_the_table():
+    """A parse run starts with an empty table, the relations created before
+    it being equal to the new ones"""
+    old_rel = DepRelation("work.top", DepRelation.USE, DepRelation.MODULE)
+    DepParser.start_parse_run()
+    assert not DepRelation._instances
+    new_rel = DepRelation("work.top", DepRelation.USE, DepRelation.MODULE)
+    assert new_rel is not old_rel
+    assert new_rel == old_rel and not new_rel != old_rel
+    assert hash(new_rel) == hash(old_rel)
+    assert old_rel in set([new_rel])
@@ -0,0 +1,410 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the ordering of the files done by the dependency solver"""
+
+from __future__ import absolute_import
+import json
+import random
+
+import pytest
+
+from hdlmake import new_dep_solver as dep_solver
+from hdlmake.dep_file import DepRelation
+from hdlmake.srcfile import create_source_file, SourceFileSet
+
+
+def _make_graph(tmpdir, names, edges, libraries=None):
+    """Create a DepFile for every name, in the library given by the
+    libraries dictionary or in work, and make it depend on the files
+    given by the (user, dependency) edges"""
+    files = {}
+    for name in names:
+        path = tmpdir.join("%s.vhd" % name)
+        path.write("")
+        files[name] = create_source_file(
+            str(path), None, library=(libraries or {}).get(name, "work"))
+    for user, dependency in edges:
+        files[user].depends_on.add(files[dependency])
+    fileset = SourceFileSet()
+    fileset.add(list(files.values()))
+    return files, fileset
+
+
+def _check_order(files, fileset):
+    """Check that no dependency out of a cycle is broken by the levels nor
+    by the sorted list of the files"""
+    component_of = {}
+    for component in dep_solver.make_strong_components(fileset):
+        for member in component:
+            component_of[member] = id(component)
+    levels = dep_solver.make_dependency_levels(fileset)
+    position = dict((dep_file, index) for index, dep_file in
+                    enumerate(dep_solver.make_dependency_sorted_list(fileset)))
+    for dep_file in files.values():
+        for dependency in dep_file.depends_on:
+            if component_of[dependency] == component_of[dep_file]:
+                continue
+            assert levels[dependency] < levels[dep_file]
+            assert position[dependency] < position[dep_file]
+
+
+def test_cycle_downstream_is_not_broken(tmpdir):
+    """A file depending on a cycle must not be released before it"""
+    files, fileset = _make_graph(
+        tmpdir, ["a", "z", "p", "q"],
+        [("a", "z"), ("z", "p"), ("p", "q"), ("q", "p")])
+    levels = dep_solver.make_dependency_levels(fileset)
+    assert levels[files["p"]] == 0
+    assert levels[files["q"]] == 1
+    assert levels[files["z"]] == 1
+    assert levels[files["a"]] == 2
+    sorted_names = [dep_file.name for dep_file in
+                    dep_solver.make_dependency_sorted_list(fileset)]
+    assert sorted_names == ["p.vhd", "q.vhd", "z.vhd", "a.vhd"]
+
+
+def test_random_graphs_keep_acyclic_edges(tmpdir):
+    """Only the edges inside a cycle can be broken, whatever the graph"""
+    for seed in range(20):
+        rng = random.Random(seed)
+        graph_dir = tmpdir.mkdir("graph%d" % seed)
+        names = ["f%02d" % index for index in range(30)]
+        edges = set()
+        for _ in range(45):
+            edges.add((rng.choice(names), rng.choice(names)))
+        files, fileset = _make_graph(graph_dir, names, edges)
+        _check_order(files, fileset)
+
+
+def _make_parsed_files(tmpdir, names):
+    """Create a fileset of empty DepFiles that are already parsed, so that
+    their relations can be set by the test"""
+    fileset = SourceFileSet()
+    for name in names:
+        path = tmpdir.join("%s.vhd" % name)
+        path.write("")
+        dep_file = create_source_file(str(path), None, library="work")
+        dep_file.is_parsed = True
+        fileset.add(dep_file)
+    return fileset
+
+
+def _get_solution(fileset):
+    """Get the dependencies and level of every file, by file name"""
+    return dict((dep_file.name,
+                 (sorted(dep.name for dep in dep_file.depends_on),
+                  dep_file.dep_level))
+                for dep_file in fileset)
+
+
+def test_update_solution_matches_full_solve(tmpdir):
+    """Random sequences of edits of the relations of a few files are
+    solved incrementally, and the solution must always be the one found
+    by solving the whole design again"""
+    rel_types = [DepRelation.ENTITY, DepRelation.PACKAGE,
+                 DepRelation.ARCHITECTURE]
+    for seed in range(3):
+        rng = random.Random(seed)
+        file_names = ["f%03d" % index for index in range(80)]
+        obj_names = ["work.u%03d" % index for index in range(60)]
+        incremental = _make_parsed_files(
+            tmpdir.mkdir("incremental%d" % seed), file_names)
+        incremental_files = sorted(incremental, key=lambda f: f.path)
+        for dep_file in incremental_files:
+            for _ in range(3):
+                dep_file.add_relation(DepRelation(
+                    rng.choice(obj_names),
+                    rng.choice([DepRelation.USE, DepRelation.PROVIDE]),
+                    rng.choice(rel_types)))
+        dep_index = dep_solver.solve(incremental)
+        dep_solver.make_dependency_levels(incremental)
+        full_dir = tmpdir.mkdir("full%d" % seed)
+        for step in range(60):
+            changed_files = rng.sample(incremental_files, rng.randint(1, 4))
+            for dep_file in changed_files:
+                for _ in range(rng.randint(1, 3)):
+                    rels = sorted(dep_file.rels, key=str)
+                    if rels and rng.random() < 0.4:
+                        dep_file.rels.discard(rng.choice(rels))
+                    else:
+                        dep_file.add_relation(DepRelation(
+                            rng.choice(obj_names),
+                            rng.choice([DepRelation.USE,
+                                        DepRelation.PROVIDE]),
+                            rng.choice(rel_types)))
+            dep_solver.update_solution(changed_files, dep_index)
+            full = _make_parsed_files(full_dir.mkdir("step%d" % step),
+                                      file_names)
+            rels = dict((dep_file.name, dep_file.rels)
+                        for dep_file in incremental_files)
+            for dep_file in full:
+                for rel in rels[dep_file.name]:
+                    dep_file.add_relation(rel)
+            dep_solver.solve(full)
+            dep_solver.make_dependency_levels(full)
+            assert _get_solution(incremental) == _get_solution(full), \
+                (seed, step)
+
+
+def test_reduction_only_through_stamp_targets(tmpdir):
+    """A dependency is only implied through a file of the fileset, as a
+    file out of it, such as an include, does not carry the changes of the
+    files it depends on"""
+    files, _ = _make_graph(
+        tmpdir, ["a", "b", "s", "inc1", "inc2"],
+        [("a", "inc1"), ("inc1", "inc2"), ("a", "inc2"),
+         ("b", "s"), ("s", "inc2"), ("b", "inc2")])
+    fileset = SourceFileSet()
+    fileset.add([files[name] for name in ["a", "b", "s"]])
+    reduced_deps = dep_solver.make_transitive_reduction(fileset)
+    assert reduced_deps[files["a"]] == set([files["inc1"], files["inc2"]])
+    assert reduced_deps[files["b"]] == set([files["s"]])
+
+
+def _add_relations(dep_file, relations):
+    """Add the (obj_name, direction, rel_type) relations to the file"""
+    for obj_name, direction, rel_type in relations:
+        dep_file.add_relation(DepRelation(obj_name, direction, rel_type))
+
+
+def test_dep_index_lookup_and_removal(tmpdir):
+    """The index finds the providers of a relation, scope relations being
+    provided by packages, and forgets the relations of a removed file"""
+    fileset = _make_parsed_files(tmpdir, ["pkg", "user"])
+    pkg, user = sorted(fileset, key=lambda f: f.path)
+    _add_relations(pkg, [("work.p", DepRelation.PROVIDE,
+                          DepRelation.PACKAGE)])
+    _add_relations(user, [("work.p", DepRelation.USE, DepRelation.SCOPE),
+                          ("work.e", DepRelation.PROVIDE,
+                           DepRelation.ENTITY)])
+    dep_index = dep_solver.make_dep_index(fileset)
+    assert dep_index.get_providers(DepRelation.PACKAGE, "work.p") == \
+        set([pkg])
+    assert dep_index.users[(DepRelation.PACKAGE, "work.p")] == set([user])
+    assert dep_index.get_providers(DepRelation.ENTITY, "work.x") == set()
+    provided, used = dep_index.remove_file(user)
+    assert provided == set([(DepRelation.ENTITY, "work.e")])
+    assert used == set([(DepRelation.PACKAGE, "work.p")])
+    assert (DepRelation.ENTITY, "work.e") not in dep_index.providers
+    assert (DepRelation.PACKAGE, "work.p") not in dep_index.users
+
+
+def test_dep_index_keeps_parser_dependencies(tmpdir):
+    """Replacing the dependencies solved for a file keeps those added by
+    the parser, and the dependents of every file are kept up to date"""
+    files, _ = _make_graph(tmpdir, ["user", "include", "old", "new"],
+                           [("user", "include")])
+    dep_index = dep_solver.DepIndex()
+    dep_index.set_solved_deps(files["user"], set([files["old"]]))
+    assert files["user"].depends_on == set([files["include"], files["old"]])
+    dep_index.set_solved_deps(files["user"], set([files["new"]]))
+    assert files["user"].depends_on == set([files["include"], files["new"]])
+    assert dep_index.dependents[files["old"]] == set()
+    assert dep_index.dependents[files["new"]] == set([files["user"]])
+    assert dep_index.dependents[files["include"]] == set([files["user"]])
+
+
+def test_kahn_levels_and_order(tmpdir):
+    """Every file is one level above its highest dependency, and the
+    sorted list is ordered by level and then by path"""
+    files, fileset = _make_graph(
+        tmpdir, ["top", "left", "right", "base", "leaf", "alone"],
+        [("top", "left"), ("top", "right"), ("left", "base"),
+         ("right", "base"), ("right", "leaf"), ("leaf", "base")])
+    levels = dep_solver.make_dependency_levels(fileset)
+    assert dict((dep_file.purename, level)
+                for dep_file, level in levels.items()) == {
+                    "base": 0, "alone": 0, "leaf": 1, "left": 1,
+                    "right": 2, "top": 3}
+    assert all(dep_file.dep_level == levels[dep_file]
+               for dep_file in fileset)
+    assert [dep_file.purename for dep_file in
+            dep_solver.make_dependency_sorted_list(fileset)] == [
+                "alone", "base", "leaf", "left", "right", "top"]
+    assert [dep_file.purename for dep_file in
+            dep_solver.make_dependency_sorted_list(
+                fileset, reverse=True)] == [
+                    "top", "right", "left", "leaf", "base", "alone"]
+
+
+def _solve_graph(tmpdir, edges):
+    """Solve a fileset in which every file provides the entity named after
+    it and instantiates the entities of the files it depends on, given by
+    the (user, dependency) edges"""
+    names = sorted(set(name for edge in edges for name in edge))
+    fileset = _make_parsed_files(tmpdir, names)
+    files = dict((dep_file.purename, dep_file) for dep_file in fileset)
+    for name, dep_file in files.items():
+        _add_relations(dep_file, [("work.%s" % name, DepRelation.PROVIDE,
+                                   DepRelation.ARCHITECTURE)])
+    for user, dependency in edges:
+        _add_relations(files[user], [("work.%s" % dependency,
+                                      DepRelation.USE,
+                                      DepRelation.ARCHITECTURE)])
+    dep_solver.solve(fileset)
+    return files, fileset
+
+
+CYCLE_EDGES = [("a", "b"), ("b", "c"), ("c", "a"), ("c", "e"), ("d", "a"),
+               ("f", "g"), ("g", "f")]
+
+
+def test_strong_components_and_condensation(tmpdir):
+    """The files of every cycle are a component, the components are in
+    compile order and the condensation links them as a DAG"""
+    _, fileset = _solve_graph(tmpdir, CYCLE_EDGES)
+    components, comp_deps = dep_solver.make_condensation(fileset)
+    names = [[dep_file.purename for dep_file in component]
+             for component in components]
+    assert sorted(names) == [["a", "b", "c"], ["d"], ["e"], ["f", "g"]]
+    assert names == [[dep_file.purename for dep_file in component]
+                     for component in
+                     dep_solver.make_strong_components(fileset)]
+    index = dict((tuple(name), position)
+                 for position, name in enumerate(names))
+    cycle, down, leaf, pair = [index[name] for name in
+                               [("a", "b", "c"), ("d",), ("e",),
+                                ("f", "g")]]
+    assert leaf < cycle < down
+    assert comp_deps[cycle] == set([leaf])
+    assert comp_deps[down] == set([cycle])
+    assert comp_deps[leaf] == set()
+    assert comp_deps[pair] == set()
+
+
+def test_report_dependency_cycles(tmpdir):
+    """Every cycle is reported once, from the first file of its component,
+    with the relation closing every one of its edges, and the order only
+    breaks the edges of the cycles"""
+    files, fileset = _solve_graph(tmpdir, CYCLE_EDGES)
+    cycles = dep_solver.report_dependency_cycles(fileset)
+    assert [[(dep_file.purename, dependency.purename, rel)
+             for dep_file, dependency, rel in cycle] for cycle in cycles] == [
+                 [("a", "b", DepRelation("work.b", DepRelation.USE,
+                                         DepRelation.ARCHITECTURE)),
+                  ("b", "c", DepRelation("work.c", DepRelation.USE,
+                                         DepRelation.ARCHITECTURE)),
+                  ("c", "a", DepRelation("work.a", DepRelation.USE,
+                                         DepRelation.ARCHITECTURE))],
+                 [("f", "g", DepRelation("work.g", DepRelation.USE,
+                                         DepRelation.ARCHITECTURE)),
+                  ("g", "f", DepRelation("work.f", DepRelation.USE,
+                                         DepRelation.ARCHITECTURE))]]
+    _check_order(files, fileset)
+
+
+def test_dependency_sets_match_single_top_sets(tmpdir):
+    """The sets computed for several tops in a single traversal are those
+    found for every top on its own, for tops sharing a subgraph, with a
+    cycle in it, for a top with a disjoint one and for an unknown top"""
+    _, fileset = _solve_graph(
+        tmpdir, [("t1", "shared"), ("t2", "shared"), ("shared", "cyc"),
+                 ("cyc", "shared"), ("cyc", "leaf"), ("t1", "only1"),
+                 ("t2", "only2"), ("only2", "leaf"), ("t3", "y"),
+                 ("y", "z")])
+    tops = ["t1", "t2", "t3", "shared", "unknown"]
+    dep_sets = dep_solver.make_dependency_sets(fileset, tops)
+    for top in tops:
+        assert set(dep_sets[top]) == set(
+            dep_solver.make_dependency_set(fileset, top)), top
+    assert set(dep_file.purename for dep_file in dep_sets["t1"]) == set(
+        ["t1", "shared", "cyc", "leaf", "only1"])
+    assert set(dep_file.purename for dep_file in dep_sets["t3"]) == set(
+        ["t3", "y", "z"])
+    assert set(dep_sets["unknown"]) == set(fileset)
+
+
+def test_compile_waves(tmpdir):
+    """Every file is in a single wave, under its library, and all of its
+    dependencies are in earlier waves"""
+    _, fileset = _make_graph(
+        tmpdir, ["top", "mid1", "mid2", "lib1", "lib2", "base", "alone"],
+        [("top", "mid1"), ("top", "mid2"), ("mid1", "lib1"),
+         ("mid2", "lib2"), ("mid2", "base"), ("lib2", "lib1")],
+        {"lib1": "vendor", "lib2": "vendor"})
+    waves = dep_solver.make_compile_waves(fileset)
+    wave_of = {}
+    for wave_index, wave in enumerate(waves):
+        for library, wave_files in wave.items():
+            assert wave_files == sorted(wave_files, key=lambda f: f.path)
+            for dep_file in wave_files:
+                assert dep_file not in wave_of
+                assert dep_file.library == library
+                wave_of[dep_file] = wave_index
+    assert set(wave_of) == set(fileset)
+    for dep_file in fileset:
+        for dependency in dep_file.depends_on:
+            assert wave_of[dependency] < wave_of[dep_file]
+    assert [dict((library, sorted(f.purename for f in wave_files))
+                 for library, wave_files in wave.items())
+            for wave in waves] == [
+                {"work": ["alone", "base"], "vendor": ["lib1"]},
+                {"work": ["mid1"], "vendor": ["lib2"]},
+                {"work": ["mid2"]},
+                {"work": ["top"]}]
+    assert dep_solver.get_compile_waves_stats(waves) == {
+        "files": 7, "depth": 4, "max_width": 3, "average_width": 1.75}
+    assert dep_solver.get_compile_waves_stats([]) == {
+        "files": 0, "depth": 0, "max_width": 0, "average_width": 0.0}
+
+
+def test_read_compile_times(tmpdir):
+    """The times of the history are averaged and given by absolute path,
+    the invalid ones being ignored"""
+    history = tmpdir.join("history.json")
+    history.write(json.dumps({"a.vhd": 2, "sub/b.vhd": [1.0, 2.0, 6.0],
+                              "c.vhd": "slow", "d.vhd": []}))
+    assert dep_solver.read_compile_times(str(history)) == {
+        str(tmpdir.join("a.vhd")): 2.0, str(tmpdir.join("sub", "b.vhd")): 3.0}
+
+
+@pytest.mark.parametrize("content", [None, "{not json", "[1, 2]"])
+def test_read_invalid_compile_times(tmpdir, content):
+    """A missing history, or one that is not a JSON object, is an error"""
+    history = tmpdir.join("history.json")
+    if content is not None:
+        history.write(content)
+    with pytest.raises(SystemExit):
+        dep_solver.read_compile_times(str(history))
+
+
+def test_critical_path_and_priority_order(tmpdir):
+    """The critical path is the longest chain of compile times, files
+    without a time get the average one, and the priority order starts
+    the ready file with the longest tail first"""
+    files, fileset = _make_graph(
+        tmpdir, ["base", "slow", "fast", "top", "alone"],
+        [("slow", "base"), ("fast", "base"), ("top", "slow"),
+         ("top", "fast")])
+    compile_times = {files["base"].path: 1.0, files["slow"].path: 10.0,
+                     files["fast"].path: 2.0, files["top"].path: 1.0}
+    critical_path, length, total_work, tails = \
+        dep_solver.make_critical_path(fileset, compile_times)
+    assert [dep_file.purename for dep_file in critical_path] == [
+        "base", "slow", "top"]
+    assert length == 12.0
+    assert total_work == 17.5
+    assert dict((dep_file.purename, tail)
+                for dep_file, tail in tails.items()) == {
+                    "base": 12.0, "slow": 11.0, "fast": 3.0, "top": 1.0,
+                    "alone": 3.5}
+    assert [dep_file.purename for dep_file in
+            dep_solver.make_priority_sorted_list(fileset, tails)] == [
+                "base", "slow", "alone", "fast", "top"]
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Measure of the memory taken by every source file of a large design,
+once created and once parsed"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("tracemalloc")
+
+# the files are measured in their own process, whose memory is not
+# changed by the tests run before
+MEASURE_FILES = """
+import gc, sys, tracemalloc
+from hdlmake.new_dep_solver import DepParser
+from hdlmake.srcfile import create_source_file
+paths = sys.stdin.read().split()
+DepParser.start_parse_run()
+gc.collect()
+tracemalloc.start()
+files = [create_source_file(path, None, library="work",
+                            include_dirs=["inc", "common/inc"])
+         for path in paths]
+gc.collect()
+created = tracemalloc.get_traced_memory()[0]
+for dep_file in files:
+    dep_file.parser.parse(dep_file)
+gc.collect()
+parsed = tracemalloc.get_traced_memory()[0]
+sys.stdout.write("%d %d" % (created, parsed))
+"""
+
+N_FILES = 2000
+N_INSTANCES = 40
+# bytes allowed per source file, the files created with their own parser
+# and preprocessor took about 1100 bytes, and 10700 bytes once parsed
+MAX_CREATED = 900
+MAX_PARSED = 6000
+
+
+def _write_design(tmpdir):
+    """Write a design of VHDL and SystemVerilog files instantiating other
+    files of the design, and get their paths"""
+    paths = []
+    for index in range(N_FILES):
+        subdir = tmpdir.join("sub%d" % (index % 50))
+        used = [(index + inst) % N_FILES for inst in range(N_INSTANCES)]
+        if index % 2:
+            path = subdir.join("unit_%d.vhd" % index)
+            path.write(
+                "library ieee;\nuse ieee.std_logic_1164.all;\n"
+                "entity unit_%d is\nend unit_%d;\n"
+                "architecture rtl of unit_%d is\nbegin\n%send rtl;\n" % (
+                    index, index, index,
+                    "".join("  u%d : entity work.unit_%d port map "
+                            "(a => a);\n" % (inst, unit)
+                            for inst, unit in enumerate(used))),
+                ensure=True)
+        else:
+            path = subdir.join("unit_%d.sv" % index)
+            path.write("module unit_%d(input a);\n%sendmodule\n" % (
+                index, "".join("  unit_%d u%d (.a(a));\n" % (unit, inst)
+                               for inst, unit in enumerate(used))),
+                       ensure=True)
+        paths.append(str(path))
+    return paths
+
+
+def test_bytes_per_file(tmpdir):
+    """The memory taken by every source file, once created and once
+    parsed, is under the ceilings"""
+    paths = _write_design(tmpdir)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))
+    process = subprocess.Popen(
+        [sys.executable, "-c", MEASURE_FILES], env=env,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    stdout, _ = process.communicate("\n".join(paths).encode())
+    created, parsed = [int(size) / float(N_FILES)
+                       for size in stdout.decode().split()]
+    print("%d files: %.0f bytes per file created, %.0f bytes per file "
+          "parsed" % (N_FILES, created, parsed))
+    assert created < MAX_CREATED
+    assert parsed < MAX_PARSED
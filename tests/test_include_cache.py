@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the cache of the Verilog include files preprocessed in a
+parse run"""
+
+from __future__ import absolute_import
+
+from hdlmake.dep_file import DepRelation
+from hdlmake.new_dep_solver import DepParser
+from hdlmake.srcfile import create_source_file
+from hdlmake.vlog_parser import IncludeCache, VerilogParser
+
+HEADER = ("`ifdef USE_FAST\n`define CELL fast_cell\n`else\n"
+          "`define CELL slow_cell\n`endif\n")
+
+
+def _parse(tmpdir, sources):
+    """Parse the Verilog sources, all of them including the header, and
+    get the relations found in every one of them with their guards"""
+    tmpdir.join("cells.vh").write(HEADER)
+    rels = {}
+    for name, code in sources:
+        path = tmpdir.join("%s.v" % name)
+        path.write(code)
+        dep_file = create_source_file(str(path), None, library="work",
+                                      include_dirs=[str(tmpdir)])
+        dep_file.parser.parse(dep_file)
+        guarded_rels = dep_file.guarded_rels or {}
+        rels[name] = set((str(rel), guarded_rels.get(rel))
+                         for rel in set(dep_file.rels) | set(guarded_rels)
+                         if rel.rel_type != DepRelation.INCLUDE)
+    return rels
+
+
+def _make_sources(count):
+    """Get the sources of files that define different macros before
+    including the header, the macro it tests being one of them"""
+    sources = []
+    for index in range(count):
+        defines = "`define UNUSED_%d\n" % index
+        if index % 3 == 0:
+            defines += "`define USE_FAST\n"
+        sources.append(("top%d" % index, defines +
+                        "`include \"cells.vh\"\nmodule top%d;\n"
+                        "  `CELL u0 ();\nendmodule\n" % index))
+    return sources
+
+
+def test_cached_includes_match_parsing(tmpdir):
+    """The files parsed with the include cache of a parse run have the
+    relations found when every include is preprocessed again"""
+    DepParser.start_parse_run()
+    parser = VerilogParser.get_shared()
+    cached = _parse(tmpdir.mkdir("cached"), _make_sources(12))
+    uncached = {}
+    for name, code in _make_sources(12):
+        parser.include_cache = None
+        uncached.update(_parse(tmpdir.mkdir(name), [(name, code)]))
+    DepParser.start_parse_run()
+    assert cached == uncached
+    assert ("Use module 'work.fast_cell'", None) in cached["top0"]
+    assert ("Use module 'work.slow_cell'", None) not in cached["top0"]
+    assert "Use module 'work.slow_cell'" in [
+        rel for rel, guard in cached["top1"] if guard is not None]
+
+
+def test_include_reused_for_other_macros(tmpdir):
+    """The macros the include does not read are not part of its key"""
+    DepParser.start_parse_run()
+    parser = VerilogParser.get_shared()
+    _parse(tmpdir, _make_sources(12))
+    variants = list(parser.include_cache._entries.values())
+    # one entry for the files defining USE_FAST, one for the others
+    assert len(variants) == 1
+    assert len(variants[0]) == 2
+
+
+def test_include_cache_is_bounded():
+    """The least recently used includes are dropped"""
+    include_cache = IncludeCache(max_includes=2, max_variants=2)
+    for index in range(3):
+        include_cache.put(("a.vh", index), ((), (), (("M", index),), {}))
+        include_cache.put(("b.vh", 0), ((), (), (("M", index),), {}))
+    assert list(include_cache._entries) == [("a.vh", 2), ("b.vh", 0)]
+    assert len(include_cache._entries[("b.vh", 0)]) == 2
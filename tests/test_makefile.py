@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the dependencies written to the simulation Makefiles"""
+
+from __future__ import absolute_import
+import os
+import random
+import subprocess
+import sys
+
+from hdlmake.srcfile import create_source_file, SourceFileSet
+from hdlmake.tools.modelsim import ToolModelsim
+
+
+def _make_fileset(tmpdir, seed):
+    """Create a random acyclic design of VHDL files, plus a Verilog file
+    depending on some of them and on an include out of the fileset"""
+    rng = random.Random(seed)
+    files = []
+    for index in range(25):
+        path = tmpdir.join("f%02d.vhd" % index)
+        path.write("")
+        dep_file = create_source_file(str(path), None, library="work")
+        for _ in range(min(index, 4)):
+            dep_file.depends_on.add(rng.choice(files))
+        files.append(dep_file)
+    include_path = tmpdir.join("defs.vh")
+    include_path.write("")
+    include = create_source_file(str(include_path), None)
+    vlog_path = tmpdir.join("top.v")
+    vlog_path.write("")
+    vlog = create_source_file(str(vlog_path), None, library="work",
+                              include_dirs=[])
+    vlog.depends_on.update([include, files[-1], files[-2]])
+    files.append(vlog)
+    fileset = SourceFileSet()
+    fileset.add(files)
+    return fileset
+
+
+def _write_makefile(tmpdir, fileset, reduce_deps):
+    """Write the Modelsim Makefile of the fileset and get its rules, as a
+    dictionary mapping every target to the list of its prerequisites"""
+    filename = str(tmpdir.join("Makefile.%s" % reduce_deps))
+    tool = ToolModelsim()
+    tool.reduce_deps = reduce_deps
+    tool.write_makefile({"sim_top": "top", "sim_tool": "modelsim",
+                         "sim_path": str(tmpdir)}, fileset, filename)
+    tool.makefile_close()
+    with open(filename) as makefile:
+        text = makefile.read().replace(" \\\n", " ")
+    rules = {}
+    for line in text.splitlines():
+        if line.startswith("\t") or ":" not in line or ":=" in line:
+            continue
+        target, prerequisites = line.split(":", 1)
+        rules[target.strip()] = prerequisites.split()
+    return rules
+
+
+def _get_closure(rules, target):
+    """Get every prerequisite reached from the target, following the
+    prerequisites that are targets of the Makefile too"""
+    closure = set()
+    pending = [target]
+    while pending:
+        for prerequisite in rules.get(pending.pop(), []):
+            if prerequisite not in closure:
+                closure.add(prerequisite)
+                pending.append(prerequisite)
+    return closure
+
+
+def test_reduced_deps_keep_closure(tmpdir):
+    """The reduced Makefile lists less prerequisites, but every stamp
+    target still reaches the same stamps and sources through them"""
+    for seed in range(5):
+        design_dir = tmpdir.mkdir("design%d" % seed)
+        with design_dir.as_cwd():
+            fileset = _make_fileset(design_dir, seed)
+            full_rules = _write_makefile(design_dir, fileset, False)
+            reduced_rules = _write_makefile(design_dir, fileset, True)
+        stamps = [target for target in full_rules
+                  if target.startswith("work/") and target != "work/.work"]
+        assert len(stamps) == len(fileset)
+        assert set(stamps) <= set(reduced_rules)
+        for stamp in stamps:
+            assert (_get_closure(full_rules, stamp) ==
+                    _get_closure(reduced_rules, stamp))
+            # the include is not a stamp, so it is never implied
+            if stamp.endswith("_v"):
+                assert "defs.vh" in reduced_rules[stamp]
+        assert (sum(len(reduced_rules[stamp]) for stamp in stamps) <
+                sum(len(full_rules[stamp]) for stamp in stamps))
+
+
+def test_makefile_per_define_configuration(tmpdir):
+    """A Makefile is written for every configuration of Verilog macros
+    given with --defines, named after its macros or default for none, with
+    the sources and the flags of that configuration"""
+    tmpdir.join("Manifest.py").write(
+        'action = "simulation"\nsim_tool = "modelsim"\nsim_top = "top"\n'
+        'files = ["top.v", "fast_cell.v", "slow_cell.v"]\n')
+    tmpdir.join("top.v").write(
+        "module top;\n`ifdef FAST\n  fast_cell u();\n`else\n"
+        "  slow_cell u();\n`endif\nendmodule\n")
+    for name in ["fast_cell", "slow_cell"]:
+        tmpdir.join("%s.v" % name).write("module %s;\nendmodule\n" % name)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))
+    env["XDG_CACHE_HOME"] = str(tmpdir.join("cache"))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "hdlmake", "makefile", "--defines", "FAST",
+         "--defines", ""],
+        cwd=str(tmpdir), env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    process.communicate()
+    assert process.returncode == 0
+    assert not tmpdir.join("Makefile").check()
+    for suffix, cell, flag in [("FAST", "fast_cell", True),
+                               ("default", "slow_cell", False)]:
+        makefile = tmpdir.join("Makefile.%s" % suffix).read()
+        assert ("+define+FAST" in makefile) == flag
+        assert "work/%s/.%s_v: %s.v\n" % (cell, cell, cell) in makefile
+        assert "work/top/.top_v: top.v \\\nwork/%s/.%s_v\n" % (
+            cell, cell) in makefile
+        other = "slow_cell" if flag else "fast_cell"
+        assert other not in makefile
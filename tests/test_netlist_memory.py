@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Test of the memory used to parse a large netlist: it must not grow
+with the size of the netlist"""
+
+from __future__ import absolute_import
+import os
+import subprocess
+import sys
+
+import pytest
+
+resource = pytest.importorskip("resource")
+
+# hdlmake is run in its own process, so that its peak RSS can be measured
+RUN_HDLMAKE = """
+import resource, runpy, sys
+sys.argv = ["hdlmake", "--log", "error", "list-files"]
+try:
+    runpy.run_module("hdlmake", run_name="__main__")
+except SystemExit:
+    pass
+sys.stderr.write("maxrss %d\\n" % resource.getrusage(
+    resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def _write_netlist(path, n_cells):
+    """Write a VHDL netlist instantiating n_cells library cells"""
+    with open(path, "w") as netlist:
+        netlist.write("library ieee;\nuse ieee.std_logic_1164.all;\n"
+                      "library simprim;\nuse simprim.vcomponents.all;\n"
+                      "entity net_top is\n  port (q : out std_logic);\n"
+                      "end net_top;\n\narchitecture structure of net_top is\n")
+        for index in range(n_cells):
+            netlist.write("  signal n_%d : std_logic_vector(3 downto 0);\n"
+                          % index)
+        netlist.write("begin\n")
+        for index in range(n_cells):
+            netlist.write(
+                "  u_%d : X_LUT4\n    generic map(\n      INIT => X\"%04X\"\n"
+                "    )\n    port map (\n      ADR0 => n_%d(0),\n"
+                "      ADR1 => n_%d(1),\n      O => n_%d(3)\n    );\n" %
+                (index, index & 0xffff, index, max(index - 1, 0), index))
+        netlist.write("end structure;\n")
+
+
+def _get_peak_rss(project_dir, n_cells):
+    """Run list-files on a project with a netlist of n_cells cells, with
+    the default parse cache setting, and get its peak RSS in bytes"""
+    project_dir.join("Manifest.py").write(
+        'action = "simulation"\nsim_tool = "ghdl"\nsim_top = "net_top"\n'
+        'files = ["net.vho"]\n')
+    _write_netlist(str(project_dir.join("net.vho")), n_cells)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))
+    env["XDG_CACHE_HOME"] = str(project_dir.join("cache"))
+    process = subprocess.Popen(
+        [sys.executable, "-c", RUN_HDLMAKE], cwd=str(project_dir), env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    maxrss = int(stderr.decode().split("maxrss")[-1])
+    # ru_maxrss is in bytes in macOS and in kilobytes everywhere else
+    if sys.platform != "darwin":
+        maxrss *= 1024
+    return maxrss
+
+
+def test_large_netlist_rss(tmpdir):
+    """Parsing a netlist of about 80 MB must take less memory than half
+    of its size on top of the one taken with a small netlist"""
+    base_rss = _get_peak_rss(tmpdir.mkdir("small"), 10)
+    netlist_dir = tmpdir.mkdir("large")
+    rss = _get_peak_rss(netlist_dir, 400000)
+    netlist_size = netlist_dir.join("net.vho").size()
+    assert netlist_size > 70 * 1024 * 1024
+    assert rss - base_rss < netlist_size // 2
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the relations found in the generated netlists by the single
+pass VHDL scanner and by the streaming netlist parsers, and benchmark of
+the scanner on netlists of several megabytes"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import time
+
+import pytest
+
+from hdlmake.dep_file import DepRelation
+from hdlmake.srcfile import create_source_file
+
+# Relations found in the netlists by the regular expression parsers that
+# the VHDL scanner and the netlist parsers replaced
+VHO_RELATIONS = set([
+    "Provide entity 'work.net_top'",
+    "Provide module 'work.net_top'",
+    "Use entity 'work.net_top'",
+    "Use module 'simprim.x_ff'",
+    "Use module 'work.net_sub'",
+    "Use module 'work.x_lut4'",
+    "Use package 'ieee.std_logic_1164'",
+    "Use package 'simprim.vcomponents'",
+    "Use package 'work.net_pkg'"])
+VO_RELATIONS = set([
+    "Provide module 'work.net_sub'",
+    "Provide module 'work.net_top'",
+    "Use module 'work.bufg'",
+    "Use module 'work.fdre'",
+    "Use module 'work.lut4'",
+    "Use module 'work.net_sub'"])
+# allowed growth of the scan time per megabyte between the smallest
+# netlist and the largest one
+MAX_GROWTH = 2.0
+
+
+def _write_vho(path, n_cells):
+    """Write a VHDL netlist instantiating n_cells vendor cells"""
+    with open(path, "w") as netlist:
+        netlist.write(
+            "library ieee;\nuse ieee.std_logic_1164.all;\n"
+            "library simprim;\nuse simprim.vcomponents.all;\n"
+            "use work.net_pkg.all;\n"
+            "entity net_top is\n  port (\n    clk : in std_logic;\n"
+            "    q : out std_logic\n  );\nend net_top;\n\n"
+            "architecture structure of net_top is\n")
+        for index in range(n_cells):
+            netlist.write("  signal n_%d : std_logic_vector(3 downto 0);\n"
+                          % index)
+        netlist.write("begin\n")
+        for index in range(n_cells):
+            netlist.write(
+                "  u_%d_lut : X_LUT4\n    generic map(\n"
+                "      INIT => X\"%04X\"\n    )\n    port map (\n"
+                "      ADR0 => n_%d(0),\n      ADR1 => clk,\n"
+                "      O => n_%d(3)\n    );\n" %
+                (index, index & 0xffff, index, index))
+            if index % 5 == 0:
+                netlist.write(
+                    "  -- u_c%d : X_BUF port map (I => clk);\n"
+                    "  r_%d : entity simprim.X_FF port map "
+                    "(I => n_%d(2), O => q);\n" % (index, index, index))
+        netlist.write("  u_sub : net_sub port map (clk => clk);\n"
+                      "end structure;\n")
+
+
+def _write_vo(path, n_cells):
+    """Write a Verilog netlist instantiating n_cells vendor cells"""
+    with open(path, "w") as netlist:
+        netlist.write("// generated netlist\n`timescale 1 ps / 1 ps\n"
+                      "module net_top (clk, q);\n  input clk;\n"
+                      "  output q;\n")
+        for index in range(n_cells):
+            netlist.write("  wire n_%d;\n" % index)
+        for index in range(n_cells):
+            netlist.write(
+                "  LUT4 #(\n    .INIT(16'h%04X)\n  ) u_%d_lut (\n"
+                "    .I0(clk),\n    .O(n_%d)\n  );\n" %
+                (index & 0xffff, index, index))
+            if index % 5 == 0:
+                netlist.write("  FDRE r_%d (.C(clk), .D(n_%d), .Q(q));\n"
+                              % (index, index))
+        netlist.write("  net_sub u_sub (.clk(clk));\nendmodule\n\n"
+                      "module net_sub (clk);\n  input clk;\n"
+                      "  BUFG u_buf (.I(clk));\nendmodule\n")
+
+
+def _parse(path, netlist):
+    """Parse the netlist, as a source file or as a netlist, and get its
+    relations other than the header provided by the Verilog files"""
+    dep_file = create_source_file(path, None, library="work",
+                                  include_dirs=[], netlist=netlist)
+    dep_file.parser.parse(dep_file)
+    return set(str(rel) for rel in dep_file.rels
+               if rel.rel_type != DepRelation.INCLUDE)
+
+
+@pytest.mark.parametrize("netlist", [False, True])
+def test_netlist_relations(tmpdir, netlist):
+    """The VHDL scanner and the netlist parsers find the relations found
+    by the previous parsers in the generated netlists"""
+    vho_path = str(tmpdir.join("net.vho"))
+    _write_vho(vho_path, 50)
+    assert _parse(vho_path, netlist) == VHO_RELATIONS
+    for extension in ["vo", "vm"]:
+        vo_path = str(tmpdir.join("net.%s" % extension))
+        _write_vo(vo_path, 50)
+        assert _parse(vo_path, netlist) == VO_RELATIONS
+
+
+def test_vho_scan_scaling(tmpdir):
+    """Benchmark of the VHDL scanner and of the netlist parser on VHDL
+    netlists of one and of eight megabytes: the scan time must grow
+    linearly with the size of the netlist"""
+    times = {}
+    for n_cells in [5000, 40000]:
+        path = tmpdir.join("net%d.vho" % n_cells)
+        _write_vho(str(path), n_cells)
+        megabytes = path.size() / (1024.0 * 1024.0)
+        for netlist in [False, True]:
+            start = time.time()
+            assert _parse(str(path), netlist) == VHO_RELATIONS
+            times[n_cells, netlist] = (time.time() - start) / megabytes
+            print("%.1f MB, netlist %s: %.3f s/MB" % (
+                megabytes, netlist, times[n_cells, netlist]))
+    assert times[40000, False] < MAX_GROWTH * times[5000, False], times
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the SystemVerilog scope references (name::), that are only
+resolved against the packages of the design"""
+
+from __future__ import absolute_import
+import logging
+
+from hdlmake import new_dep_solver as dep_solver
+from hdlmake.dep_file import DepRelation
+from hdlmake.new_dep_solver import DepParser
+from hdlmake.srcfile import create_source_file, SourceFileSet
+from hdlmake.vlog_guard import guard_holds
+
+DESIGN = {
+    "pkg.sv": "package pkg;\n  localparam W = 8;\nendpackage\n",
+    "util.sv": "module util;\nendmodule\n",
+    "user.sv": "module user;\n"
+               "  logic [pkg::W-1:0] data;\n"
+               "  int n = util::count;\n"
+               "  int e = missing::VALUE;\n"
+               "  process p = std::process::self();\n"
+               "endmodule\n",
+}
+
+
+def _get_relations(dep_file):
+    """Get the USE relations of the file with their guards"""
+    guarded_rels = dep_file.guarded_rels or {}
+    return dict((str(rel), guarded_rels.get(rel))
+                for rel in set(dep_file.rels) | set(guarded_rels)
+                if rel.direction == DepRelation.USE)
+
+
+def _parse(tmpdir, code, defines=()):
+    """Parse the SystemVerilog code and get its file"""
+    path = tmpdir.join("scopes.sv")
+    path.write(code)
+    DepParser.start_parse_run(defines)
+    dep_file = create_source_file(str(path), None, library="work",
+                                  include_dirs=[])
+    dep_file.parser.parse(dep_file)
+    return dep_file
+
+
+def test_scopes_resolve_to_packages(tmpdir, caplog):
+    """A scope reference depends on the package of the same name, not on a
+    module of that name, and the references naming no package are ignored
+    without a warning"""
+    files = {}
+    for name in sorted(DESIGN):
+        path = tmpdir.join(name)
+        path.write(DESIGN[name])
+        files[name] = create_source_file(str(path), None, library="work",
+                                         include_dirs=[])
+    fileset = SourceFileSet()
+    fileset.add(list(files.values()))
+    with caplog.at_level(logging.INFO):
+        dep_index = dep_solver.solve(fileset)
+    assert set(_get_relations(files["user.sv"])) == set([
+        "Use package scope 'work.pkg'",
+        "Use package scope 'work.util'",
+        "Use package scope 'work.missing'"])
+    assert files["user.sv"].depends_on == set([files["pkg.sv"]])
+    assert dep_index.ignored_scopes == {files["user.sv"]: 2}
+    assert "2 SystemVerilog scope references" in caplog.text
+    assert "not satisfied" not in caplog.text
+
+
+def test_import_and_scope(tmpdir):
+    """A package both imported and used as a scope by the file is used by
+    a single relation"""
+    dep_file = _parse(tmpdir, "module top;\n  import pkg::*;\n"
+                              "  int n = pkg::N + other::N;\nendmodule\n")
+    assert _get_relations(dep_file) == {
+        "Use package 'work.pkg'": None,
+        "Use package scope 'work.other'": None}
+
+
+def test_guarded_import_and_scope(tmpdir):
+    """A package used as a scope is only used by a scope relation where
+    its import is not compiled"""
+    code = ("module top;\n`ifdef USE_PKG\n  import pkg::*;\n`endif\n"
+            "  int n = pkg::N;\nendmodule\n")
+    dep_file = _parse(tmpdir, code, None)
+    relations = _get_relations(dep_file)
+    assert set(relations) == set(["Use package 'work.pkg'",
+                                  "Use package scope 'work.pkg'"])
+    for defines in [(), ("USE_PKG",)]:
+        assert [name for name, guard in relations.items()
+                if guard_holds(guard, defines)] == [
+                    "Use package 'work.pkg'" if defines else
+                    "Use package scope 'work.pkg'"]
+        assert set(_get_relations(_parse(tmpdir, code, defines))) == set(
+            name for name, guard in relations.items()
+            if guard_holds(guard, defines))
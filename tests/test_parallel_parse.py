@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the parse of the files by parallel jobs: the result must be
+the one of a single job, and it must take less time on several cores"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import multiprocessing
+import time
+
+from hdlmake import new_dep_solver as dep_solver
+from hdlmake.srcfile import create_source_file, SourceFileSet
+
+# jobs of the benchmark, that only checks the speedup if there are as
+# many cores
+BENCH_JOBS = 4
+BENCH_FILES = 200
+
+
+def _write_design(tmpdir, n_files, n_instances):
+    """Write a design of VHDL packages and entities and of Verilog modules
+    with `ifdef guarded instances and includes, and get its file paths"""
+    tmpdir.join("cells.vh").write(
+        "`ifdef USE_FAST\n`define CELL fast_cell\n`else\n"
+        "`define CELL slow_cell\n`endif\n")
+    paths = []
+    for index in range(n_files):
+        if index % 2 == 0:
+            path = tmpdir.join("e%d.vhd" % index)
+            lines = ["library ieee;", "use ieee.std_logic_1164.all;",
+                     "package p%d is" % index,
+                     "  constant c%d : integer := %d;" % (index, index),
+                     "end package;", "",
+                     "library ieee;", "use ieee.std_logic_1164.all;",
+                     "use work.p%d.all;" % max(index - 2, 0),
+                     "entity e%d is" % index,
+                     "  port (clk : in std_logic);",
+                     "end entity;",
+                     "architecture rtl of e%d is" % index,
+                     "begin"]
+            for inst in range(n_instances):
+                used = (index + 2 * inst + 2) % n_files // 2 * 2
+                lines.append("  u%d : entity work.e%d port map (clk => clk);"
+                             % (inst, used))
+            lines += ["end architecture;", ""]
+        else:
+            path = tmpdir.join("m%d.v" % index)
+            lines = ["`include \"cells.vh\"", "module m%d(input clk);" % index]
+            for inst in range(n_instances):
+                lines += ["`ifdef USE_M%d" % (inst % 3),
+                          "  m%d u_m%d(.clk(clk));" % (
+                              (index + 2 * inst + 2) % n_files // 2 * 2 + 1,
+                              inst),
+                          "`else",
+                          "  `CELL u_cell%d(.clk(clk));" % inst,
+                          "`endif"]
+            lines += ["endmodule", ""]
+        path.write("\n".join(lines))
+        paths.append(str(path))
+    return paths
+
+
+def _make_fileset(tmpdir, paths):
+    """Get a new fileset with the files of the provided paths"""
+    fileset = SourceFileSet()
+    fileset.add([create_source_file(path, None, library="work",
+                                    include_dirs=[str(tmpdir)])
+                 for path in paths])
+    return fileset
+
+
+def _get_relations(dep_file):
+    """Get the relations of the file, with their guards and its includes"""
+    guarded_rels = dep_file.guarded_rels or {}
+    return (sorted((str(rel), sorted(sorted(term) for term in
+                                      guarded_rels.get(rel, [])))
+                   for rel in set(dep_file.rels) | set(guarded_rels)),
+            sorted(dep.path for dep in dep_file.depends_on))
+
+
+def _parse(tmpdir, paths, jobs, defines):
+    """Parse the design with the provided number of jobs, and get the
+    relations of every file"""
+    fileset = _make_fileset(tmpdir, paths)
+    dep_solver.DepParser.start_parse_run(defines)
+    dep_solver.parse_files(list(fileset), jobs=jobs)
+    return dict((dep_file.path, _get_relations(dep_file))
+                for dep_file in fileset)
+
+
+def test_jobs_match_single_job(tmpdir):
+    """The relations found by several jobs, with and without the `ifdef
+    guards, and the solved compile order are the ones of a single job"""
+    paths = _write_design(tmpdir, 40, 4)
+    for defines in [None, (), ("USE_FAST", "USE_M1")]:
+        assert (_parse(tmpdir, paths, 3, defines) ==
+                _parse(tmpdir, paths, 1, defines))
+    orders = []
+    for jobs in [1, 3]:
+        fileset = _make_fileset(tmpdir, paths)
+        dep_solver.solve(fileset, jobs=jobs, defines=("USE_M2",),
+                         any_defines=True)
+        orders.append([(dep_file.path,
+                        sorted(dep.path for dep in dep_file.depends_on))
+                       for dep_file in
+                       dep_solver.make_dependency_sorted_list(fileset)])
+    assert orders[0] == orders[1]
+
+
+def test_jobs_scaling(tmpdir):
+    """Benchmark of the parse of a design by one and by several jobs, that
+    must be faster if the machine has enough cores"""
+    paths = _write_design(tmpdir, BENCH_FILES, 100)
+    times = {}
+    for jobs in [1, BENCH_JOBS]:
+        start = time.time()
+        _parse(tmpdir, paths, jobs, None)
+        times[jobs] = time.time() - start
+        print("%d jobs: %.3f s" % (jobs, times[jobs]))
+    if multiprocessing.cpu_count() >= BENCH_JOBS:
+        assert times[BENCH_JOBS] < 0.75 * times[1], times
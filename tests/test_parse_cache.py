@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the persistent cache of the parse results"""
+
+from __future__ import absolute_import
+import json
+import os
+
+from hdlmake import new_dep_solver as dep_solver
+from hdlmake.parse_cache import ParseCache
+from hdlmake.srcfile import create_source_file
+
+SOURCE = ("`include \"cells.vh\"\n"
+          "module top;\n"
+          "`ifdef USE_FAST\n  fast_cell u_fast();\n"
+          "`elsif USE_SLOW\n  slow_cell u_slow();\n"
+          "`else\n  `CELL u_cell();\n`endif\n"
+          "  always_cell u_always();\n"
+          "endmodule\n")
+HEADER = "`define CELL default_cell\n"
+
+
+def _get_relations(dep_file):
+    """Get the relations of the file, with their guards"""
+    guarded_rels = dep_file.guarded_rels or {}
+    return set((str(rel), guarded_rels.get(rel))
+               for rel in set(dep_file.rels) | set(guarded_rels))
+
+
+def _parse(tmpdir, parse_cache):
+    """Parse the top file with the provided cache and get the new DepFile"""
+    dep_file = create_source_file(str(tmpdir.join("top.v")), None,
+                                  library="work", include_dirs=[str(tmpdir)])
+    dep_solver.DepParser.start_parse_run()
+    dep_solver.parse_files([dep_file], parse_cache=parse_cache)
+    return dep_file
+
+
+def test_cache_round_trip(tmpdir):
+    """A file loaded from the cache has the relations, guards and includes
+    of the parsed one, and its entry is a JSON document"""
+    tmpdir.join("top.v").write(SOURCE)
+    tmpdir.join("cells.vh").write(HEADER)
+    cache_dir = tmpdir.join("cache")
+    parsed = _parse(tmpdir, ParseCache(str(cache_dir)))
+    assert parsed.guarded_rels
+    parse_cache = ParseCache(str(cache_dir))
+    loaded = _parse(tmpdir, parse_cache)
+    assert (parse_cache.hits, parse_cache.misses) == (1, 0)
+    assert _get_relations(loaded) == _get_relations(parsed)
+    assert (sorted(dep.path for dep in loaded.depends_on) ==
+            [str(tmpdir.join("cells.vh"))])
+    entries = [entry for entry in cache_dir.visit()
+               if entry.check(file=1)]
+    assert len(entries) == 1
+    assert json.loads(entries[0].read())["includes"] == [
+        str(tmpdir.join("cells.vh"))]
+    # a change in an include invalidates the entry
+    tmpdir.join("cells.vh").write("`define CELL other_cell\n")
+    parse_cache = ParseCache(str(cache_dir))
+    _parse(tmpdir, parse_cache)
+    assert (parse_cache.hits, parse_cache.misses) == (0, 1)
+
+
+def test_cache_default_dir(tmpdir, monkeypatch):
+    """The cache is kept in the cache directory of the user, and not in
+    the working directory"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir.join("user_cache")))
+    assert ParseCache().cache_dir == os.path.join(
+        str(tmpdir), "user_cache", "hdlmake", "parse")
+    monkeypatch.delenv("XDG_CACHE_HOME")
+    monkeypatch.setenv("HOME", str(tmpdir))
+    assert ParseCache().cache_dir == os.path.join(
+        str(tmpdir), ".cache", "hdlmake", "parse")
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Benchmark of the Verilog parser on inputs that make a backtracking
+regex take minutes: every one of them must be parsed within a ceiling.
+Regression tests of the inputs that confused the linear scanner"""
+
+from __future__ import absolute_import
+import time
+
+import pytest
+
+from hdlmake.dep_file import DepRelation
+from hdlmake.srcfile import create_source_file
+
+# seconds allowed to parse every input, they take a fraction of it when
+# they are scanned in linear time
+CEILING = 5.0
+SIZE = 20000
+
+PATHOLOGICAL_INPUTS = {
+    "whitespace_run": "module a(input x);\n" + "  \n" * SIZE +
+                      "  foo u (.x(x));\nendmodule\n",
+    "unclosed_paren": "module a(input x);\n  foo u (\n" +
+                      "".join("  w%d x%d\n" % (index, index)
+                              for index in range(SIZE)) + "endmodule\n",
+    "no_endmodule": "".join("module m%d(input x);\n  wire w%d;\n" %
+                            (index, index) for index in range(SIZE // 10)),
+    "word_soup": "module a(input x);\n" +
+                 " ".join("w%d" % index for index in range(SIZE * 5)) +
+                 " (\nendmodule\n",
+    "unclosed_params": "module a(input x);\n" + "  foo #(\n" * (SIZE // 10) +
+                       "endmodule\n",
+}
+
+
+@pytest.mark.parametrize("name", sorted(PATHOLOGICAL_INPUTS))
+def test_pathological_input(tmpdir, name):
+    """Parse one of the pathological inputs under the time ceiling"""
+    path = tmpdir.join("%s.v" % name)
+    path.write(PATHOLOGICAL_INPUTS[name])
+    dep_file = create_source_file(str(path), None, library="work",
+                                  include_dirs=[])
+    start = time.time()
+    dep_file.parser.parse(dep_file)
+    elapsed = time.time() - start
+    assert dep_file.is_parsed
+    assert elapsed < CEILING, "%s parsed in %.1f s" % (name, elapsed)
+
+
+def test_end_keyword_in_string(tmpdir):
+    """The end keywords and declarations in strings are not code"""
+    path = tmpdir.join("strings.sv")
+    path.write('module top;\n'
+               '  string s = "module fake; endmodule";\n'
+               '  string t = "endmodule"; sub u_sub ();\n'
+               '  leaf u_leaf ();\n'
+               'endmodule\n')
+    dep_file = create_source_file(str(path), None, library="work",
+                                  include_dirs=[])
+    dep_file.parser.parse(dep_file)
+    assert set(str(rel) for rel in dep_file.rels
+               if rel.rel_type != DepRelation.INCLUDE) == set([
+                   "Provide module 'work.top'",
+                   "Use module 'work.sub'",
+                   "Use module 'work.leaf'"])
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the on demand parsing and its prescan, which must find every
+declaration the parser finds"""
+
+from __future__ import absolute_import
+
+import pytest
+
+from hdlmake import new_dep_solver as dep_solver
+from hdlmake.dep_file import DepRelation
+from hdlmake.netlist_parser import NetlistParser
+from hdlmake.srcfile import create_source_file, SourceFileSet
+
+
+def _check_prescan(tmpdir, file_name, code, expected):
+    """Check that the prescan of the code finds the expected names and
+    every name provided by the parsed file"""
+    path = tmpdir.join(file_name)
+    path.write(code)
+    dep_file = create_source_file(str(path), None, library="work",
+                                  include_dirs=[])
+    provided = dep_file.parser.prescan(dep_file)
+    dep_file.parser.parse(dep_file)
+    parsed = set((rel.rel_type, rel.obj_name) for rel in dep_file.rels
+                 if rel.direction == DepRelation.PROVIDE and
+                 rel.rel_type != DepRelation.INCLUDE)
+    assert parsed <= provided
+    assert set(expected) <= provided
+
+
+def test_vhdl_units_after_semicolon(tmpdir):
+    """A unit can be declared after the end of another one in a line"""
+    _check_prescan(
+        tmpdir, "units.vhd",
+        "entity a is\nend entity a; entity b is\nend b;\n"
+        "architecture rtl of a is begin end rtl; package p is end p;\n",
+        [(DepRelation.ENTITY, "work.a"), (DepRelation.ENTITY, "work.b"),
+         (DepRelation.ARCHITECTURE, "work.a"),
+         (DepRelation.PACKAGE, "work.p")])
+
+
+def test_verilog_identifiers(tmpdir):
+    """Escaped identifiers, identifiers with $ and comments between the
+    keyword and the name are found as the parser tokens are"""
+    _check_prescan(
+        tmpdir, "names.sv",
+        "module \\foo+bar (input a);\nendmodule\n"
+        "module baz$1;\nendmodule\n"
+        "module /* comment */ qux;\nendmodule\n"
+        "package // comment\n  pkg;\nendpackage\n",
+        [(DepRelation.MODULE, "work.\\foo+bar"),
+         (DepRelation.MODULE, "work.baz$1"),
+         (DepRelation.MODULE, "work.qux"),
+         (DepRelation.PACKAGE, "work.pkg")])
+
+
+DESIGN = {
+    "pkg.vhd": "package p is\nend p;\n",
+    "a.vhd": "use work.p.all;\nentity a is\nend a;\n"
+             "architecture rtl of a is\nbegin\nend rtl;\n",
+    "b.vhd": "entity b is\nend b;\narchitecture rtl of b is\nbegin\n"
+             "  u : entity work.a;\nend rtl;\n",
+    "c.vhd": "entity c is\nend c;\n",
+}
+
+
+def _list_files(tmpdir, top, lazy):
+    """Solve the design as the list-files command does, parsing it on
+    demand or not, and get the names of the files listed for the top"""
+    fileset = SourceFileSet()
+    for name in sorted(DESIGN):
+        path = tmpdir.join(name)
+        path.write(DESIGN[name])
+        fileset.add(create_source_file(str(path), None, library="work"))
+    solved_files = fileset
+    if lazy:
+        solved_files = dep_solver.parse_on_demand(fileset, [top])
+    dep_index = dep_solver.solve(solved_files)
+    return [dep_file.name for dep_file in
+            dep_solver.make_dependency_sorted_list(
+                dep_solver.make_dependency_set(fileset, top,
+                                               dep_index=dep_index))]
+
+
+def test_on_demand_unknown_top(tmpdir):
+    """The files listed for a top that no file provides are the whole
+    design, sorted as they are without on demand parsing"""
+    eager = _list_files(tmpdir.mkdir("eager"), "nonexist", False)
+    assert eager[-2:] == ["a.vhd", "b.vhd"]
+    assert _list_files(tmpdir.mkdir("lazy"), "nonexist", True) == eager
+    assert _list_files(tmpdir.mkdir("top"), "b", True) == [
+        "pkg.vhd", "a.vhd", "b.vhd"]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_netlist_scanned_once(tmpdir, monkeypatch, jobs):
+    """A netlist parsed on demand is only read by its prescan, and a
+    netlist that is not required is not read again either"""
+    # the scans are logged to a file, so that the ones done by the
+    # worker processes are counted too
+    scan_log = tmpdir.join("scans.log")
+    scan = NetlistParser._scan
+
+    def _logging_scan(parser, dep_file):
+        """Log the scans of every netlist"""
+        with open(str(scan_log), "a") as log_file:
+            log_file.write(dep_file.name + "\n")
+        return scan(parser, dep_file)
+    monkeypatch.setattr(NetlistParser, "_scan", _logging_scan)
+    tmpdir.join("top.vhd").write(
+        "entity top is\nend top;\narchitecture rtl of top is\nbegin\n"
+        "  u : entity work.net_top;\n  v : entity work.other_top;\n"
+        "end rtl;\n")
+    for name in ["net", "other", "unused"]:
+        tmpdir.join("%s.vho" % name).write(
+            "entity %s_top is\nend %s_top;\n"
+            "architecture structure of %s_top is\nbegin\n"
+            "  u_0 : X_LUT4\n    port map (O => o);\n"
+            "end structure;\n" % (name, name, name))
+    fileset = SourceFileSet()
+    fileset.add([create_source_file(str(tmpdir.join(name)), None,
+                                    library="work")
+                 for name in ["top.vhd", "net.vho", "other.vho",
+                              "unused.vho"]])
+    parsed_files = dep_solver.parse_on_demand(fileset, ["top"], jobs=jobs)
+    assert sorted(dep_file.name for dep_file in parsed_files) == [
+        "net.vho", "other.vho", "top.vhd"]
+    assert sorted(scan_log.read().split()) == [
+        "net.vho", "other.vho", "unused.vho"]
+    net = [dep_file for dep_file in parsed_files
+           if dep_file.name == "net.vho"][0]
+    assert "Use module 'work.x_lut4'" in set(str(rel) for rel in net.rels)
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Benchmark of the dependency solver on synthetic designs of 100 to 50000
+files: the time spent resolving their relations must grow linearly with
+the number of files"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import random
+import time
+
+from hdlmake import new_dep_solver as dep_solver
+from hdlmake.dep_file import DepRelation
+from hdlmake.srcfile import create_source_file, SourceFileSet
+
+SIZES = [100, 1000, 10000, 50000]
+# allowed growth of the time per file between the smallest design timed
+# and the largest one, a solver scanning the whole fileset for every
+# relation grows as much as the number of files
+MAX_GROWTH = 5.0
+
+
+def _make_design(n_files):
+    """Create a synthetic design of n_files already parsed files. Every
+    file provides an entity with its architecture and a package, and uses
+    the package and instantiates the entity of a few of the files before
+    it"""
+    rng = random.Random(n_files)
+    fileset = SourceFileSet()
+    for index in range(n_files):
+        dep_file = create_source_file("/synthetic/f%05d.vhd" % index, None,
+                                      library="work")
+        dep_file.is_parsed = True
+        dep_file.add_relation(DepRelation(
+            "work.e%d" % index, DepRelation.PROVIDE, DepRelation.ENTITY))
+        dep_file.add_relation(DepRelation(
+            "work.e%d" % index, DepRelation.PROVIDE,
+            DepRelation.ARCHITECTURE))
+        dep_file.add_relation(DepRelation(
+            "work.p%d" % index, DepRelation.PROVIDE, DepRelation.PACKAGE))
+        for _ in range(min(index, 3)):
+            used = rng.randrange(index)
+            dep_file.add_relation(DepRelation(
+                "work.e%d" % used, DepRelation.USE,
+                DepRelation.ARCHITECTURE))
+            dep_file.add_relation(DepRelation(
+                "work.p%d" % used, DepRelation.USE, DepRelation.PACKAGE))
+        fileset.add(dep_file)
+    return fileset
+
+
+def _time_solve(n_files):
+    """Get the best time of a few solves of a synthetic design"""
+    times = []
+    for _ in range(3 if n_files < 10000 else 1):
+        fileset = _make_design(n_files)
+        start = time.time()
+        dep_solver.solve(fileset)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def test_solve_scales_linearly():
+    """The time per file spent by solve on the largest design is close to
+    the one spent on a small one"""
+    times = {}
+    for n_files in SIZES:
+        times[n_files] = _time_solve(n_files)
+        print("%6d files: %.3f s" % (n_files, times[n_files]))
+    # the smallest design is too fast to be timed reliably
+    small, large = SIZES[1], SIZES[-1]
+    per_file_small = times[small] / small
+    per_file_large = times[large] / large
+    assert per_file_large < MAX_GROWTH * per_file_small, times
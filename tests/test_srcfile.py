@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the registry that makes every file of the design a single
+File instance"""
+
+from __future__ import absolute_import
+import logging
+import os
+import subprocess
+import sys
+
+import pytest
+
+from hdlmake.srcfile import create_source_file, SourceFileRegistry
+
+
+def _register(registry, path, library):
+    """Get the File registered for the path and library, creating and
+    registering it if it is not known, as create_source_file does"""
+    known_file = registry.get(path, library)
+    if known_file is not None:
+        return known_file
+    new_file = create_source_file(path, None, library=library,
+                                  include_dirs=[])
+    registry.add(new_file, library)
+    return new_file
+
+
+def test_libraries_are_kept_apart(tmpdir):
+    """The same file listed in two libraries is two Files, as it is
+    compiled in each of them"""
+    path = str(tmpdir.join("pkg.vhd").ensure())
+    registry = SourceFileRegistry()
+    work_file = _register(registry, path, "work")
+    lib_file = _register(registry, path, "lib1")
+    assert work_file is not lib_file
+    assert _register(registry, path, "work") is work_file
+    assert _register(registry, path, "lib1") is lib_file
+    assert registry.merged_paths == {}
+
+
+def test_include_of_listed_header(tmpdir):
+    """A header listed in the manifest of a library other than work is the
+    same File when it is included"""
+    path = str(tmpdir.join("defs.vh").ensure())
+    registry = SourceFileRegistry()
+    listed = _register(registry, path, "lib1")
+    assert _register(registry, path, None) is listed
+    # the included files are found by their path only
+    included = _register(registry, str(tmpdir.join("other.vh").ensure()),
+                         None)
+    assert _register(registry, included.path, None) is included
+
+
+@pytest.mark.skipif(not hasattr(os, "symlink"), reason="no symbolic links")
+def test_merged_paths(tmpdir, caplog):
+    """The paths to an already known file through links are merged into
+    its File and reported"""
+    real_dir = tmpdir.mkdir("real")
+    path = str(real_dir.join("top.v").ensure())
+    tmpdir.join("link").mksymlinkto(real_dir)
+    link_path = str(tmpdir.join("link", "top.v"))
+    hard_path = str(tmpdir.join("hard.v"))
+    os.link(path, hard_path)
+    registry = SourceFileRegistry()
+    top = _register(registry, path, "work")
+    assert _register(registry, link_path, "work") is top
+    assert _register(registry, hard_path, None) is top
+    assert registry.merged_paths == {top: set([link_path, hard_path])}
+    with caplog.at_level(logging.INFO):
+        registry.log_merged_paths()
+    assert "%s also found as: %s" % (
+        path, ", ".join(sorted([hard_path, link_path]))) in caplog.text
+
+
+@pytest.mark.skipif(not hasattr(os, "symlink"), reason="no symbolic links")
+def test_symlinked_module(tmpdir):
+    """A module reached through a symbolic link to its directory gets a
+    single compile rule in the Makefile, and the merged path is
+    reported"""
+    project_dir = tmpdir.mkdir("project")
+    project_dir.join("Manifest.py").write(
+        'action = "simulation"\nsim_tool = "ghdl"\nsim_top = "top"\n'
+        'files = ["top.vhd"]\nmodules = {"local": ["lib", "lib_link"]}\n')
+    project_dir.join("top.vhd").write(
+        "entity top is\nend top;\narchitecture rtl of top is\nbegin\n"
+        "  u : entity work.leaf;\nend rtl;\n")
+    lib_dir = project_dir.mkdir("lib")
+    lib_dir.join("Manifest.py").write('files = ["leaf.vhd"]\n')
+    lib_dir.join("leaf.vhd").write(
+        "entity leaf is\nend leaf;\narchitecture rtl of leaf is\n"
+        "begin\nend rtl;\n")
+    project_dir.join("lib_link").mksymlinkto(lib_dir)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))
+    env["XDG_CACHE_HOME"] = str(tmpdir.join("cache"))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "hdlmake", "--log", "info", "makefile"],
+        cwd=str(project_dir), env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = process.communicate()
+    assert process.returncode == 0
+    assert "%s also found as: %s" % (
+        lib_dir.join("leaf.vhd"),
+        project_dir.join("lib_link", "leaf.vhd")) in stderr.decode()
+    rules = [line for line in project_dir.join("Makefile").readlines()
+             if line.startswith("work/leaf/.leaf_vhd:")]
+    assert rules == ["work/leaf/.leaf_vhd: lib/leaf.vhd\n"]
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the resolution of the component instances by the VHDL parser,
+and benchmark of the relations found in a design of several libraries"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import logging
+
+from hdlmake import new_dep_solver as dep_solver
+from hdlmake.dep_file import DepRelation
+from hdlmake.srcfile import create_source_file, SourceFileSet
+
+N_ENTITIES = 50
+N_ARCHITECTURES = 100
+# USE relations, relations not satisfied and dependencies of the design;
+# when every instance was looked for in the library of its file, there
+# were 1000 relations, 500 not satisfied and 300 dependencies
+RELATION_COUNTS = (900, 50, 650)
+
+
+def _get_instances(tmpdir, code):
+    """Parse the code and get the names of the instantiated entities"""
+    path = tmpdir.join("units.vhd")
+    path.write(code)
+    dep_file = create_source_file(str(path), None, library="work",
+                                  include_dirs=[])
+    dep_file.parser.parse(dep_file)
+    return set(rel.obj_name for rel in dep_file.rels
+               if rel.direction == DepRelation.USE and
+               rel.rel_type == DepRelation.ARCHITECTURE)
+
+
+def test_context_is_not_inherited(tmpdir):
+    """A unit whose context clause has only use clauses does not see the
+    libraries made visible to the previous unit"""
+    assert _get_instances(
+        tmpdir,
+        "library mylib;\nuse mylib.all;\n"
+        "entity u1 is\nend u1;\n"
+        "architecture rtl of u1 is\nbegin\n"
+        "  i1 : foo port map (a => b);\nend rtl;\n"
+        "use work.pkg.all;\n-- comment\n"
+        "entity u2 is\nend u2;\n"
+        "architecture rtl of u2 is\nbegin\n"
+        "  u2 : bar port map (a => b);\nend rtl;\n") == set(
+            ["mylib.foo", "work.bar"])
+
+
+def test_use_clause_in_declarations(tmpdir):
+    """A use clause in the declarations of an architecture is only seen by
+    that architecture"""
+    assert _get_instances(
+        tmpdir,
+        "entity u1 is\nend u1;\n"
+        "architecture rtl of u1 is\n  use mylib.all;\nbegin\n"
+        "  i1 : foo port map (a => b);\nend rtl;\n"
+        "architecture other of u1 is\nbegin\n"
+        "  i2 : bar port map (a => b);\nend other;\n") == set(
+            ["mylib.foo", "work.bar"])
+
+
+def test_entity_instance_with_architecture(tmpdir):
+    """An entity instance naming the architecture uses the entity of the
+    library it names"""
+    assert _get_instances(
+        tmpdir,
+        "entity top is\nend top;\n"
+        "architecture rtl of top is\nbegin\n"
+        "  u1 : entity lib1.x(rtl) port map (a => b);\n"
+        "  u2 : entity work.y generic map (W => 8) port map (a => b);\n"
+        "end rtl;\n") == set(["lib1.x", "work.y"])
+
+
+def test_configuration_specifications(tmpdir):
+    """The component instances are bound to the entities of the
+    configuration specifications of the architecture, for their labels
+    first and then for all or others"""
+    assert _get_instances(
+        tmpdir,
+        "library lib1, lib2;\nuse lib1.all;\n"
+        "entity top is\nend top;\n"
+        "architecture rtl of top is\n"
+        "  component c is\n    port (a : in bit);\n  end component;\n"
+        "  component d is\n    port (a : in bit);\n  end component;\n"
+        "  for u1, u2 : c use entity lib2.e1(rtl);\n"
+        "  for others : c use entity work.e2;\n"
+        "  for all : d use entity lib2.e3;\n"
+        "begin\n"
+        "  u1 : c port map (a => b);\n"
+        "  u3 : component c port map (a => b);\n"
+        "  u4 : d port map (a => b);\n"
+        "  u5 : f port map (a => b);\nend rtl;\n"
+        "architecture other of top is\nbegin\n"
+        "  u1 : c port map (a => b);\nend other;\n") == set(
+            ["lib2.e1", "work.e2", "lib2.e3", "lib1.f", "lib1.c"])
+
+
+def test_configuration_declaration(tmpdir):
+    """The entities bound by a configuration declaration are used by the
+    file"""
+    assert _get_instances(
+        tmpdir,
+        "configuration cfg of top is\n  for rtl\n"
+        "    for u1 : c use entity lib1.e1(rtl);\n    end for;\n"
+        "    for all : d use entity work.e2;\n    end for;\n"
+        "  end for;\nend cfg;\n") == set(["lib1.e1", "work.e2"])
+
+
+def test_get_bound_entity():
+    """The bound entity is taken from the binding of the label, then of all
+    the instances of the component, then from the unit made visible by a
+    use clause, then from the only library made visible, and is in the
+    working library otherwise"""
+    from hdlmake.vhdl_parser import VHDLParser
+    get_bound_entity = VHDLParser._get_bound_entity
+    bindings = {("u1", "c"): "lib1.e1", (None, "c"): "lib2.e2"}
+    context = ({"c": "lib3", "d": "lib3"}, ["lib4"])
+    assert get_bound_entity("work", "U1", "C", context, bindings) == "lib1.e1"
+    assert get_bound_entity("work", "u2", "c", context, bindings) == "lib2.e2"
+    assert get_bound_entity("work", "u1", "D", context, bindings) == "lib3.D"
+    assert get_bound_entity("work", "u1", "f", context, bindings) == "lib4.f"
+    assert get_bound_entity("work", "u1", "f", ({}, []), {}) == "work.f"
+    assert get_bound_entity("lib0", "u1", "f", ({}, ["lib4", "lib5"]),
+                            {}) == "lib0.f"
+
+
+def _write_library_design(tmpdir):
+    """Write two libraries of entities, with a package declaring their
+    components, and architectures of the working library instantiating
+    them through use clauses, configuration specifications and entity
+    instances, and get the files"""
+    files = []
+
+    def write(name, library, code):
+        path = tmpdir.join(name)
+        path.write(code)
+        files.append(create_source_file(str(path), None, library=library,
+                                        include_dirs=[]))
+    for library in ["lib_a", "lib_b"]:
+        components = []
+        for index in range(N_ENTITIES):
+            entity = "%s_e%d" % (library, index)
+            write("%s.vhd" % entity, library,
+                  "entity %s is\n  port (a : in bit);\nend %s;\n"
+                  "architecture rtl of %s is\nbegin\nend rtl;\n" % (
+                      entity, entity, entity))
+            components.append("  component %s is\n    port (a : in bit);\n"
+                              "  end component;\n" % entity)
+        write("%s_comps.vhd" % library, library,
+              "package %s_comps is\n%send %s_comps;\n" % (
+                  library, "".join(components), library))
+    for index in range(N_ARCHITECTURES):
+        used = [(index + offset) % N_ENTITIES for offset in range(4)]
+        write("top%d.vhd" % index, "work",
+              "library lib_a, lib_b;\nuse lib_a.lib_a_comps.all;\n"
+              "use lib_b.lib_b_comps.all;\n%s\nuse lib_b.lib_b_e%d;\n"
+              "entity top%d is\n  port (clk : in bit);\nend top%d;\n"
+              "architecture rtl of top%d is\n"
+              "  for u_b1 : lib_b_e%d use entity lib_b.lib_b_e%d;\n"
+              "begin\n"
+              "  u_a0 : lib_a_e%d port map (a => clk);\n"
+              "  u_a1 : component lib_a_e%d port map (a => clk);\n"
+              "  u_a2 : entity lib_a.lib_a_e%d port map (a => clk);\n"
+              "  u_b0 : lib_b_e%d port map (a => clk);\n"
+              "  u_b1 : lib_b_e%d port map (a => clk);\n"
+              "end rtl;\n" % (
+                  "use lib_a.all;" if index % 2 else
+                  "use lib_a.lib_a_e%d;" % used[0], used[0],
+                  index, index, index, used[1], used[1], used[0], used[1],
+                  used[2], used[0], used[1]))
+    return files
+
+
+def test_relation_counts(tmpdir, caplog):
+    """Benchmark of the relations of a design instantiating the
+    components of other libraries: every instance is resolved to the
+    entity of the library that provides it"""
+    files = _write_library_design(tmpdir)
+    fileset = SourceFileSet()
+    fileset.add(files)
+    with caplog.at_level(logging.WARNING):
+        dep_solver.solve(fileset)
+    relations = sum(1 for dep_file in files for rel in dep_file.rels
+                    if rel.direction == DepRelation.USE)
+    not_satisfied = caplog.text.count("not satisfied by")
+    dependencies = sum(len(dep_file.depends_on) for dep_file in files)
+    print("%d files: %d USE relations, %d not satisfied, %d "
+          "dependencies" % (len(files), relations, not_satisfied,
+                            dependencies))
+    assert (relations, not_satisfied, dependencies) == RELATION_COUNTS
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Hdlmake.
+#
+# Hdlmake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hdlmake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hdlmake.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the guards of the relations found in the `ifdef code by the
+Verilog preprocessor, and benchmark of the expansion of the macros of
+UVM-style sources"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import itertools
+import time
+
+from hdlmake import new_dep_solver as dep_solver
+from hdlmake.dep_file import DepRelation
+from hdlmake.new_dep_solver import DepParser
+from hdlmake.srcfile import create_source_file, SourceFileSet
+from hdlmake.vlog_guard import guard_holds
+
+NESTED = """\
+`ifdef A
+`define CELL_D d_cell
+`else
+`define CELL_D nd_cell
+`endif
+module top;
+`ifdef A
+  a_cell u0();
+  `ifndef B
+    a_nb_cell u1();
+  `elsif C
+    a_b_c_cell u2();
+  `else
+    a_b_nc_cell u3();
+  `endif
+`elsif B
+  na_b_cell u4();
+  `ifdef C
+    na_b_c_cell u5();
+  `endif
+`else
+  na_nb_cell u6();
+`endif
+  `CELL_D u7();
+  always_cell u8();
+endmodule
+"""
+# cell -> function of the defined macros telling if it is instantiated
+NESTED_CELLS = {
+    "a_cell": lambda a, b, c: a,
+    "a_nb_cell": lambda a, b, c: a and not b,
+    "a_b_c_cell": lambda a, b, c: a and b and c,
+    "a_b_nc_cell": lambda a, b, c: a and b and not c,
+    "na_b_cell": lambda a, b, c: not a and b,
+    "na_b_c_cell": lambda a, b, c: not a and b and c,
+    "na_nb_cell": lambda a, b, c: not a and not b,
+    "d_cell": lambda a, b, c: a,
+    "nd_cell": lambda a, b, c: not a,
+    "always_cell": lambda a, b, c: True,
+}
+# allowed growth of the time per macro reference between the smallest
+# UVM-style source and the largest one, and ceiling of the largest one
+MAX_GROWTH = 2.0
+MAX_SECONDS = 5.0
+
+
+def _parse(path, include_dirs, defines):
+    """Parse the Verilog file for the provided macros, or for any of them
+    if None, and get the file"""
+    DepParser.start_parse_run(defines)
+    dep_file = create_source_file(path, None, library="work",
+                                  include_dirs=include_dirs)
+    dep_file.parser.parse(dep_file)
+    return dep_file
+
+
+def _get_cells(dep_file):
+    """Get the names of the modules instantiated in the file"""
+    return set(rel.obj_name.split(".")[1] for rel in dep_file.rels
+               if rel.direction == DepRelation.USE and
+               rel.rel_type == DepRelation.MODULE)
+
+
+def test_nested_guards(tmpdir):
+    """The guards of the instances in nested `ifdef, `ifndef, `elsif and
+    `else branches, and of the macros defined in them, hold exactly for
+    the macros that select the instances when the file is parsed for
+    them"""
+    path = tmpdir.join("top.v")
+    path.write(NESTED)
+    guarded_file = _parse(str(path), [], None)
+    guards = dict((rel.obj_name.split(".")[1], guard)
+                  for rel, guard in guarded_file.guarded_rels.items())
+    assert "always_cell" in _get_cells(guarded_file)
+    assert "always_cell" not in guards
+    assert set(guards) == set(NESTED_CELLS) - set(["always_cell"])
+    for values in itertools.product([False, True], repeat=3):
+        defines = frozenset(name for name, value in zip("ABC", values)
+                            if value)
+        expected = set(cell for cell, selected in NESTED_CELLS.items()
+                       if selected(*values))
+        assert set(cell for cell, guard in guards.items()
+                   if guard_holds(guard, defines)) | set(
+                       ["always_cell"]) == expected
+        assert _get_cells(_parse(str(path), [], defines)) == expected
+
+
+def test_select_defines_matches_reparse(tmpdir):
+    """The relations selected from a single guarded parse for every
+    configuration of macros are those found by parsing the files again
+    with these macros"""
+    tmpdir.join("cells.vh").write(
+        "`ifdef C\n`define CELL_E c_cell\n`else\n`define CELL_E nc_cell\n"
+        "`endif\n")
+    tmpdir.join("top.v").write(NESTED)
+    tmpdir.join("sub.v").write(
+        "`include \"cells.vh\"\nmodule sub;\n  `CELL_E u0();\n"
+        "`ifndef A\n  top u1();\n`endif\nendmodule\n")
+    paths = [str(tmpdir.join(name)) for name in ["top.v", "sub.v"]]
+    files = [create_source_file(path, None, library="work",
+                                include_dirs=[str(tmpdir)])
+             for path in paths]
+    fileset = SourceFileSet()
+    fileset.add(files)
+    dep_solver.solve(fileset, any_defines=True)
+    for values in itertools.product([False, True], repeat=3):
+        defines = frozenset(name for name, value in zip("ABC", values)
+                            if value)
+        dep_solver.select_defines(files, defines)
+        for path, dep_file in zip(paths, files):
+            assert set(str(rel) for rel in dep_file.rels) == set(
+                str(rel) for rel in _parse(
+                    path, [str(tmpdir)], defines).rels), (path, defines)
+
+
+def _write_uvm_source(tmpdir, name, n_fields):
+    """Write a UVM-style header of field macros expanding other macros
+    with arguments, and a module using n_fields of them and instantiating
+    a cell named by a macro"""
+    header = ["`ifndef MACROS_SVH", "`define MACROS_SVH",
+              "`define uvm_pack(ARG) p_``ARG = ARG;",
+              "`define uvm_copy(ARG) c_``ARG = ARG;",
+              "`define uvm_field_int_core(ARG, FLAG) `uvm_pack(ARG) "
+              "`uvm_copy(ARG)",
+              "`define uvm_object_utils_begin(T) typedef T this_type;",
+              "`define uvm_object_utils_end",
+              "`ifdef UVM_FAST", "`define CELL(N) fast_cell u_``N ();",
+              "`else", "`define CELL(N) slow_cell u_``N ();", "`endif"]
+    for index in range(n_fields):
+        header.append("`define uvm_field_%d(ARG, FLAG) "
+                      "`uvm_field_int_core(ARG, FLAG)" % index)
+    header.append("`endif")
+    tmpdir.join("macros.svh").write("\n".join(header) + "\n")
+    source = ["`include \"macros.svh\"", "module %s(input a);" % name,
+              "  `uvm_object_utils_begin(%s)" % name]
+    for index in range(n_fields):
+        source.append("  `uvm_field_%d(f%d, 1)" % (index, index))
+    source += ["  `uvm_object_utils_end", "  `CELL(0)", "endmodule", ""]
+    path = tmpdir.join("%s.sv" % name)
+    path.write("\n".join(source))
+    return str(path)
+
+
+def test_uvm_macros_scaling(tmpdir):
+    """Benchmark of the parse of UVM-style sources of 500 and 4000 macro
+    references: the time per reference must not grow with the size of
+    the source and the file must be parsed in a few seconds"""
+    times = {}
+    for n_fields in [500, 4000]:
+        source_dir = tmpdir.mkdir("uvm%d" % n_fields)
+        path = _write_uvm_source(source_dir, "c%d" % n_fields, n_fields)
+        best = None
+        for _ in range(3):
+            start = time.time()
+            dep_file = _parse(path, [str(source_dir)], None)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        assert _get_cells(dep_file) == set()
+        assert set(rel.obj_name for rel in dep_file.guarded_rels) == set(
+            ["work.fast_cell", "work.slow_cell"])
+        times[n_fields] = best
+        print("%d macro references: %.3f s" % (n_fields, best))
+    assert times[4000] < MAX_SECONDS, times
+    assert times[4000] / 4000 < MAX_GROWTH * times[500] / 500, times